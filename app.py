@@ -4,9 +4,53 @@ import os
 import sys
 import datetime
 import json
-from flask import Flask, request, redirect, url_for, session, g, render_template, flash, get_flashed_messages
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+import base64
+import re
+import threading
+from collections import OrderedDict
+import queue
+import time
+import hashlib
+import gzip
+import tempfile
+import mimetypes
+import random
+import cProfile
+import math
+import secrets
+import socket
+import csv
+import io
+import atexit
+import asyncio
+import multiprocessing
+import click
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, redirect, url_for, session, g, render_template, flash, get_flashed_messages, \
+    stream_template, jsonify, send_from_directory, abort, has_request_context, template_rendered, \
+    before_render_template
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import BadSignature
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from markupsafe import Markup
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ====================================================================
 # Flask App Setup & Configuration
@@ -15,230 +59,3240 @@ from werkzeug.utils import secure_filename
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['THUMBNAIL_FOLDER'] = os.path.join('uploads', 'thumbs')
+app.config['THUMBNAIL_SIZE'] = (320, 320)
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+# None serves uploads from Flask; 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx)
+# hands the file transfer to the front proxy. UPLOAD_ACCEL_PREFIX must map to
+# UPLOAD_FOLDER through an internal nginx location.
+app.config['UPLOAD_OFFLOAD'] = None
+app.config['UPLOAD_ACCEL_PREFIX'] = '/protected-uploads/'
+app.config['UPLOAD_MAX_AGE'] = 3600
+app.config['UPLOAD_IMMUTABLE_MAX_AGE'] = 365 * 24 * 3600
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['PROFILING'] = False
+app.config['PROFILE_SAMPLE_RATE'] = 0.01
+app.config['SLOW_REQUEST_SECONDS'] = 0.5
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['PAGE_SIZE'] = 50
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_POOL_TIMEOUT'] = 5
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+app.config['DB_LOCK_RETRIES'] = 3
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['DB_CACHE_SIZE_KB'] = 64 * 1024
+app.config['DB_STATEMENT_CACHE'] = 256
+# Paths of read-only copies of database.db kept current by e.g. Litestream or LiteFS.
+app.config['DB_REPLICAS'] = []
+# 'sqlite' for database.db, or 'server' for ServerStore with the driver and connect callables below.
+app.config['DATA_BACKEND'] = 'sqlite'
+app.config['DATA_SERVER_DRIVER'] = None
+app.config['DATA_SERVER_CONNECT'] = None
+app.config['DATA_SERVER_REPLICAS'] = []
+app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:260000'
+app.config['HASH_WORKERS'] = 2
+app.config['HASH_MAX_PENDING'] = 16
+app.config['HASH_TIMEOUT'] = 10
+app.config['LOGIN_RATE_PER_USER'] = (5, 60)
+app.config['LOGIN_RATE_PER_IP'] = (20, 3)
+app.config['HISTORY_QUEUE_SIZE'] = 10000
+app.config['HISTORY_BATCH_SIZE'] = 500
+app.config['HISTORY_FLUSH_INTERVAL'] = 1.0
+app.config['HISTORY_PUT_TIMEOUT'] = 0.05
+app.config['IMPORT_BATCH_SIZE'] = 5000
+app.config['IMPORT_MAX_ERRORS'] = 20
+app.config['EXPORT_BATCH_SIZE'] = 1000
+app.config['MIGRATION_BATCH_SIZE'] = 1000
+app.config['MIGRATION_BATCH_PAUSE'] = 0.02
+app.config['SESSION_CACHE_SIZE'] = 10000
+app.config['SESSION_SYNC_INTERVAL'] = 1.0
+app.config['SESSION_REFRESH_INTERVAL'] = 3600
+app.config['API_MAX_LIMIT'] = 200
+app.config['API_COMPRESS_MIN_SIZE'] = 1024
+app.config['ASGI_THREADS'] = app.config['DB_POOL_SIZE']
+app.config['ASGI_IO_THREADS'] = 2
+app.config['ASGI_SPOOL_MEMORY'] = 512 * 1024
+app.config['ASGI_RESPONSE_QUEUE'] = 16
+app.config['ASGI_SEND_BUFFER'] = 32 * 1024
+app.config['SCHEMA_AUTO_MIGRATE'] = True
+app.config['SCHEMA_LOCK_TIMEOUT'] = 3600
+app.config['SCHEDULER_ENABLED'] = True
+app.config['SCHEDULER_INTERVAL'] = 60
+app.config['SCHEDULER_LEASE'] = 300
+app.config['MAINTENANCE_HOURS'] = (3, 6)
+app.config['MAINTENANCE_ANALYSIS_LIMIT'] = 1000
+app.config['MAINTENANCE_VACUUM_PAGES'] = 10000
+app.config['UPLOAD_GC_GRACE'] = 24 * 3600
+app.config['SESSION_REVOCATION_KEEP'] = 24 * 3600
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
+if not os.path.exists(app.config['THUMBNAIL_FOLDER']):
+    os.makedirs(app.config['THUMBNAIL_FOLDER'])
+
+
+def allowed_file(filename):
+    return '.' in filename and \
+        filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+
+
+# ====================================================================
+# Instrumentation
+# ====================================================================
+# With PROFILING enabled every request records its SQL statements (count and
+# time including row fetching), JSON decoding, template rendering and password
+# hashing. The figures are sent back in a Server-Timing header, aggregated
+# per worker for /admin/metrics, and a PROFILE_SAMPLE_RATE share of requests
+# runs under cProfile, keeping a dump in PROFILE_FOLDER when it was slow.
+# Timings of a streamed page are only complete in the aggregated metrics,
+# since its headers leave before the template has been rendered.
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+MAX_TRACKED_STATEMENTS = 500
+
+
+class RequestProfile(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+        self.timings = {'json': 0.0, 'render': 0.0, 'hash': 0.0}
+        self.render_started = None
+        self.profiler = None
+
+    def add_statement(self, sql, seconds):
+        record = [sql, seconds]
+        self.statements.append(record)
+        return record
+
+    @property
+    def sql_seconds(self):
+        return sum(seconds for sql, seconds in self.statements)
+
+    def server_timing(self):
+        entries = [f'db;dur={self.sql_seconds * 1000:.2f};desc="{len(self.statements)} queries"']
+        for name, seconds in self.timings.items():
+            if seconds:
+                entries.append(f'{name};dur={seconds * 1000:.2f}')
+        entries.append(f'app;dur={(time.perf_counter() - self.started) * 1000:.2f}')
+        return ', '.join(entries)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    record = None
+
+    def execute(self, sql, parameters=()):
+        return self._profiled(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._profiled(super().executemany, sql, seq_of_parameters)
+
+    def _profiled(self, method, sql, parameters):
+        profile = current_profile()
+        if profile is None:
+            return method(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            self.record = profile.add_statement(sql, time.perf_counter() - started)
+
+    # SQLite steps through result rows lazily, so fetching is part of a statement's cost.
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def __next__(self):
+        return self._timed_fetch(super().__next__)
+
+    def _timed_fetch(self, method, *args):
+        if self.record is None:
+            return method(*args)
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.record[1] += time.perf_counter() - started
+
+
+class Metrics(object):
+    """Per-worker aggregates of request profiles, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.statements = {}
+
+    def observe(self, endpoint, status, profile, seconds):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'errors': 0, 'seconds': 0.0, 'sql_statements': 0, 'sql_seconds': 0.0,
+                    'json_seconds': 0.0, 'render_seconds': 0.0, 'hash_seconds': 0.0,
+                    'buckets': [0] * len(REQUEST_BUCKETS),
+                }
+            stats['requests'] += 1
+            stats['errors'] += status >= 500
+            stats['seconds'] += seconds
+            stats['sql_statements'] += len(profile.statements)
+            stats['sql_seconds'] += profile.sql_seconds
+            for name, value in profile.timings.items():
+                stats[f'{name}_seconds'] += value
+            for i, bound in enumerate(REQUEST_BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            for sql, statement_seconds in profile.statements:
+                key = ' '.join(sql.split())[:300]
+                if key not in self.statements and len(self.statements) >= MAX_TRACKED_STATEMENTS:
+                    key = 'other'
+                entry = self.statements.setdefault(key, [0, 0.0])
+                entry[0] += 1
+                entry[1] += statement_seconds
+
+    def render(self):
+        worker = f'worker="{os.getpid()}"'
+        lines = []
+
+        def metric(name, kind, help_text, samples, suffixes=('',)):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, sample_list in zip(suffixes, samples if len(suffixes) > 1 else [samples]):
+                for labels, value in sample_list:
+                    lines.append(f'{name}{suffix}{{{",".join([worker] + labels)}}} {value}')
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            statements = sorted(self.statements.items(), key=lambda item: -item[1][1])[:50]
+
+        def per_endpoint(key):
+            return [([f'endpoint="{endpoint}"'], stats[key]) for endpoint, stats in endpoints]
+
+        buckets = []
+        for endpoint, stats in endpoints:
+            for bound, count in zip(REQUEST_BUCKETS, stats['buckets']):
+                le = '+Inf' if bound == float('inf') else bound
+                buckets.append(([f'endpoint="{endpoint}"', f'le="{le}"'], count))
+        metric('app_request_duration_seconds', 'histogram', 'Request duration.',
+               [buckets, per_endpoint('seconds'), per_endpoint('requests')], ('_bucket', '_sum', '_count'))
+        metric('app_request_errors_total', 'counter', 'Requests answered with 5xx.', per_endpoint('errors'))
+        metric('app_sql_statements_total', 'counter', 'SQL statements executed.', per_endpoint('sql_statements'))
+        metric('app_sql_seconds_total', 'counter', 'Time spent in SQL statements.', per_endpoint('sql_seconds'))
+        metric('app_json_decode_seconds_total', 'counter', 'Time spent decoding JSON.', per_endpoint('json_seconds'))
+        metric('app_template_render_seconds_total', 'counter', 'Time spent rendering templates.',
+               per_endpoint('render_seconds'))
+        metric('app_password_hash_seconds_total', 'counter', 'Time spent hashing passwords.',
+               per_endpoint('hash_seconds'))
+
+        def statement_label(sql):
+            return 'statement="' + sql.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+        metric('app_sql_statement_seconds_total', 'counter', 'Time per SQL statement (top 50).',
+               [([statement_label(sql)], seconds) for sql, (count, seconds) in statements])
+        metric('app_sql_statement_calls_total', 'counter', 'Calls per SQL statement (top 50).',
+               [([statement_label(sql)], count) for sql, (count, seconds) in statements])
+        metric('app_store', 'gauge', 'Data store counters.',
+               [([f'stat="{name}"'], value) for name, value in sorted(get_store().stats().items())])
+        metric('app_db_pool', 'gauge', 'Connection pool counters.',
+               [([f'stat="{name}"'], value) for name, value in sorted(get_pool().stats().items())])
+        metric('app_page_cache', 'gauge', 'Page cache counters.',
+               [([f'stat="{name}"'], value) for name, value in sorted(page_cache.stats().items())])
+        metric('app_sessions', 'gauge', 'Session store counters.',
+               [([f'stat="{name}"'], value) for name, value in sorted(get_session_store().stats().items())])
+        metric('app_history', 'gauge', 'Operation history writer counters.',
+               [([f'stat="{name}"'], value) for name, value in sorted(get_history_writer().stats().items())])
+        if asgi_app.pid == os.getpid():
+            metric('app_asgi', 'gauge', 'ASGI adapter counters.',
+                   [([f'stat="{name}"'], value) for name, value in sorted(asgi_app.stats().items())])
+        if _scheduler is not None and _scheduler.pid == os.getpid():
+            metric('app_scheduler', 'gauge', 'Maintenance scheduler counters.',
+                   [([f'stat="{name}"'], value) for name, value in sorted(_scheduler.stats().items())])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def current_profile():
+    if not app.config['PROFILING'] or not has_request_context():
+        return None
+    return g.get('_profile')
+
+
+@contextmanager
+def timed(name):
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[name] += time.perf_counter() - started
+
+
+@app.before_request
+def start_profile():
+    if not app.config['PROFILING']:
+        return
+    profile = g._profile = RequestProfile()
+    if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        profile.profiler = cProfile.Profile()
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread.
+            profile.profiler = None
+
+
+@app.after_request
+def finish_profile(response):
+    profile = current_profile()
+    if profile is None:
+        return response
+    response.headers['Server-Timing'] = profile.server_timing()
+    endpoint = request.endpoint or 'unknown'
+    status = response.status_code
+
+    def on_close():
+        seconds = time.perf_counter() - profile.started
+        metrics.observe(endpoint, status, profile, seconds)
+        if profile.profiler is not None:
+            if seconds >= app.config['SLOW_REQUEST_SECONDS']:
+                os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+                filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{int(seconds * 1000)}ms.prof"
+                profile.profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], filename))
+
+    response.call_on_close(on_close)
+    return response
+
+
+@app.teardown_request
+def stop_profiler(exception):
+    # cProfile must be disabled on the thread that enabled it, which the
+    # response's close callback does not guarantee.
+    profile = current_profile()
+    if profile is not None and profile.profiler is not None:
+        profile.profiler.disable()
+
+
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.render_started is None:
+        profile.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _render_finished(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.render_started is not None:
+        profile.timings['render'] += time.perf_counter() - profile.render_started
+        profile.render_started = None
+
+
+# ====================================================================
+# Database Setup
+# ====================================================================
+
+DATABASE = 'database.db'
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that retries statements failing with "database is locked".
+
+    busy_timeout already makes SQLite wait for a lock, but a deferred
+    transaction can still fail immediately when it would deadlock. Such a
+    statement is only retried when it started its own transaction, since
+    retrying inside a caller's transaction could act on a stale snapshot.
+    """
+
+    pool = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfiledCursor)
+
+    def execute(self, sql, parameters=()):
+        return self._with_retry(self.cursor().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._with_retry(self.cursor().executemany, sql, seq_of_parameters)
+
+    def _with_retry(self, method, sql, parameters):
+        was_in_transaction = self.in_transaction
+        attempt = 0
+        while True:
+            try:
+                return method(sql, parameters)
+            except sqlite3.OperationalError as e:
+                if was_in_transaction or 'locked' not in str(e) or attempt >= app.config['DB_LOCK_RETRIES']:
+                    raise
+                if self.in_transaction:
+                    self.rollback()
+                attempt += 1
+                if self.pool is not None:
+                    self.pool.count('lock_retries')
+                time.sleep(0.01 * 2 ** attempt)
+
+
+class ConnectionPool(object):
+    """Per-process pool of configured SQLite connections.
+
+    Connections keep their prepared statement cache and page cache between
+    requests. A pool created before a fork is discarded by get_pool() in the
+    child, so each gunicorn worker owns its connections.
+    """
+
+    def __init__(self, database, size, timeout, readonly=False):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.readonly = readonly
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.metrics = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'lock_retries': 0,
+        }
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def connect(self):
+        database = f'file:{self.database}?mode=ro' if self.readonly else self.database
+        db = sqlite3.connect(database, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                             check_same_thread=False, factory=PooledConnection,
+                             cached_statements=app.config['DB_STATEMENT_CACHE'], uri=self.readonly)
+        db.row_factory = sqlite3.Row
+        if not self.readonly:
+            # Only takes effect on a new, empty database; see the vacuum command.
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+        db.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+        db.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+        db.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")
+        db.execute('PRAGMA temp_store = MEMORY')
+        # Load the schema now rather than on the first request that uses the connection.
+        db.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        db.pool = self
+        self.count('created')
+        return db
+
+    def acquire(self):
+        self.count('checkouts')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        self.count('waits')
+        started = time.perf_counter()
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            # Every pooled connection is busy; serve the request with a temporary one
+            # rather than failing it. release() closes it once the pool is full again.
+            self.count('timeouts')
+            with self._lock:
+                self._created += 1
+            return self.connect()
+        finally:
+            self.count('wait_seconds', time.perf_counter() - started)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        with self._lock:
+            keep = self._created <= self.size
+            if not keep:
+                self._created -= 1
+        if keep:
+            self._idle.put(db)
+        else:
+            db.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['size'] = self.size
+            stats['open'] = self._created
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+
+def get_pool():
+    return get_store().primary
+
+
+def get_db():
+    db = getattr(g, '_database', None)
+    if db is None:
+        db = g._database = get_pool().acquire()
+    return db
+
+
+@app.teardown_appcontext
+def close_connection(exception):
+    replica = g.pop('_read_replica', None)
+    if replica is not None:
+        replica[0].release(replica[1])
+    g.pop('_read_database', None)
+    db = g.pop('_database', None)
+    if db is not None:
+        db.pool.release(db)
+
+
+# ====================================================================
+# Data Access
+# ====================================================================
+# Routes read and write users, listings and settings through get_store()
+# rather than with SQL of their own. Write methods leave committing to the
+# caller: store.commit(), or store.batch() to run several writes in one
+# IMMEDIATE transaction. Reads that tolerate replication lag (listing pages
+# and details) pass replica=True; they are served by one of the read
+# replicas if it has caught up with the content version this request saw
+# on the primary, and by the primary otherwise. Driver errors that callers
+# act upon are raised as store errors (DuplicateError).
+
+class DuplicateError(Exception):
+    """A write conflicted with a unique key, e.g. a username that is taken."""
+
+
+_schema_thread_lock = threading.Lock()
+
+
+class SQLiteStore(object):
+    """Users, listings and settings in the SQLite file, with optional read-only replicas."""
+
+    # DB-API module whose Error and IntegrityError the connections raise.
+    driver = sqlite3
+
+    def __init__(self, primary, replicas=()):
+        self.pid = os.getpid()
+        self.primary = self.make_pool(primary)
+        self.replicas = [self.make_pool(replica, readonly=True) for replica in replicas]
+        self._lock = threading.Lock()
+        self.metrics = {'primary_reads': 0, 'replica_reads': 0, 'stale_replicas': 0, 'batches': 0}
+
+    def make_pool(self, database, readonly=False):
+        return ConnectionPool(database, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'], readonly)
+
+    def count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats['replicas'] = len(self.replicas)
+        return stats
+
+    def writer(self):
+        return get_db()
+
+    def reader(self):
+        """Connection for lag-tolerant reads, picked once per request."""
+        db = g.get('_read_database')
+        if db is not None:
+            return db
+        db = self.writer()
+        if self.replicas:
+            pool = random.choice(self.replicas)
+            replica = pool.acquire()
+            try:
+                fresh = replica.execute('SELECT content_version FROM settings WHERE id = 1').fetchone()[0] \
+                    >= content_version()
+            except self.driver.Error as e:
+                app.logger.warning("Read replica unavailable: %s", e)
+                fresh = False
+            if fresh:
+                g._read_replica = (pool, replica)
+                db = replica
+            else:
+                pool.release(replica)
+                self.count('stale_replicas')
+        self.count('replica_reads' if db is not self.writer() else 'primary_reads')
+        g._read_database = db
+        return db
+
+    def commit(self):
+        self.writer().commit()
+
+    @contextmanager
+    def batch(self):
+        db = self.writer()
+        if not db.in_transaction:
+            db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        self.count('batches')
+
+    @contextmanager
+    def schema_lock(self):
+        """Serialize migrations across processes (only within one process where fcntl is missing)."""
+        if fcntl is None:
+            with _schema_thread_lock:
+                yield
+            return
+        with open(f'{self.primary.database}.migrate-lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Users
+
+    def get_user(self, user_id):
+        return self.writer().execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+
+    def find_user(self, username):
+        return self.writer().execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+
+    def user_ids(self):
+        return {row[0] for row in self.writer().execute('SELECT id FROM users')}
+
+    def create_user(self, username, password_hash):
+        try:
+            return self.writer().execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                                         (username, password_hash)).lastrowid
+        except self.driver.IntegrityError as e:
+            raise DuplicateError(str(e))
+
+    def update_user(self, user_id, **values):
+        columns = ', '.join(f'{name} = ?' for name in values)
+        self.writer().execute(f'UPDATE users SET {columns} WHERE id = ?', list(values.values()) + [user_id])
+
+    def delete_user(self, user_id):
+        self.writer().execute('DELETE FROM users WHERE id = ?', (user_id,))
+
+    def page_users(self, sort_by, order, limit, prefix=None, cursor_key=None):
+        conditions = []
+        params = []
+        if prefix:
+            # A prefix range instead of LIKE so the search uses the username index.
+            conditions.append('username >= ? AND username < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        if cursor_key:
+            conditions.append(f"({sort_by}, id) {'>' if order == 'asc' else '<'} (?, ?)")
+            params.extend(cursor_key)
+        query = "SELECT * FROM users WHERE 1=1" + ''.join(' AND ' + c for c in conditions)
+        query += f" ORDER BY {sort_by} {order.upper()}, id {order.upper()} LIMIT ?"
+        return self.writer().execute(query, params + [limit]).fetchall()
+
+    def top_users(self, limit):
+        return self.writer().execute('SELECT id, username, post_count, accepted_count FROM users '
+                                     'ORDER BY post_count DESC, id DESC LIMIT ?', (limit,)).fetchall()
+
+    # Listings
+
+    def get_listing(self, listing_id, replica=False):
+        db = self.reader() if replica else self.writer()
+        return db.execute('SELECT * FROM listings WHERE id = ?', (listing_id,)).fetchone()
+
+    def page_listings(self, listing_query, replica=True):
+        db = self.reader() if replica else self.writer()
+        return db.execute(listing_query.sql, listing_query.params).fetchall()
+
+    def insert_listing(self, user_id, data, post_date, search_fields):
+        db = self.writer()
+        listing_id = db.execute('INSERT INTO listings (user_id, data, post_date) VALUES (?, ?, ?)',
+                                (user_id, json.dumps(data), post_date)).lastrowid
+        index_listing(db, listing_id, data, search_fields)
+        bump_content_version(db)
+        return listing_id
+
+    def update_listing(self, listing_id, data, search_fields, migration_id):
+        """Replace the data; migration_id is the newest field migration whose shape data already has."""
+        db = self.writer()
+        db.execute('UPDATE listings SET data = ?, migration_id = ?, rev = rev + 1 WHERE id = ?',
+                   (json.dumps(data), migration_id, listing_id))
+        index_listing(db, listing_id, data, search_fields)
+        bump_content_version(db)
+
+    def delete_listing(self, listing_id):
+        db = self.writer()
+        db.execute('DELETE FROM listings WHERE id = ?', (listing_id,))
+        unindex_listing(db, listing_id)
+        bump_content_version(db)
+
+    def set_listing_status(self, listing_ids, status, current):
+        """Change the status of those listings currently in one of the statuses current; returns how many."""
+        db = self.writer()
+        changed = 0
+        for i in range(0, len(listing_ids), BULK_STATUS_CHUNK):
+            chunk = listing_ids[i:i + BULK_STATUS_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            # The stats triggers update users.accepted_count in this same transaction.
+            changed += db.execute(f"UPDATE listings SET status = ?, rev = rev + 1 WHERE id IN ({placeholders}) "
+                                  f"AND status IN ({', '.join('?' * len(current))})",
+                                  [status] + chunk + list(current)).rowcount
+        if changed:
+            bump_content_version(db)
+        return changed
+
+    def insert_listings(self, batch, search_fields):
+        """Insert (listing data, (user_id, data JSON, post_date, status)) pairs in one transaction."""
+        with self.batch():
+            db = self.writer()
+            # Ids are assigned here rather than by AUTOINCREMENT so the search rows
+            # can be written with the same executemany pass.
+            next_id = db.execute("SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'listings'), 0), "
+                                 "coalesce((SELECT max(id) FROM listings), 0)) + 1").fetchone()[0]
+            db.executemany('INSERT INTO listings (id, user_id, data, post_date, status) VALUES (?, ?, ?, ?, ?)',
+                           [(next_id + i,) + params for i, (listing_data, params) in enumerate(batch)])
+            if app.config['SEARCH_ENABLED']:
+                db.executemany('INSERT INTO search_docs (listing_id, field, body) VALUES (?, ?, ?)',
+                               [(next_id + i, name, listing_data[name])
+                                for i, (listing_data, params) in enumerate(batch) for name in search_fields
+                                if isinstance(listing_data.get(name), str) and listing_data[name]])
+            bump_content_version(db)
+
+    def scan_listings(self, batch_size):
+        """Yield all listings in id order, batch by batch, on a connection of its own.
+
+        Used for streamed exports, which outlive the request's connection.
+        """
+        db = self.primary.acquire()
+        try:
+            last_id = 0
+            while True:
+                rows = db.execute('SELECT id, user_id, data, post_date, status, migration_id FROM listings '
+                                  'WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+                if not rows:
+                    return
+                last_id = rows[-1]['id']
+                yield rows
+        finally:
+            self.primary.release(db)
+
+    def listing_stats(self, since):
+        db = self.writer()
+        return (db.execute('SELECT day, sum(count) AS count FROM listing_stats WHERE day >= ? '
+                           'GROUP BY day ORDER BY day DESC', (since,)).fetchall(),
+                db.execute('SELECT status, sum(count) AS count FROM listing_stats '
+                           'GROUP BY status ORDER BY status').fetchall())
+
+    # History
+
+    def page_history(self, limit, user_id=None, action=None, before=None):
+        conditions = []
+        params = []
+        for condition, value in (('user_id = ?', user_id), ('action = ?', action), ('id < ?', before)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = "SELECT * FROM history WHERE 1=1" + ''.join(' AND ' + c for c in conditions)
+        query += " ORDER BY id DESC LIMIT ?"
+        return self.writer().execute(query, params + [limit]).fetchall()
+
+    # Settings
+
+    def settings_versions(self):
+        return self.writer().execute('SELECT version, content_version, content_updated_at FROM settings '
+                                     'WHERE id = 1').fetchone()
+
+    def load_settings(self):
+        return self.writer().execute('SELECT * FROM settings WHERE id = 1').fetchone()
+
+    def pending_field_migrations(self):
+        return self.writer().execute("SELECT id, max_id, plan FROM field_migrations WHERE status != 'done' "
+                                     "ORDER BY id").fetchall()
+
+    def recent_field_migrations(self, limit):
+        return self.writer().execute('SELECT * FROM field_migrations ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+    def update_settings(self, **values):
+        columns = ''.join(f'{name} = ?, ' for name in values)
+        self.writer().execute(f'UPDATE settings SET {columns}version = version + 1 WHERE id = 1',
+                              list(values.values()))
+
+
+class ServerConnectionPool(ConnectionPool):
+    """Pool of connections made by a DB-API connect callable instead of a local file."""
+
+    def connect(self):
+        db = self.database()
+        db.pool = self
+        self.count('created')
+        return db
+
+
+class ServerStore(SQLiteStore):
+    """Store on a database server that speaks SQLite's dialect, such as libSQL (sqld) or rqlite.
+
+    driver is the DB-API module of the server's client library; its Error and
+    IntegrityError are the exceptions the store translates. The primary and
+    each replica are given as callables returning a connection with the
+    sqlite3 API (execute(), rows addressable by column name, in_transaction),
+    as the driver or a thin adapter provides. Schema, triggers and FTS5 carry
+    over unchanged; PRAGMAs tuning the file are the server's business. Since
+    workers may run on several hosts, migrations are serialized by a lock row
+    in the database rather than by a local file.
+    """
+
+    def __init__(self, driver, primary, replicas=()):
+        self.driver = driver
+        super().__init__(primary, replicas)
+
+    def make_pool(self, connect, readonly=False):
+        return ServerConnectionPool(connect, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'], readonly)
+
+    @contextmanager
+    def schema_lock(self):
+        owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        db = self.primary.acquire()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS schema_lock (id INTEGER PRIMARY KEY CHECK (id = 1), '
+                       'owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+            db.commit()
+            while True:
+                # A holder that has not released the lock within SCHEMA_LOCK_TIMEOUT is presumed dead.
+                now = time.time()
+                acquired = db.execute('INSERT INTO schema_lock (id, owner, expires_at) VALUES (1, ?, ?) '
+                                      'ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, '
+                                      'expires_at = excluded.expires_at WHERE expires_at < ?',
+                                      (owner, now + app.config['SCHEMA_LOCK_TIMEOUT'], now)).rowcount == 1
+                db.commit()
+                if acquired:
+                    break
+                time.sleep(1)
+            try:
+                yield
+            finally:
+                db.execute('DELETE FROM schema_lock WHERE owner = ?', (owner,))
+                db.commit()
+        finally:
+            self.primary.release(db)
+
+
+def local_server(path):
+    """Connect callable for a local file (driver sqlite3), standing in for a server in tests."""
+    def connect():
+        db = sqlite3.connect(path, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000, check_same_thread=False,
+                             factory=PooledConnection)
+        db.row_factory = sqlite3.Row
+        return db
+
+    return connect
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None or _store.pid != os.getpid():
+        with _store_lock:
+            if _store is None or _store.pid != os.getpid():
+                if app.config['DATA_BACKEND'] == 'server':
+                    _store = ServerStore(app.config['DATA_SERVER_DRIVER'], app.config['DATA_SERVER_CONNECT'],
+                                         app.config['DATA_SERVER_REPLICAS'])
+                else:
+                    _store = SQLiteStore(DATABASE, app.config['DB_REPLICAS'])
+    return _store
+
+
+# ====================================================================
+# Dynamic Field Columns
+# ====================================================================
+# Filterable and sortable dynamic fields are mirrored as VIRTUAL generated
+# columns over listings.data with an (column, id) index each, so that sort,
+# keyset pagination and filters are served from an index instead of calling
+# json_extract on every row. ALTER TABLE ... DROP COLUMN needs SQLite 3.35.
+#
+# Number columns hold REAL values so they sort numerically; a missing number
+# becomes -Inf (a missing text or date becomes ''), which keeps every column
+# NOT NULL for the (value, id) keyset comparison and sorts missing values first.
+# Number and date fields are filtered by min/max ranges on these indexes.
+
+FIELD_COLUMN_PREFIX = 'f_'
+RANGE_FIELD_TYPES = ['number', 'date']
+MISSING_NUMBER_SQL = '-9e999'
+SUPPORTS_FIELD_COLUMNS = sqlite3.sqlite_version_info >= (3, 35, 0)
+FIELD_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def has_field_column(field):
+    return SUPPORTS_FIELD_COLUMNS and field['type'] not in ['textarea', 'file'] \
+        and FIELD_NAME_PATTERN.match(field['name']) is not None
+
+
+def field_column(field):
+    return FIELD_COLUMN_PREFIX + field['name']
+
+
+def field_value_sql(field):
+    value = f"json_extract(data, '$.{field['name']}')"
+    if field['type'] == 'number':
+        return f"IFNULL(CAST(NULLIF({value}, '') AS REAL), {MISSING_NUMBER_SQL})"
+    return f"IFNULL({value}, '')"
+
+
+def field_missing_sql(field):
+    return MISSING_NUMBER_SQL if field['type'] == 'number' else "''"
+
+
+def field_expr(field):
+    if has_field_column(field):
+        return field_column(field)
+    return field_value_sql(field)
+
+
+def parse_number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = value
+    else:
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(value)
+    return number
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+
+
+def coerce_form_value(field, value):
+    """Convert a submitted value to its stored form; raise ValueError with a message."""
+    if field['type'] not in RANGE_FIELD_TYPES:
+        return value
+    if value is None or value == '':
+        return None
+    try:
+        return parse_number(value) if field['type'] == 'number' else parse_date(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"字段 '{field['label']}' 必须是{'数字' if field['type'] == 'number' else '日期'}")
+
+
+def sync_field_columns(db, fields):
+    """Match the generated f_ columns to fields; the caller commits.
+
+    Adding or dropping a VIRTUAL column only changes the schema. Their indexes
+    have to read every row, so create_field_indexes() builds them separately.
+    """
+    if not SUPPORTS_FIELD_COLUMNS:
+        return
+
+    existing = {row['name'] for row in db.execute('PRAGMA table_xinfo(listings)')
+                if row['name'].startswith(FIELD_COLUMN_PREFIX)}
+    wanted = {field_column(f): f for f in fields if has_field_column(f)}
+    definitions = {column: f"{column} GENERATED ALWAYS AS ({field_value_sql(field)}) VIRTUAL"
+                   for column, field in wanted.items()}
+    # ADD COLUMN keeps the column definition text in sqlite_master, which tells
+    # whether an existing column still matches its field's type.
+    table_sql = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'listings'").fetchone()[0]
+    stale = {column for column in existing & wanted.keys() if definitions[column] not in table_sql}
+
+    for column in (existing - wanted.keys()) | stale:
+        db.execute(f'DROP INDEX IF EXISTS idx_listings_{column}')
+        db.execute(f'ALTER TABLE listings DROP COLUMN {column}')
+    for column, field in wanted.items():
+        if column not in existing or column in stale:
+            db.execute(f"ALTER TABLE listings ADD COLUMN {definitions[column]}")
+
+
+def create_field_indexes(db, fields):
+    """Index the f_ columns that have no index yet, one transaction per index."""
+    if not SUPPORTS_FIELD_COLUMNS:
+        return
+    existing = {row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                  "AND tbl_name = 'listings'")}
+    for field in fields:
+        column = field_column(field)
+        if has_field_column(field) and f'idx_listings_{column}' not in existing:
+            db.execute(f'CREATE INDEX IF NOT EXISTS idx_listings_{column} ON listings ({column}, id)')
+            db.commit()
+
+
+# ====================================================================
+# Full-Text Search
+# ====================================================================
+# Text and textarea values are copied into search_docs (one row per listing
+# and field) and indexed by an external-content FTS5 table using the trigram
+# tokenizer, which keeps the substring semantics of the old LIKE '%x%'
+# filters, works for CJK text and ranks hits with bm25. Terms shorter than
+# three characters cannot be matched by trigrams and fall back to LIKE.
+
+SEARCH_FIELD_TYPES = ['text', 'textarea']
+SEARCH_MIN_TERM_LENGTH = 3
+SEARCH_MAX_TERMS = 5
+# FTS5 cannot parse control characters (NUL ends the query string) even inside a quoted phrase.
+SEARCH_CONTROL_CHARS = re.compile(r'[\x00-\x1f\x7f]')
+app.config['SEARCH_ENABLED'] = False
+
+
+def init_search(db):
+    try:
+        db.execute('''
+                   CREATE TABLE IF NOT EXISTS search_docs
+                   (
+                       id INTEGER PRIMARY KEY,
+                       listing_id INTEGER NOT NULL,
+                       field TEXT NOT NULL,
+                       body TEXT NOT NULL
+                   );
+                   ''')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_listing ON search_docs (listing_id)')
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts "
+                   "USING fts5(body, content='search_docs', content_rowid='id', tokenize='trigram')")
+        db.execute('''
+                   CREATE TRIGGER IF NOT EXISTS search_docs_ai AFTER INSERT ON search_docs BEGIN
+                       INSERT INTO listings_fts (rowid, body) VALUES (new.id, new.body);
+                   END;
+                   ''')
+        db.execute('''
+                   CREATE TRIGGER IF NOT EXISTS search_docs_ad AFTER DELETE ON search_docs BEGIN
+                       INSERT INTO listings_fts (listings_fts, rowid, body) VALUES ('delete', old.id, old.body);
+                   END;
+                   ''')
+        db.commit()
+    except sqlite3.OperationalError as e:
+        db.rollback()
+        print(f"Full-text search disabled: {e}")
+        return False
+    return True
+
+
+def search_field_names(fields):
+    return {f['name'] for f in fields if f['type'] in SEARCH_FIELD_TYPES}
+
+
+def index_listing(db, listing_id, listing_data, search_fields):
+    if not app.config['SEARCH_ENABLED']:
+        return
+    db.execute('DELETE FROM search_docs WHERE listing_id = ?', (listing_id,))
+    db.executemany('INSERT INTO search_docs (listing_id, field, body) VALUES (?, ?, ?)',
+                   [(listing_id, name, listing_data[name]) for name in search_fields
+                    if isinstance(listing_data.get(name), str) and listing_data[name]])
+
+
+def unindex_listing(db, listing_id):
+    if not app.config['SEARCH_ENABLED']:
+        return
+    db.execute('DELETE FROM search_docs WHERE listing_id = ?', (listing_id,))
+
+
+def backfill_search_field(db, name):
+    path = f'$.{name}'
+    db.execute("INSERT INTO search_docs (listing_id, field, body) "
+               "SELECT id, ?, json_extract(data, ?) FROM listings "
+               "WHERE json_type(data, ?) = 'text' AND json_extract(data, ?) != ''",
+               (name, path, path, path))
+
+
+def rebuild_search_index(db, fields):
+    # Dropping the triggers and the FTS table first lets SQLite truncate
+    # search_docs instead of firing a delete trigger per row.
+    db.execute('DROP TRIGGER IF EXISTS search_docs_ai')
+    db.execute('DROP TRIGGER IF EXISTS search_docs_ad')
+    db.execute('DROP TABLE IF EXISTS listings_fts')
+    db.execute('DELETE FROM search_docs')
+    for name in search_field_names(fields):
+        backfill_search_field(db, name)
+    db.commit()
+    if init_search(db):
+        db.execute("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')")
+        db.commit()
+        return True
+    return False
+
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+class ListingSearch(object):
+    """Collects the joins and conditions that restrict index() to search hits.
+
+    Every rankable term becomes a joined subquery yielding the best bm25 score
+    per listing; ``score_expr`` sums them so results can be ordered by relevance.
+    """
+
+    def __init__(self):
+        self.joins = []
+        self.join_params = []
+        self.conditions = []
+        self.params = []
+        self.scores = []
+
+    def add(self, term, field_name=None):
+        term = SEARCH_CONTROL_CHARS.sub('', term)
+        if not term:
+            return
+        field_sql = ' AND d.field = ?' if field_name else ''
+        field_params = [field_name] if field_name else []
+        if len(term) < SEARCH_MIN_TERM_LENGTH:
+            self.conditions.append(f"id IN (SELECT d.listing_id FROM search_docs d WHERE d.body LIKE ?{field_sql})")
+            self.params.extend([f'%{term}%'] + field_params)
+            return
+        alias = f'hits{len(self.scores)}'
+        self.joins.append(f"JOIN (SELECT d.listing_id, MIN(listings_fts.rank) AS score FROM listings_fts "
+                          f"JOIN search_docs d ON d.id = listings_fts.rowid "
+                          f"WHERE listings_fts MATCH ?{field_sql} GROUP BY d.listing_id) AS {alias} "
+                          f"ON {alias}.listing_id = listings.id")
+        self.join_params.extend([fts_phrase(term)] + field_params)
+        self.scores.append(f'{alias}.score')
+
+    @property
+    def score_expr(self):
+        return ' + '.join(self.scores) if self.scores else None
+
+
+# ====================================================================
+# Listing Statistics
+# ====================================================================
+# users.post_count / users.accepted_count and the listing_stats rollup
+# (listings per day and status) are maintained by triggers on listings, so
+# every write path, bulk import included, keeps them exact within its own
+# transaction and the admin dashboard never has to COUNT(*) the listings.
+#
+# A listing is accepted by an admin and then closed (completed) by its owner
+# or an admin; accepted_count counts listings in ACCEPTED_STATUSES.
+
+LISTING_STATUSES = OrderedDict([
+    ('open', '开放'),
+    ('accepted', '已接受'),
+    ('closed', '已完成'),
+])
+ACCEPTED_STATUSES = ('accepted', 'closed')
+# target status -> (statuses it can be reached from, whether the owner may do it, action label)
+STATUS_TRANSITIONS = OrderedDict([
+    ('accepted', (('open',), False, '接受')),
+    ('closed', (('accepted',), True, '完成')),
+    ('open', (('accepted', 'closed'), False, '重新开放')),
+])
+BULK_STATUS_CHUNK = 500
+app.add_template_global(LISTING_STATUSES, 'listing_statuses')
+app.add_template_global(STATUS_TRANSITIONS, 'status_transitions')
+
+
+def init_listing_stats(db):
+    """Create the rollup table and triggers; return True if the triggers were (re)created."""
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS listing_stats
+               (
+                   day TEXT NOT NULL,
+                   status TEXT NOT NULL,
+                   count INTEGER NOT NULL DEFAULT 0,
+                   PRIMARY KEY (day, status)
+               );
+               ''')
+    accepted = ', '.join(f"'{status}'" for status in ACCEPTED_STATUSES)
+    triggers = {}
+    triggers['listings_stats_ai'] = f'''
+               CREATE TRIGGER listings_stats_ai AFTER INSERT ON listings BEGIN
+                   UPDATE users SET post_count = post_count + 1,
+                                    accepted_count = accepted_count + (new.status IN ({accepted}))
+                   WHERE id = new.user_id;
+                   INSERT INTO listing_stats (day, status, count) VALUES (substr(new.post_date, 1, 10), new.status, 1)
+                   ON CONFLICT (day, status) DO UPDATE SET count = count + 1;
+               END;
+               '''
+    triggers['listings_stats_ad'] = f'''
+               CREATE TRIGGER listings_stats_ad AFTER DELETE ON listings BEGIN
+                   UPDATE users SET post_count = post_count - 1,
+                                    accepted_count = accepted_count - (old.status IN ({accepted}))
+                   WHERE id = old.user_id;
+                   UPDATE listing_stats SET count = count - 1
+                   WHERE day = substr(old.post_date, 1, 10) AND status = old.status;
+               END;
+               '''
+    triggers['listings_stats_au'] = f'''
+               CREATE TRIGGER listings_stats_au AFTER UPDATE OF user_id, status, post_date ON listings
+               BEGIN
+                   UPDATE users SET post_count = post_count - 1,
+                                    accepted_count = accepted_count - (old.status IN ({accepted}))
+                   WHERE id = old.user_id;
+                   UPDATE users SET post_count = post_count + 1,
+                                    accepted_count = accepted_count + (new.status IN ({accepted}))
+                   WHERE id = new.user_id;
+                   UPDATE listing_stats SET count = count - 1
+                   WHERE day = substr(old.post_date, 1, 10) AND status = old.status;
+                   INSERT INTO listing_stats (day, status, count) VALUES (substr(new.post_date, 1, 10), new.status, 1)
+                   ON CONFLICT (day, status) DO UPDATE SET count = count + 1;
+               END;
+               '''
+    # Triggers written for another ACCEPTED_STATUSES are replaced; the caller
+    # then has to recount accepted_count.
+    changed = False
+    for name, sql in triggers.items():
+        existing = db.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()
+        if existing is not None and f'IN ({accepted})' in existing[0]:
+            continue
+        db.execute(f'DROP TRIGGER IF EXISTS {name}')
+        db.execute(sql)
+        changed = True
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_post_count ON users (post_count, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_accepted_count ON users (accepted_count, id)')
+    db.commit()
+    return changed
+
+
+def rebuild_listing_stats(db):
+    """Recompute the counters and the rollup from scratch (one full scan)."""
+    accepted = ', '.join(f"'{status}'" for status in ACCEPTED_STATUSES)
+    db.execute(f'''
+               UPDATE users SET
+                   post_count = (SELECT count(*) FROM listings WHERE user_id = users.id),
+                   accepted_count = (SELECT count(*) FROM listings WHERE user_id = users.id
+                                     AND status IN ({accepted}))
+               ''')
+    db.execute('DELETE FROM listing_stats')
+    db.execute("INSERT INTO listing_stats (day, status, count) "
+               "SELECT substr(post_date, 1, 10), status, count(*) FROM listings GROUP BY 1, 2")
+    db.commit()
+
+
+# ====================================================================
+# Field Migrations
+# ====================================================================
+# When update_fields() changes the field definitions, the listings are brought
+# to the new shape in the background: a migration stores a plan (for every new
+# field: the key it is read from, whether its value must be coerced to the new
+# type and an optional default) and the id of the last listing it covers. The
+# runner rewrites listings in batches of MIGRATION_BATCH_SIZE rows, each in its
+# own short transaction that also advances the migration's cursor, so a restart
+# resumes where it stopped and several workers may run it side by side. Keys
+# that are not in the plan are dropped.
+#
+# Until the runner gets to a listing, readers apply the pending plans to its
+# data themselves (migrate_listing_data), so it is always shown and edited in
+# the current shape. listings.migration_id records the last migration a row's
+# data already follows: an edit writes the current shape, and the runner must
+# not apply older plans to it again.
+#
+# The runner also rewrites the search rows of each batch and, once no batch is
+# left, builds the indexes of new typed field columns. update_fields() itself
+# only stores the definitions, the generated columns and the plan, so the admin
+# request holds the write lock for milliseconds whatever the table size.
+
+_migrations_pending = False
+
+
+def plan_field_migration(old_fields, new_fields, originals):
+    """Return the migration plan for new_fields, or None if rows need no rewrite.
+
+    originals[i] is the name new_fields[i] had before (empty for new fields).
+    """
+    old_by_name = {f['name']: f for f in old_fields}
+    sources = {}
+    for field, original in zip(new_fields, originals):
+        if original in old_by_name and original not in sources.values():
+            sources[field['name']] = original
+    for field in new_fields:
+        if field['name'] not in sources and field['name'] in old_by_name \
+                and field['name'] not in sources.values():
+            sources[field['name']] = field['name']
+
+    plan = []
+    changed = set(old_by_name) != set(sources.values())
+    for field in new_fields:
+        source = old_by_name.get(sources.get(field['name']))
+        step = {'name': field['name'], 'source': source['name'] if source else None, 'type': field['type'],
+                'coerce': source is not None and source['type'] != field['type'], 'default': None}
+        default = field.get('default')
+        if default not in (None, '') and (source is None or source.get('default') != default
+                                          or (field['required'] and not source['required'])):
+            step['default'] = default
+        changed = changed or step['source'] != step['name'] or step['coerce'] or step['default'] is not None
+        plan.append(step)
+    return plan if changed else None
+
+
+def coerce_field_value(value, field_type):
+    if value is None or value == '':
+        return value
+    if field_type == 'number':
+        try:
+            return parse_number(value)
+        except (TypeError, ValueError):
+            return None
+    if field_type == 'date':
+        try:
+            return parse_date(value)
+        except (TypeError, ValueError):
+            return None
+    if field_type == 'file':
+        return value if isinstance(value, str) else None
+    return value if isinstance(value, str) else str(value)
+
+
+def apply_field_migration(data, plan):
+    migrated = {}
+    for step in plan:
+        # Rows written after the change already use the new name.
+        if step['source'] is not None and step['source'] in data:
+            value = data[step['source']]
+        else:
+            value = data.get(step['name'])
+        if step['coerce']:
+            value = coerce_field_value(value, step['type'])
+        if step['default'] is not None and value in (None, ''):
+            value = step['default']
+        migrated[step['name']] = value
+    return migrated
+
+
+def migrate_listing_data(listing, data, settings):
+    """Return data in the current field shape, applying the plans the runner has not applied to it yet."""
+    for migration_id, max_id, plan in settings['pending_migrations']:
+        if listing['id'] <= max_id and listing['migration_id'] < migration_id:
+            data = apply_field_migration(data, plan)
+    return data
+
+
+def record_field_migration(db, plan):
+    """Queue the plan for the migration runner; the caller commits, then calls start_field_migration()."""
+    max_id, total = db.execute('SELECT coalesce(max(id), 0), count(*) FROM listings').fetchone()
+    db.execute("INSERT INTO field_migrations (created_at, plan, max_id, total) VALUES (?, ?, ?, ?)",
+               (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), json.dumps(plan), max_id, total))
+
+
+def start_field_migration():
+    global _migrations_pending
+    _migrations_pending = True
+    get_migration_runner().wake()
+
+
+def run_migration_batch(db):
+    """Migrate the next batch of the oldest unfinished migration; False when none is left."""
+    migration = db.execute("SELECT id, plan FROM field_migrations WHERE status != 'done' "
+                           "ORDER BY id LIMIT 1").fetchone()
+    if migration is None:
+        return False
+    plan = json.loads(migration['plan'])
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        state = db.execute('SELECT last_id, max_id, status FROM field_migrations WHERE id = ?',
+                           (migration['id'],)).fetchone()
+        if state['status'] == 'done':
+            db.commit()
+            return True
+        rows = db.execute('SELECT id, data, migration_id FROM listings WHERE id > ? AND id <= ? '
+                          'ORDER BY id LIMIT ?',
+                          (state['last_id'], state['max_id'], app.config['MIGRATION_BATCH_SIZE'])).fetchall()
+        if not rows:
+            db.execute("UPDATE field_migrations SET status = 'done', error = NULL, finished_at = ? WHERE id = ?",
+                       (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), migration['id']))
+            # Workers keep the pending plans with their cached settings.
+            db.execute('UPDATE settings SET version = version + 1 WHERE id = 1')
+            db.commit()
+            return True
+
+        search_fields = search_field_names(plan)
+        # A field that became searchable needs search rows even where its value stays the same.
+        reindex_all = any(step['coerce'] and step['type'] in SEARCH_FIELD_TYPES for step in plan)
+        updates = []
+        reindex = []
+        pending = []
+        for row in rows:
+            if row['migration_id'] >= migration['id']:
+                continue
+            pending.append((row['id'],))
+            data = json.loads(row['data']) if row['data'] else {}
+            migrated = apply_field_migration(data, plan)
+            if migrated != data:
+                updates.append((row['id'], migrated))
+            if migrated != data or reindex_all:
+                reindex.append((row['id'], migrated))
+        if updates:
+            db.executemany('UPDATE listings SET data = ?, migration_id = ?, rev = rev + 1 WHERE id = ?',
+                           [(json.dumps(migrated), migration['id'], listing_id) for listing_id, migrated in updates])
+        dropped = 0
+        if app.config['SEARCH_ENABLED']:
+            # Search rows of dropped, renamed or no longer searchable fields.
+            placeholders = ', '.join('?' * len(search_fields))
+            dropped = db.executemany(f'DELETE FROM search_docs WHERE listing_id = ? AND field NOT IN ({placeholders})',
+                                     [row + tuple(sorted(search_fields)) for row in pending]).rowcount
+            db.executemany('DELETE FROM search_docs WHERE listing_id = ?',
+                           [(listing_id,) for listing_id, migrated in reindex])
+            db.executemany('INSERT INTO search_docs (listing_id, field, body) VALUES (?, ?, ?)',
+                           [(listing_id, name, migrated[name]) for listing_id, migrated in reindex
+                            for name in search_fields if isinstance(migrated.get(name), str) and migrated[name]])
+        if reindex or dropped:
+            bump_content_version(db)
+        db.execute("UPDATE field_migrations SET last_id = ?, processed = processed + ?, "
+                   "rewritten = rewritten + ?, status = 'running', error = NULL WHERE id = ?",
+                   (rows[-1]['id'], len(rows), len(updates), migration['id']))
+        db.commit()
+    except BaseException as e:
+        db.rollback()
+        db.execute('UPDATE field_migrations SET error = ? WHERE id = ?', (str(e), migration['id']))
+        db.commit()
+        raise
+    return True
+
+
+class MigrationRunner(object):
+    """Background thread that runs pending field migrations when woken."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='field-migrations', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        global _migrations_pending
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            pool = get_pool()
+            try:
+                while True:
+                    db = pool.acquire()
+                    try:
+                        if not run_migration_batch(db):
+                            fields = db.execute('SELECT fields_definition FROM settings WHERE id = 1').fetchone()[0]
+                            create_field_indexes(db, json.loads(fields))
+                            _migrations_pending = False
+                            break
+                    finally:
+                        pool.release(db)
+                    time.sleep(app.config['MIGRATION_BATCH_PAUSE'])
+            except Exception as e:
+                app.logger.warning("Field migration failed: %s", e)
+
+
+_migration_runner = None
+_migration_runner_lock = threading.Lock()
+
+
+def get_migration_runner():
+    global _migration_runner
+    if _migration_runner is None or _migration_runner.pid != os.getpid():
+        with _migration_runner_lock:
+            if _migration_runner is None or _migration_runner.pid != os.getpid():
+                _migration_runner = MigrationRunner()
+    return _migration_runner
+
+
+@app.before_request
+def resume_field_migrations():
+    if _migrations_pending:
+        get_migration_runner().wake()
+
+
+# ====================================================================
+# Schema Migrations
+# ====================================================================
+# The schema version is kept in the schema_version table. Migrations are
+# ordered and idempotent, so a database created before versioning existed
+# simply replays them all. They are applied by "flask --app app migrate-db"
+# or, with SCHEMA_AUTO_MIGRATE, by the first worker to boot while holding the
+# store's schema lock (a file lock next to database.db, or a row on a database
+# server); the other workers wait for it and then find the schema current.
+# A worker booting against a current schema only reads its version. Append
+# new migrations to SCHEMA_MIGRATIONS; never change one that has shipped.
+
+def migrate_core_tables(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS users
+               (
+                   id
+                   INTEGER
+                   PRIMARY
+                   KEY
+                   AUTOINCREMENT,
+                   username
+                   TEXT
+                   UNIQUE
+                   NOT
+                   NULL,
+                   password
+                   TEXT
+                   NOT
+                   NULL,
+                   is_admin
+                   INTEGER
+                   DEFAULT
+                   0,
+                   is_locked
+                   INTEGER
+                   DEFAULT
+                   0,
+                   expiry_date
+                   TEXT,
+                   post_count
+                   INTEGER
+                   DEFAULT
+                   0,
+                   accepted_count
+                   INTEGER
+                   DEFAULT
+                   0,
+                   last_rating
+                   INTEGER,
+                   UNIQUE
+               (
+                   username
+               )
+                   );
+               ''')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS listings
+               (
+                   id
+                   INTEGER
+                   PRIMARY
+                   KEY
+                   AUTOINCREMENT,
+                   user_id
+                   INTEGER
+                   NOT
+                   NULL,
+                   data
+                   TEXT,
+                   post_date
+                   TEXT
+                   NOT
+                   NULL,
+                   status
+                   TEXT
+                   NOT
+                   NULL
+                   DEFAULT
+                   'open',
+                   FOREIGN
+                   KEY
+               (
+                   user_id
+               ) REFERENCES users
+               (
+                   id
+               )
+                   );
+               ''')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS settings
+               (
+                   id
+                   INTEGER
+                   PRIMARY
+                   KEY
+                   AUTOINCREMENT,
+                   site_name
+                   TEXT
+                   DEFAULT
+                   '通用网站平台',
+                   registration_enabled
+                   INTEGER
+                   DEFAULT
+                   1,
+                   fields_definition
+                   TEXT
+                   DEFAULT
+                   '[]',
+                   version
+                   INTEGER
+                   NOT
+                   NULL
+                   DEFAULT
+                   1,
+                   content_version
+                   INTEGER
+                   NOT
+                   NULL
+                   DEFAULT
+                   1,
+                   content_updated_at
+                   REAL
+               );
+               ''')
+    db.commit()
+
+    cursor = db.cursor()
+    cursor.execute("SELECT id FROM users WHERE username = ?", ('admin',))
+    admin_exists = cursor.fetchone()
+    if not admin_exists:
+        hashed_password = generate_password_hash('admin_password_123', method=app.config['PASSWORD_HASH_METHOD'])
+        db.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)",
+                   ('admin', hashed_password, 1))
+        db.commit()
+        print("Super admin account 'admin' created with password 'admin_password_123'")
+
+    cursor.execute("SELECT id FROM settings")
+    settings_exist = cursor.fetchone()
+    if not settings_exist:
+        db.execute("INSERT INTO settings (site_name, registration_enabled, fields_definition) VALUES (?, ?, ?)",
+                   ('通用网站平台', 1, json.dumps([
+                       {"name": "field_name_1", "label": "字段1", "type": "text", "required": True},
+                       {"name": "field_name_2", "label": "字段2", "type": "number", "required": False},
+                       {"name": "field_name_3", "label": "字段3", "type": "textarea", "required": False}
+                   ])))
+        db.commit()
+
+
+def migrate_cache_versions(db):
+    settings_columns = {row['name'] for row in db.execute('PRAGMA table_info(settings)')}
+    if 'version' not in settings_columns:
+        db.execute('ALTER TABLE settings ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    if 'content_version' not in settings_columns:
+        db.execute('ALTER TABLE settings ADD COLUMN content_version INTEGER NOT NULL DEFAULT 1')
+    if 'content_updated_at' not in settings_columns:
+        db.execute('ALTER TABLE settings ADD COLUMN content_updated_at REAL')
+    if 'rev' not in {row['name'] for row in db.execute('PRAGMA table_info(listings)')}:
+        db.execute('ALTER TABLE listings ADD COLUMN rev INTEGER NOT NULL DEFAULT 0')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_listings_post_date ON listings (post_date, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_listings_status ON listings (status, post_date, id)')
+    db.execute('UPDATE settings SET content_updated_at = ? WHERE content_updated_at IS NULL', (time.time(),))
+    db.commit()
+
+
+def migrate_history(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS history
+               (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   created_at TEXT NOT NULL,
+                   user_id INTEGER,
+                   username TEXT,
+                   action TEXT NOT NULL,
+                   target TEXT,
+                   detail TEXT,
+                   ip TEXT
+               );
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_user ON history (user_id, id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_action ON history (action, id)')
+    db.commit()
+
+
+def migrate_field_columns(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS field_migrations
+               (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   created_at TEXT NOT NULL,
+                   plan TEXT NOT NULL,
+                   max_id INTEGER NOT NULL,
+                   last_id INTEGER NOT NULL DEFAULT 0,
+                   total INTEGER NOT NULL DEFAULT 0,
+                   processed INTEGER NOT NULL DEFAULT 0,
+                   rewritten INTEGER NOT NULL DEFAULT 0,
+                   status TEXT NOT NULL DEFAULT 'pending',
+                   error TEXT,
+                   finished_at TEXT
+               );
+               ''')
+    db.commit()
+    settings = db.execute("SELECT fields_definition FROM settings WHERE id = 1").fetchone()
+    fields = json.loads(settings['fields_definition'])
+    sync_field_columns(db, fields)
+    db.commit()
+    create_field_indexes(db, fields)
+
+
+def migrate_listing_stats(db):
+    if init_listing_stats(db):
+        rebuild_listing_stats(db)
+        print("Listing statistics built.")
+
+
+def migrate_search(db):
+    search_exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'").fetchone()
+    if init_search(db) and not search_exists:
+        fields = json.loads(db.execute("SELECT fields_definition FROM settings WHERE id = 1").fetchone()[0])
+        rebuild_search_index(db, fields)
+        print("Full-text search index built.")
+
+
+def migrate_sessions(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS sessions
+               (
+                   id TEXT PRIMARY KEY,
+                   user_id INTEGER,
+                   data TEXT NOT NULL,
+                   version INTEGER NOT NULL,
+                   expires_at REAL NOT NULL
+               );
+               ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS session_revocations
+               (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   user_id INTEGER NOT NULL,
+                   created_at REAL NOT NULL
+               );
+               ''')
+    db.commit()
+
+
+def migrate_scheduler(db):
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS scheduler_leases
+               (
+                   name TEXT PRIMARY KEY,
+                   owner TEXT NOT NULL,
+                   expires_at REAL NOT NULL
+               );
+               ''')
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS scheduled_jobs
+               (
+                   name TEXT PRIMARY KEY,
+                   last_run REAL NOT NULL,
+                   duration REAL,
+                   status TEXT,
+                   result TEXT
+               );
+               ''')
+    db.commit()
+
+
+def migrate_listing_migration_ids(db):
+    if 'migration_id' not in {row['name'] for row in db.execute('PRAGMA table_info(listings)')}:
+        db.execute('ALTER TABLE listings ADD COLUMN migration_id INTEGER NOT NULL DEFAULT 0')
+    db.commit()
+
+
+SCHEMA_MIGRATIONS = [
+    (1, 'users, listings and settings', migrate_core_tables),
+    (2, 'cache versions and listing indexes', migrate_cache_versions),
+    (3, 'operation history', migrate_history),
+    (4, 'field migrations and typed field columns', migrate_field_columns),
+    (5, 'listing counters and statistics', migrate_listing_stats),
+    (6, 'full-text search', migrate_search),
+    (7, 'server-side sessions', migrate_sessions),
+    (8, 'maintenance scheduler', migrate_scheduler),
+    (9, 'field migration marker on listings', migrate_listing_migration_ids),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+_schema_outdated = False
+
+
+def schema_version(db):
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone() is None:
+        return 0
+    return db.execute('SELECT coalesce(max(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate_schema(db):
+    """Apply pending migrations in order; returns the versions applied."""
+    applied = []
+    with get_store().schema_lock():
+        db.execute('''
+                   CREATE TABLE IF NOT EXISTS schema_version
+                   (
+                       version INTEGER PRIMARY KEY,
+                       description TEXT NOT NULL,
+                       applied_at TEXT NOT NULL
+                   );
+                   ''')
+        db.commit()
+        current = schema_version(db)
+        for version, description, migration in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            migration(db)
+            db.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                       (version, description, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            db.commit()
+            print(f"Schema migration {version} applied: {description}")
+            applied.append(version)
+    return applied
+
+
+def load_schema_state(db):
+    global _migrations_pending, _schema_outdated
+    version = schema_version(db)
+    _schema_outdated = version < SCHEMA_VERSION
+    if _schema_outdated:
+        return version
+    app.config['SEARCH_ENABLED'] = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'").fetchone() is not None
+    _migrations_pending = db.execute("SELECT 1 FROM field_migrations WHERE status != 'done'").fetchone() is not None
+    return version
+
+
+def init_db():
+    with app.app_context():
+        db = get_db()
+        version = load_schema_state(db)
+        if not _schema_outdated:
+            return
+        if app.config['SCHEMA_AUTO_MIGRATE']:
+            migrate_schema(db)
+            load_schema_state(db)
+        else:
+            app.logger.warning("Database schema is at version %s, expected %s; run 'flask --app app migrate-db'.",
+                               version, SCHEMA_VERSION)
+
+
+def schema_outdated():
+    # Only true with SCHEMA_AUTO_MIGRATE off, until migrate-db has run.
+    return _schema_outdated and load_schema_state(get_db()) < SCHEMA_VERSION
+
+
+@app.before_request
+def require_current_schema():
+    # The session interface already refreshed the schema state for this request.
+    if _schema_outdated:
+        return "数据库正在升级，请稍后再试。", 503
+
+
+init_db()
+
+
+# ====================================================================
+# Settings Cache
+# ====================================================================
+# Parsed settings are cached per worker process together with the value of
+# settings.version. Every write to the site settings bumps that version, so
+# a request only has to read one integer to know whether the cached copy is
+# still current, and other gunicorn workers pick up the change on their next
+# request. The cached dict is shared between requests and must not be mutated.
+# The same read returns settings.content_version, which listing writes bump
+# and the page cache keys on, and settings.content_updated_at, the time of the
+# last listing write that the JSON API sends as Last-Modified.
+
+_settings_cache = (None, None)
+_settings_lock = threading.Lock()
+
+
+def load_settings():
+    settings = get_store().load_settings()
+    if not settings:
+        return None
+    settings = dict(settings)
+    del settings['content_version']
+    del settings['content_updated_at']
+    with timed('json'):
+        fields = json.loads(settings['fields_definition'])
+    settings['fields_definition'] = fields
+    settings['fields_to_filter'] = [f for f in fields if f['type'] not in ['textarea', 'file']]
+    settings['sortable_fields'] = {f['name']: f for f in fields if f['type'] != 'file'}
+    settings['file_fields'] = {f['name'] for f in fields if f['type'] == 'file'}
+    settings['search_fields'] = search_field_names(fields)
+    settings['pending_migrations'] = [(row['id'], row['max_id'], json.loads(row['plan']))
+                                      for row in get_store().pending_field_migrations()]
+    settings['migration_id'] = max([row[0] for row in settings['pending_migrations']], default=0)
+    return settings
+
+
+def get_settings():
+    global _settings_cache
+    settings = g.get('_settings')
+    if settings is not None:
+        return settings
+
+    row = get_store().settings_versions()
+    if not row:
+        return None
+    g._content_version = row['content_version']
+    g._content_updated_at = row['content_updated_at']
+
+    version, settings = _settings_cache
+    if version != row['version']:
+        with _settings_lock:
+            version, settings = _settings_cache
+            if version != row['version']:
+                settings = load_settings()
+                _settings_cache = (settings['version'], settings)
+    g._settings = settings
+    return settings
+
+
+def invalidate_settings():
+    global _settings_cache
+    _settings_cache = (None, None)
+    g.pop('_settings', None)
+
+
+# ====================================================================
+# Page Cache
+# ====================================================================
+# Rendered page bodies (everything inside the content block, i.e. without the
+# navigation bar and flashed messages) are cached for index() and
+# view_details(). Keys carry the versions the fragment depends on: the
+# settings version, settings.content_version for listing pages and
+# listings.rev for detail pages. A write that bumps a version therefore
+# invalidates exactly the fragments built from the old data, in every worker.
+
+class PageCache(object):
+    """LRU cache of HTML fragments with a TTL and a memory budget."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.metrics['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.metrics['hits'] += 1
+            return entry[1]
+
+    def set(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, html, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.metrics['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'], app.config['PAGE_CACHE_TTL'])
+
+
+def cache_role():
+    if session.get('is_admin'):
+        return 'admin'
+    if 'user_id' in session:
+        # Edit and delete links depend on who owns a listing.
+        return f"user:{session['user_id']}"
+    return 'anon'
+
+
+def content_version():
+    get_settings()
+    return g._content_version
+
+
+def content_updated_at():
+    get_settings()
+    return g._content_updated_at
+
+
+def bump_content_version(db):
+    db.execute('UPDATE settings SET content_version = content_version + 1, content_updated_at = ? WHERE id = 1',
+               (time.time(),))
+
+
+def cached_fragment(key):
+    html = page_cache.get(key)
+    return None if html is None else [Markup(html)]
+
+
+def render_fragment(key, template_name, **context):
+    # Yields the fragment chunk by chunk so the page can still be streamed,
+    # and stores the joined result once the template has been fully rendered.
+    template = app.jinja_env.get_template(template_name)
+    app.update_template_context(context)
+    chunks = []
+    for chunk in template.generate(context):
+        chunks.append(chunk)
+        yield Markup(chunk)
+    page_cache.set(key, ''.join(chunks))
+
+
+# ====================================================================
+# Server-Side Sessions
+# ====================================================================
+# The session cookie only carries "<session id>.<version>". Session records
+# live in the sessions table and in a per-worker LRU, so reading the session
+# costs no query while the cached version matches the cookie; every write
+# bumps the version, which makes other workers reload it from the database.
+# Revoking a user's sessions deletes their rows and appends to
+# session_revocations; the local worker drops them at once, the others when
+# they poll that table (at most every SESSION_SYNC_INTERVAL seconds).
+# Sessions without a user (flash messages of logged-out visitors) are kept
+# in a signed "c.<data>" cookie instead, so anonymous traffic never writes.
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, version=0):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.expires_at = 0
+        self.modified = False
+        self.rotate = False
+        self.signed = False
+
+    def regenerate(self):
+        """Give the session a new id, e.g. after login, to prevent session fixation."""
+        self.rotate = True
+        self.modified = True
+
+
+class SessionStore(object):
+    """Per-process LRU of session records backed by the sessions table."""
+
+    def __init__(self, maxsize):
+        self.pid = os.getpid()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._by_user = {}
+        self._last_sync = 0
+        self._last_revocation = None
+        self.metrics = {'hits': 0, 'misses': 0, 'revoked': 0}
+
+    def get(self, sid, version):
+        now = time.time()
+        with self._lock:
+            record = self._records.get(sid)
+            if record is not None and record['version'] == version and record['expires_at'] > now:
+                self._records.move_to_end(sid)
+                self.metrics['hits'] += 1
+                return record
+            self.metrics['misses'] += 1
+        row = get_db().execute('SELECT user_id, data, version, expires_at FROM sessions '
+                               'WHERE id = ? AND expires_at > ?', (sid, now)).fetchone()
+        if row is None:
+            self.discard(sid)
+            return None
+        record = {'user_id': row['user_id'], 'data': json.loads(row['data']), 'version': row['version'],
+                  'expires_at': row['expires_at']}
+        self._remember(sid, record)
+        return record
+
+    def put(self, sid, record):
+        self._write('INSERT OR REPLACE INTO sessions (id, user_id, data, version, expires_at) VALUES (?, ?, ?, ?, ?)',
+                    (sid, record['user_id'], json.dumps(record['data']), record['version'], record['expires_at']))
+        self._remember(sid, record)
+
+    def touch(self, sid, expires_at):
+        self._write('UPDATE sessions SET expires_at = ? WHERE id = ?', (expires_at, sid))
+        with self._lock:
+            if sid in self._records:
+                self._records[sid]['expires_at'] = expires_at
+
+    def delete(self, sid):
+        self._write('DELETE FROM sessions WHERE id = ?', (sid,))
+        self.discard(sid)
+
+    def discard(self, sid):
+        with self._lock:
+            record = self._records.pop(sid, None)
+            if record is not None:
+                self._unindex(sid, record)
+
+    def drop_user(self, user_id):
+        with self._lock:
+            for sid in self._by_user.pop(user_id, ()):
+                self._records.pop(sid, None)
+                self.metrics['revoked'] += 1
+
+    def sync(self):
+        """Apply revocations made by other workers since the last call."""
+        if time.monotonic() - self._last_sync < app.config['SESSION_SYNC_INTERVAL']:
+            return
+        self._last_sync = time.monotonic()
+        db = get_db()
+        if self._last_revocation is None:
+            self._last_revocation = db.execute('SELECT coalesce(max(id), 0) FROM session_revocations').fetchone()[0]
+            return
+        for row in db.execute('SELECT id, user_id FROM session_revocations WHERE id > ? ORDER BY id',
+                              (self._last_revocation,)).fetchall():
+            self.drop_user(row['user_id'])
+            self._last_revocation = row['id']
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['cached'] = len(self._records)
+        return stats
+
+    def _write(self, sql, params):
+        # Sessions are saved after the view ran, possibly with its transaction
+        # still open after an error, so they are written on a connection of their own.
+        pool = get_pool()
+        db = pool.acquire()
+        try:
+            db.execute(sql, params)
+            db.commit()
+        finally:
+            pool.release(db)
+
+    def _remember(self, sid, record):
+        with self._lock:
+            old = self._records.pop(sid, None)
+            if old is not None:
+                self._unindex(sid, old)
+            self._records[sid] = record
+            if record['user_id'] is not None:
+                self._by_user.setdefault(record['user_id'], set()).add(sid)
+            while len(self._records) > self.maxsize:
+                old_sid, old = self._records.popitem(last=False)
+                self._unindex(old_sid, old)
+
+    def _unindex(self, sid, record):
+        sids = self._by_user.get(record['user_id'])
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_user[record['user_id']]
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _session_store
+    if _session_store is None or _session_store.pid != os.getpid():
+        with _session_store_lock:
+            if _session_store is None or _session_store.pid != os.getpid():
+                _session_store = SessionStore(app.config['SESSION_CACHE_SIZE'])
+    return _session_store
+
+
+def revoke_user_sessions(db, user_id):
+    """Log the user out everywhere; the caller commits."""
+    db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+    db.execute('INSERT INTO session_revocations (user_id, created_at) VALUES (?, ?)', (user_id, time.time()))
+    get_session_store().drop_user(user_id)
+
+
+class ServerSessionInterface(SessionInterface):
+    signed_cookies = SecureCookieSessionInterface()
+
+    def open_session(self, app, request):
+        if schema_outdated():
+            # The session tables may not exist yet; require_current_schema answers 503.
+            return ServerSession()
+        cookie = request.cookies.get(self.get_cookie_name(app), '')
+        if cookie.startswith('c.'):
+            session = ServerSession()
+            session.signed = True
+            try:
+                session.update(self.signed_cookies.get_signing_serializer(app).loads(
+                    cookie[2:], max_age=int(app.permanent_session_lifetime.total_seconds())))
+            except BadSignature:
+                pass
+            session.modified = False
+            return session
+        store = get_session_store()
+        store.sync()
+        sid, _, version = cookie.partition('.')
+        if not sid or not version.isdigit():
+            return ServerSession()
+        record = store.get(sid, int(version))
+        if record is None:
+            return ServerSession()
+        expiry_date = record['data'].get('expiry_date')
+        if expiry_date and datetime.datetime.now().strftime("%Y-%m-%d") > expiry_date:
+            store.delete(sid)
+            return ServerSession(sid=sid, version=record['version'])
+        session = ServerSession(record['data'], sid, record['version'])
+        session.expires_at = record['expires_at']
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store = get_session_store()
+
+        if not session:
+            if session.sid is not None or session.signed:
+                if session.modified and session.sid is not None:
+                    store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.get('user_id') is None:
+            if session.modified:
+                if session.sid is not None:
+                    store.delete(session.sid)
+                    session.sid = None
+                value = 'c.' + self.signed_cookies.get_signing_serializer(app).dumps(dict(session))
+                response.vary.add('Cookie')
+                response.set_cookie(name, value, expires=self.get_expiration_time(app, session),
+                                    httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                    secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.modified:
+            if session.rotate and session.sid is not None:
+                store.delete(session.sid)
+            if session.sid is None or session.rotate:
+                session.sid = secrets.token_urlsafe(32)
+                session.version = 0
+            session.version += 1
+            store.put(session.sid, {'user_id': session.get('user_id'), 'data': dict(session),
+                                    'version': session.version, 'expires_at': time.time() + lifetime})
+        elif time.time() + lifetime - session.expires_at > app.config['SESSION_REFRESH_INTERVAL']:
+            store.touch(session.sid, time.time() + lifetime)
+        else:
+            return
+
+        response.vary.add('Cookie')
+        response.set_cookie(name, f'{session.sid}.{session.version}', expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+app.session_interface = ServerSessionInterface()
+
+
+# ====================================================================
+# Password Hashing
+# ====================================================================
+# pbkdf2 costs tens of milliseconds of CPU per call, so hashing runs in a
+# small per-worker process pool. At most HASH_MAX_PENDING hashes may be
+# queued or running at once; beyond that the request is turned away instead
+# of piling up behind the pool. HASH_WORKERS = 0 hashes inline. Workers are
+# started by a forkserver (spawned where there is none): forking a worker
+# that already runs the scheduler and other threads could copy a held lock.
+
+class HashPoolBusy(Exception):
+    pass
+
+
+class HashPool(object):
+    def __init__(self, workers, max_pending):
+        self.pid = os.getpid()
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._executor = self._new_executor() if workers else None
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _new_executor(self):
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context(method))
+
+    def _replace_executor(self, executor):
+        # A crashed worker breaks the whole executor. Its manager thread has
+        # already failed the pending futures, terminated the other workers and
+        # closed the queues; calling shutdown() on top of that closes a result
+        # pipe a second time, possibly one now reused by the new executor.
+        with self._lock:
+            if self._executor is executor:
+                self._executor = self._new_executor()
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolBusy()
+        executor = self._executor
+        with timed('hash'):
+            if executor is None:
+                try:
+                    return func(*args)
+                finally:
+                    self._slots.release()
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                self._slots.release()
+                self._replace_executor(executor)
+                return func(*args)
+            # The slot is only freed once the worker is done, even if the request stops waiting.
+            future.add_done_callback(lambda f: self._slots.release())
+            try:
+                return future.result(timeout=app.config['HASH_TIMEOUT'])
+            except FutureTimeoutError:
+                raise HashPoolBusy()
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                return func(*args)
+
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def get_hash_pool():
+    global _hash_pool
+    if _hash_pool is None or _hash_pool.pid != os.getpid():
+        with _hash_pool_lock:
+            if _hash_pool is None or _hash_pool.pid != os.getpid():
+                _hash_pool = HashPool(app.config['HASH_WORKERS'], app.config['HASH_MAX_PENDING'])
+    return _hash_pool
+
+
+def hash_password(password):
+    return get_hash_pool().run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pwhash, password):
+    return get_hash_pool().run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
+
+
+class RateLimiter(object):
+    """Token buckets allowing ``burst`` attempts per key, refilled one every ``interval`` seconds."""
+
+    def __init__(self, burst, interval, max_keys=10000):
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) / self.interval)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        full_after = self.burst * self.interval
+        for key, (tokens, last) in list(self._buckets.items()):
+            if now - last >= full_after:
+                del self._buckets[key]
+
+
+login_user_limiter = RateLimiter(*app.config['LOGIN_RATE_PER_USER'])
+login_ip_limiter = RateLimiter(*app.config['LOGIN_RATE_PER_IP'])
+
+
+# ====================================================================
+# Upload Storage
+# ====================================================================
+# Uploads are streamed to a temporary file while being hashed and then
+# stored as <sha256>.<ext>, so identical files are kept only once. Image
+# thumbnails are produced by a background thread (when Pillow is installed)
+# and the listing table shows them instead of the originals.
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def store_upload(file):
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        filename = f"{digest.hexdigest()}.{ext}"
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(filepath):
+            os.remove(tmp_path)
+            # Restarts the upload GC grace period for a file that may have been unreferenced.
+            os.utime(filepath)
+        else:
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    get_thumbnailer().submit(filename)
+    return filename
+
+
+def make_thumbnail(filename):
+    src = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    dst = os.path.join(app.config['THUMBNAIL_FOLDER'], filename)
+    if os.path.exists(dst) or not os.path.exists(src):
+        return
+    with Image.open(src) as image:
+        image_format = image.format
+        image.thumbnail(app.config['THUMBNAIL_SIZE'])
+        tmp_path = f"{dst}.{os.getpid()}.tmp"
+        image.save(tmp_path, format=image_format)
+    os.replace(tmp_path, dst)
+
+
+class Thumbnailer(object):
+    """Single background thread that generates thumbnails from a bounded queue.
+
+    Submissions are dropped when the queue is full; the page then keeps showing
+    the original and resubmits the file the next time it is rendered.
+    """
+
+    def __init__(self, maxsize=256):
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='thumbnailer', daemon=True)
+        self._thread.start()
+
+    def submit(self, filename):
+        if Image is None:
+            return
+        with self._lock:
+            if filename in self._pending:
+                return
+            try:
+                self._queue.put_nowait(filename)
+            except queue.Full:
+                return
+            self._pending.add(filename)
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            try:
+                make_thumbnail(filename)
+            except Exception as e:
+                app.logger.warning("Thumbnail for %s failed: %s", filename, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(filename)
+
+
+_thumbnailer = None
+_thumbnailer_lock = threading.Lock()
+
+
+def get_thumbnailer():
+    global _thumbnailer
+    if _thumbnailer is None or _thumbnailer.pid != os.getpid():
+        with _thumbnailer_lock:
+            if _thumbnailer is None or _thumbnailer.pid != os.getpid():
+                _thumbnailer = Thumbnailer()
+    return _thumbnailer
+
+
+CONTENT_ADDRESSED_NAME = re.compile(r'^([0-9a-f]{64})\.[a-z0-9]+$')
+
+
+def send_upload(folder, filename):
+    # Content-addressed names never change content, so they get a strong ETag
+    # taken from the name and may be cached forever. Older timestamped names
+    # fall back to Werkzeug's mtime/size ETag and a short max-age.
+    match = CONTENT_ADDRESSED_NAME.match(filename)
+    etag = match.group(1) if match else True
+    if folder == app.config['THUMBNAIL_FOLDER'] and match:
+        width, height = app.config['THUMBNAIL_SIZE']
+        etag = f"{match.group(1)}-{width}x{height}"
+    max_age = app.config['UPLOAD_IMMUTABLE_MAX_AGE'] if match else app.config['UPLOAD_MAX_AGE']
+
+    offload = app.config['UPLOAD_OFFLOAD']
+    if not offload:
+        response = send_from_directory(folder, filename, etag=etag, max_age=max_age)
+    else:
+        path = safe_join(folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if offload == 'x-accel':
+            relative = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_PREFIX'] + relative
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        if isinstance(etag, str):
+            response.set_etag(etag)
+        response.cache_control.max_age = max_age
+        response = response.make_conditional(request)
+
+    response.cache_control.public = True
+    if match:
+        response.cache_control.immutable = True
+    return response
+
+
+@app.template_global()
+def thumbnail_url(filename):
+    if Image is not None:
+        if os.path.exists(os.path.join(app.config['THUMBNAIL_FOLDER'], filename)):
+            return url_for('uploaded_thumbnail', filename=filename)
+        get_thumbnailer().submit(filename)
+    return url_for('uploaded_file', filename=filename)
+
+
+# ====================================================================
+# Operation History
+# ====================================================================
+# Key actions are queued in memory and written to the history table by one
+# background thread per worker, in batched transactions, so a request never
+# waits for a history INSERT and commit. When the queue is full record_history()
+# waits at most HISTORY_PUT_TIMEOUT and then drops the event; drops are counted
+# in /admin/metrics. Events are therefore visible in /history with a delay of
+# up to HISTORY_FLUSH_INTERVAL.
+
+HISTORY_ACTIONS = OrderedDict([
+    ('login', '登录'),
+    ('login_failed', '登录失败'),
+    ('register', '注册'),
+    ('post_demand', '发布内容'),
+    ('edit_demand', '编辑内容'),
+    ('delete_demand', '删除内容'),
+    ('set_site_name', '修改网站名称'),
+    ('toggle_registration', '切换注册功能'),
+    ('toggle_lock', '锁定/解锁用户'),
+    ('set_expiry', '设置有效期'),
+    ('delete_user', '删除用户'),
+    ('update_fields', '更新动态字段'),
+    ('import_listings', '批量导入'),
+    ('set_status', '修改状态'),
+    ('bulk_status', '批量修改状态'),
+    ('lock_expired', '锁定过期账号'),
+])
+
+
+class HistoryWriter(object):
+    """Background writer that flushes queued history events in batches."""
+
+    def __init__(self, maxsize, batch_size, flush_interval):
+        self.pid = os.getpid()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self.metrics = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def submit(self, event, timeout):
+        try:
+            self._queue.put(event, timeout=timeout)
+        except queue.Full:
+            self.count('dropped')
+            return False
+        self.count('queued')
+        return True
+
+    def flush(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        pool = get_pool()
+        db = pool.acquire()
+        try:
+            db.executemany('INSERT INTO history (created_at, user_id, username, action, target, detail, ip) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            db.commit()
+        finally:
+            pool.release(db)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+                self.count('written', len(batch))
+                self.count('batches')
+            except Exception as e:
+                self.count('failed', len(batch))
+                app.logger.warning("Writing %d history events failed: %s", len(batch), e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+_history_writer = None
+_history_writer_lock = threading.Lock()
+
+
+def get_history_writer():
+    global _history_writer
+    if _history_writer is None or _history_writer.pid != os.getpid():
+        with _history_writer_lock:
+            if _history_writer is None or _history_writer.pid != os.getpid():
+                _history_writer = HistoryWriter(app.config['HISTORY_QUEUE_SIZE'], app.config['HISTORY_BATCH_SIZE'],
+                                                app.config['HISTORY_FLUSH_INTERVAL'])
+    return _history_writer
+
+
+@atexit.register
+def flush_history():
+    if _history_writer is not None and _history_writer.pid == os.getpid():
+        _history_writer.flush(5)
+
+
+def record_history(action, target=None, detail=None, user_id=None, username=None):
+    if username is None:
+        user_id = session.get('user_id')
+        username = session.get('username')
+    event = (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id, username, action, target,
+             detail, request.remote_addr if has_request_context() else None)
+    return get_history_writer().submit(event, app.config['HISTORY_PUT_TIMEOUT'])
+
+
+# ====================================================================
+# Scheduled Maintenance
+# ====================================================================
+# Every worker runs a scheduler thread, but only the one holding the
+# 'scheduler' row in scheduler_leases runs jobs; the lease is renewed on
+# every tick and taken over by another worker once it expires. Last runs are
+# kept in scheduled_jobs, so job intervals hold across workers and restarts.
+# Off-peak jobs only start inside MAINTENANCE_HOURS.
+
+def acquire_lease(db, name, owner, seconds):
+    now = time.time()
+    cursor = db.execute('INSERT INTO scheduler_leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                        'WHERE owner = excluded.owner OR expires_at < ?', (name, owner, now + seconds, now))
+    db.commit()
+    return cursor.rowcount == 1
+
+
+def lock_expired_users(db):
+    today = datetime.datetime.now().strftime("%Y-%m-%d")
+    users = db.execute("SELECT id, username, expiry_date FROM users WHERE is_locked = 0 AND is_admin = 0 "
+                       "AND expiry_date IS NOT NULL AND expiry_date != '' AND expiry_date < ?", (today,)).fetchall()
+    for user in users:
+        db.execute('UPDATE users SET is_locked = 1 WHERE id = ?', (user['id'],))
+        revoke_user_sessions(db, user['id'])
+    db.commit()
+    for user in users:
+        record_history('lock_expired', f"user:{user['id']}", user['expiry_date'], username='system')
+    return f"locked {len(users)} users"
+
+
+def purge_sessions(db):
+    now = time.time()
+    sessions = db.execute('DELETE FROM sessions WHERE expires_at < ?', (now,)).rowcount
+    revocations = db.execute('DELETE FROM session_revocations WHERE created_at < ?',
+                             (now - app.config['SESSION_REVOCATION_KEEP'],)).rowcount
+    db.commit()
+    return f"purged {sessions} sessions, {revocations} revocations"
+
+
+def old_files(folder, cutoff):
+    with os.scandir(folder) as entries:
+        return {entry.name for entry in entries if entry.is_file() and entry.stat().st_mtime < cutoff}
+
+
+def remove_old_file(path, cutoff):
+    # Checked again right before removal: store_upload() touches a file it
+    # deduplicated against, so a file picked up by a new listing is kept.
+    try:
+        stat = os.stat(path)
+        if stat.st_mtime >= cutoff:
+            return 0
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return stat.st_size
+
+
+def gc_uploads(db):
+    """Remove uploads (and their thumbnails) that no listing refers to any more."""
+    if db.execute("SELECT 1 FROM field_migrations WHERE status != 'done'").fetchone():
+        return "skipped, field migration pending"
+    cutoff = time.time() - app.config['UPLOAD_GC_GRACE']
+    upload_folder, thumb_folder = app.config['UPLOAD_FOLDER'], app.config['THUMBNAIL_FOLDER']
+    orphans = old_files(upload_folder, cutoff)
+    if orphans:
+        # Any string value may name a file: fields can be renamed or retyped.
+        for row in db.execute("SELECT j.value FROM listings, json_each(listings.data) AS j WHERE j.type = 'text'"):
+            orphans.discard(row[0])
+    removed = freed = 0
+    for name in orphans:
+        size = remove_old_file(os.path.join(upload_folder, name), cutoff)
+        if size:
+            removed += 1
+            freed += size
+    if os.path.isdir(thumb_folder):
+        for name in old_files(thumb_folder, cutoff):
+            if not os.path.exists(os.path.join(upload_folder, name)):
+                freed += remove_old_file(os.path.join(thumb_folder, name), cutoff)
+    return f"removed {removed} files, {freed} bytes"
+
+
+def optimize_db(db):
+    db.execute(f"PRAGMA analysis_limit = {int(app.config['MAINTENANCE_ANALYSIS_LIMIT'])}")
+    db.execute('PRAGMA optimize')
+    if app.config['SEARCH_ENABLED']:
+        db.execute("INSERT INTO listings_fts (listings_fts) VALUES ('optimize')")
+        db.commit()
+    free_pages = db.execute('PRAGMA freelist_count').fetchone()[0]
+    if free_pages and db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        db.execute(f"PRAGMA incremental_vacuum({int(app.config['MAINTENANCE_VACUUM_PAGES'])})").fetchall()
+    busy, wal_pages, checkpointed = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return f"free pages {free_pages}, wal pages {wal_pages}, checkpointed {checkpointed}, busy {busy}"
+
+
+# name -> (function, interval in seconds, off-peak only)
+SCHEDULED_JOBS = OrderedDict([
+    ('lock_expired_users', (lock_expired_users, 300, False)),
+    ('purge_sessions', (purge_sessions, 3600, False)),
+    ('gc_uploads', (gc_uploads, 20 * 3600, True)),
+    ('optimize_db', (optimize_db, 20 * 3600, True)),
+])
+
+
+def off_peak(now=None):
+    start, end = app.config['MAINTENANCE_HOURS']
+    hour = (now or datetime.datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def run_job(db, name):
+    function = SCHEDULED_JOBS[name][0]
+    started = time.time()
+    try:
+        result, status = function(db), 'ok'
+    except Exception as e:
+        db.rollback()
+        result, status = str(e), 'error'
+        app.logger.warning("Scheduled job %s failed: %s", name, e)
+    db.execute('INSERT INTO scheduled_jobs (name, last_run, duration, status, result) VALUES (?, ?, ?, ?, ?) '
+               'ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run, duration = excluded.duration, '
+               'status = excluded.status, result = excluded.result',
+               (name, started, time.time() - started, status, result))
+    db.commit()
+    return status, result
+
+
+class Scheduler(object):
+    """Background thread that runs due SCHEDULED_JOBS while this worker holds the lease."""
+
+    def __init__(self, interval, lease):
+        self.pid = os.getpid()
+        self.owner = f"{socket.gethostname()}:{self.pid}:{secrets.token_hex(4)}"
+        self.interval = interval
+        self.lease = lease
+        self._lock = threading.Lock()
+        self.metrics = {'ticks': 0, 'leader': 0, 'runs': 0, 'failures': 0}
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def tick(self):
+        pool = get_pool()
+        db = pool.acquire()
+        try:
+            leader = acquire_lease(db, 'scheduler', self.owner, self.lease)
+            with self._lock:
+                self.metrics['ticks'] += 1
+                self.metrics['leader'] = int(leader)
+            if not leader:
+                return
+            now = time.time()
+            last_runs = dict(db.execute('SELECT name, last_run FROM scheduled_jobs').fetchall())
+            for name, (function, interval, off_peak_only) in SCHEDULED_JOBS.items():
+                if now - last_runs.get(name, 0) < interval or (off_peak_only and not off_peak()):
+                    continue
+                if not acquire_lease(db, 'scheduler', self.owner, self.lease):
+                    with self._lock:
+                        self.metrics['leader'] = 0
+                    return
+                status, result = run_job(db, name)
+                with self._lock:
+                    self.metrics['runs' if status == 'ok' else 'failures'] += 1
+        finally:
+            pool.release(db)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval * random.uniform(0.8, 1.2))
+            try:
+                self.tick()
+            except Exception as e:
+                app.logger.warning("Scheduler tick failed: %s", e)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
 
 
-def allowed_file(filename):
-    return '.' in filename and \
-        filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None or _scheduler.pid != os.getpid():
+        with _scheduler_lock:
+            if _scheduler is None or _scheduler.pid != os.getpid():
+                _scheduler = Scheduler(app.config['SCHEDULER_INTERVAL'], app.config['SCHEDULER_LEASE'])
+    return _scheduler
+
+
+@app.before_request
+def start_scheduler():
+    if app.config['SCHEDULER_ENABLED']:
+        get_scheduler()
 
 
 # ====================================================================
-# Database Setup
+# Listing Pagination
 # ====================================================================
 
-DATABASE = 'database.db'
+def encode_cursor(sort_value, listing_id):
+    raw = json.dumps([sort_value, listing_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
 
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-    return db
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_value, listing_id = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    # Anything else would fail to bind as a query parameter.
+    if not isinstance(listing_id, int) or not isinstance(sort_value, (str, int, float, type(None))):
+        return None
+    return sort_value, listing_id
 
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+class ListingPage(object):
+    """One page of listings whose JSON payloads are decoded while the template streams.
 
+    The raw rows are fetched up front (at most ``page_size + 1`` of them, the extra
+    row only tells us whether a next page exists) because the request's database
+    connection goes back to the pool before a streamed response body is consumed.
+    """
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        db.execute('''
-                   CREATE TABLE IF NOT EXISTS users
-                   (
-                       id
-                       INTEGER
-                       PRIMARY
-                       KEY
-                       AUTOINCREMENT,
-                       username
-                       TEXT
-                       UNIQUE
-                       NOT
-                       NULL,
-                       password
-                       TEXT
-                       NOT
-                       NULL,
-                       is_admin
-                       INTEGER
-                       DEFAULT
-                       0,
-                       is_locked
-                       INTEGER
-                       DEFAULT
-                       0,
-                       expiry_date
-                       TEXT,
-                       post_count
-                       INTEGER
-                       DEFAULT
-                       0,
-                       accepted_count
-                       INTEGER
-                       DEFAULT
-                       0,
-                       last_rating
-                       INTEGER,
-                       UNIQUE
-                   (
-                       username
-                   )
-                       );
-                   ''')
-        db.execute('''
-                   CREATE TABLE IF NOT EXISTS listings
-                   (
-                       id
-                       INTEGER
-                       PRIMARY
-                       KEY
-                       AUTOINCREMENT,
-                       user_id
-                       INTEGER
-                       NOT
-                       NULL,
-                       data
-                       TEXT,
-                       post_date
-                       TEXT
-                       NOT
-                       NULL,
-                       status
-                       TEXT
-                       NOT
-                       NULL
-                       DEFAULT
-                       'open',
-                       FOREIGN
-                       KEY
-                   (
-                       user_id
-                   ) REFERENCES users
-                   (
-                       id
-                   )
-                       );
-                   ''')
-        db.execute('''
-                   CREATE TABLE IF NOT EXISTS settings
-                   (
-                       id
-                       INTEGER
-                       PRIMARY
-                       KEY
-                       AUTOINCREMENT,
-                       site_name
-                       TEXT
-                       DEFAULT
-                       '通用网站平台',
-                       registration_enabled
-                       INTEGER
-                       DEFAULT
-                       1,
-                       fields_definition
-                       TEXT
-                       DEFAULT
-                       '[]'
-                   );
-                   ''')
-        db.commit()
+    def __init__(self, rows, page_size, settings):
+        self._rows = rows[:page_size]
+        self._settings = settings
+        self.next_cursor = None
+        if len(rows) > page_size:
+            last = self._rows[-1]
+            self.next_cursor = encode_cursor(last['sort_value'], last['id'])
 
-        cursor = db.cursor()
-        cursor.execute("SELECT id FROM users WHERE username = ?", ('admin',))
-        admin_exists = cursor.fetchone()
-        if not admin_exists:
-            hashed_password = generate_password_hash('admin_password_123', method='pbkdf2:sha256:260000')
-            db.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)",
-                       ('admin', hashed_password, 1))
-            db.commit()
-            print("Super admin account 'admin' created with password 'admin_password_123'")
-
-        cursor.execute("SELECT id FROM settings")
-        settings_exist = cursor.fetchone()
-        if not settings_exist:
-            db.execute("INSERT INTO settings (site_name, registration_enabled, fields_definition) VALUES (?, ?, ?)",
-                       ('通用网站平台', 1, json.dumps([
-                           {"name": "field_name_1", "label": "字段1", "type": "text", "required": True},
-                           {"name": "field_name_2", "label": "字段2", "type": "number", "required": False},
-                           {"name": "field_name_3", "label": "字段3", "type": "textarea", "required": False}
-                       ])))
-            db.commit()
-            print("Site settings initialized with registration enabled and default fields.")
+    def __bool__(self):
+        return bool(self._rows)
+
+    def __iter__(self):
+        profile = current_profile()
+        for row in self._rows:
+            listing = dict(row)
+            if profile is None:
+                listing['data'] = migrate_listing_data(listing, json.loads(listing['data']), self._settings)
+            else:
+                started = time.perf_counter()
+                listing['data'] = migrate_listing_data(listing, json.loads(listing['data']), self._settings)
+                profile.timings['json'] += time.perf_counter() - started
+            yield listing
 
 
-init_db()
+class ListingQuery(object):
+    """Filter, sort and keyset-pagination SQL for a listing request.
+
+    Shared by index() and the JSON API so both interpret ``q``, field filters,
+    ``sort``/``order`` and ``after`` the same way.
+    """
+
+    def __init__(self, settings, args, limit):
+        sortable_fields = settings['sortable_fields']
+        self.sort_by = args.get('sort')
+        if self.sort_by not in sortable_fields:
+            self.sort_by = None
+        self.order = args.get('order', 'desc')
+        if self.order not in ('asc', 'desc'):
+            self.order = 'desc'
+
+        search = ListingSearch()
+        conditions = []
+        params = []
+        self.filter_args = {}
+
+        q = args.get('q', '').strip()
+        if q:
+            self.filter_args['q'] = q
+            for term in q.split()[:SEARCH_MAX_TERMS]:
+                if app.config['SEARCH_ENABLED']:
+                    search.add(term)
+                else:
+                    conditions.append("data LIKE ?")
+                    params.append(f'%{term}%')
+
+        status = args.get('status')
+        if status in LISTING_STATUSES:
+            conditions.append('status = ?')
+            params.append(status)
+            self.filter_args['status'] = status
+
+        for field in settings['fields_to_filter']:
+            if field['type'] in RANGE_FIELD_TYPES:
+                bounds = []
+                for suffix, op in (('_min', '>='), ('_max', '<=')):
+                    raw = args.get(field['name'] + suffix, '').strip()
+                    try:
+                        bound = coerce_form_value(field, raw)
+                    except ValueError:
+                        bound = None
+                    if bound is not None:
+                        bounds.append((op, bound))
+                        self.filter_args[field['name'] + suffix] = raw
+                if bounds and bounds[0][0] == '<=':
+                    # Missing values sort below every real value; a max-only range must skip them.
+                    conditions.append(f"{field_expr(field)} > {field_missing_sql(field)}")
+                for op, bound in bounds:
+                    conditions.append(f"{field_expr(field)} {op} ?")
+                    params.append(bound)
+                continue
+
+            filter_value = args.get(field['name'])
+            if filter_value:
+                if app.config['SEARCH_ENABLED'] and field['type'] in SEARCH_FIELD_TYPES:
+                    search.add(filter_value, field['name'])
+                else:
+                    conditions.append(f"{field_expr(field)} LIKE ?")
+                    params.append(f'%{filter_value}%')
+                self.filter_args[field['name']] = filter_value
+
+        if self.sort_by:
+            sort_expr = field_expr(sortable_fields[self.sort_by])
+        elif search.score_expr:
+            sort_expr = search.score_expr
+            self.order = 'asc'
+        else:
+            sort_expr = 'post_date'
+            self.order = 'desc'
+
+        after = args.get('after')
+        self.cursor_key = decode_cursor(after) if after else None
+        self.after = after if self.cursor_key else None
+        if self.cursor_key:
+            conditions.append(f"({sort_expr}, id) {'>' if self.order == 'asc' else '<'} (?, ?)")
+            params.extend(self.cursor_key)
+
+        order = self.order.upper()
+        self.sql = f"SELECT id, user_id, data, post_date, status, migration_id, {sort_expr} AS sort_value FROM listings"
+        self.sql += ''.join(' ' + join for join in search.joins)
+        self.sql += " WHERE 1=1" + ''.join(' AND ' + c for c in search.conditions + conditions)
+        self.sql += f" ORDER BY {sort_expr} {order}, id {order} LIMIT ?"
+        self.params = search.join_params + search.params + params + [limit + 1]
 
 
 # ====================================================================
-# HTML Templates
+# JSON API
 # ====================================================================
+# Read-only endpoints under /api share ListingQuery with index(). Responses
+# carry a weak ETag derived from the versions they depend on (the same ones
+# the page cache keys on) plus Last-Modified, so a conditional request is
+# answered with 304 before any listing is read. Bodies are compact JSON,
+# compressed with brotli (when installed) or gzip if the client accepts it.
+
+def api_etag(*key):
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=12).hexdigest()
+
+
+def api_not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        modified = not request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        modified = request.if_modified_since.timestamp() < int(last_modified)
+    else:
+        return None
+    if modified:
+        return None
+    response = app.response_class(status=304)
+    api_validators(response, etag, last_modified)
+    return response
+
+
+def api_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+
+
+def api_response(body, etag=None, last_modified=None, status=200):
+    if not isinstance(body, str):
+        body = json.dumps(body, ensure_ascii=False, separators=(',', ':'))
+    data = body.encode('utf-8')
+    encoding = None
+    if len(data) >= app.config['API_COMPRESS_MIN_SIZE']:
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            data, encoding = brotli.compress(data, quality=5), 'br'
+        elif accepted['gzip']:
+            data, encoding = gzip.compress(data, compresslevel=6), 'gzip'
+    response = app.response_class(data, status=status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        api_validators(response, etag, last_modified)
+    return response
+
+
+def api_error(status, message):
+    return api_response({'error': message}, status=status)
 
-def get_settings():
-    db = get_db()
-    settings = db.execute('SELECT * FROM settings WHERE id = 1').fetchone()
-    if settings:
-        settings = dict(settings)
-        settings['fields_definition'] = json.loads(settings['fields_definition'])
-    return settings
+
+def api_listing(listing, projection):
+    data = listing['data'] or {}
+    return {'id': listing['id'], 'user_id': listing['user_id'], 'post_date': listing['post_date'],
+            'status': listing['status'], 'data': {name: data.get(name) for name in projection}}
+
+
+def api_projection(settings):
+    names = [f['name'] for f in settings['fields_definition']]
+    requested = request.args.get('fields')
+    if not requested:
+        return names
+    projection = [name for name in requested.split(',') if name]
+    unknown = [name for name in projection if name not in names]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return projection
 
 
 # ====================================================================
-# Flask Routes
+# Bulk Import/Export
 # ====================================================================
+# Listings are exported and imported as JSONL ({"id", "user_id", "post_date",
+# "status", "data": {...}} per line) or CSV (id, user_id, post_date, status and
+# one column per dynamic field). Both directions stream: export reads the table
+# in keyset batches, import validates rows as they are parsed and inserts them
+# with executemany, one transaction per IMPORT_BATCH_SIZE rows. Imported rows
+# always get new ids.
 
-@app.route('/')
-def index():
-    db = get_db()
-    settings = get_settings()
+EXPORT_FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+LISTING_COLUMNS = ['id', 'user_id', 'post_date', 'status']
 
-    fields_definition = settings['fields_definition']
-    fields_to_display = [f for f in fields_definition]
-    fields_to_filter = [f for f in fields_to_display if f['type'] not in ['textarea', 'file']]
 
-    query = "SELECT id, user_id, data, post_date, status FROM listings WHERE 1=1"
-    params = []
+def export_format_for(filename, default='jsonl'):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return ext if ext in EXPORT_FORMATS else default
 
-    for field in fields_to_filter:
-        filter_value = request.args.get(field['name'])
-        if filter_value:
-            query += f" AND json_extract(data, '$.{field['name']}') LIKE ?"
-            params.append(f'%{filter_value}%')
 
-    sort_by = request.args.get('sort')
-    order = request.args.get('order', 'desc')
+def export_listings(fmt, settings):
+    """Yield the listings table as JSONL or CSV text chunks."""
+    names = [f['name'] for f in settings['fields_definition']]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(LISTING_COLUMNS + names)
+    for rows in get_store().scan_listings(app.config['EXPORT_BATCH_SIZE']):
+        for row in rows:
+            if fmt == 'csv':
+                data = migrate_listing_data(row, json.loads(row['data']) if row['data'] else {}, settings)
+                writer.writerow([row['id'], row['user_id'], row['post_date'], row['status']] +
+                                [data.get(name) for name in names])
+            else:
+                # data is already JSON text, so it is spliced in without decoding it
+                # unless a field migration still has to be applied to it.
+                data = row['data']
+                if settings['pending_migrations']:
+                    data = json.dumps(migrate_listing_data(row, json.loads(data) if data else {}, settings))
+                buffer.write(f'{{"id": {row["id"]}, "user_id": {row["user_id"]}, '
+                             f'"post_date": {json.dumps(row["post_date"])}, '
+                             f'"status": {json.dumps(row["status"])}, "data": {data or "null"}}}\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
 
-    if sort_by:
-        query += f" ORDER BY json_extract(data, '$.{sort_by}') {order.upper()}"
-    else:
-        query += " ORDER BY post_date DESC"
 
-    listings = db.execute(query, params).fetchall()
+def read_import_rows(stream, fmt):
+    """Yield (line number, row dict) from a binary JSONL or CSV stream."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_no, ValueError(f"JSON 格式错误：{e}")
+            continue
+        yield line_no, row if isinstance(row, dict) else ValueError("每行必须是一个 JSON 对象")
+
+
+def validate_import_row(row, fields, user_ids, default_user_id, now):
+    """Return (listing_data, insert params without id) or raise ValueError."""
+    if isinstance(row, Exception):
+        raise row
+    data = row.get('data')
+    if data is None:
+        data = {k: v for k, v in row.items() if k not in LISTING_COLUMNS}
+    elif not isinstance(data, dict):
+        raise ValueError("data 必须是 JSON 对象")
+    field_names = {f['name'] for f in fields}
+    unknown = [k for k in data if k not in field_names]
+    if unknown:
+        raise ValueError(f"未知字段：{', '.join(map(str, unknown))}")
+
+    listing_data = {}
+    for field in fields:
+        value = data.get(field['name'])
+        if value == '':
+            value = None
+        if value is None:
+            if field['required']:
+                raise ValueError(f"字段 '{field['label']}' 是必填的")
+        elif field['type'] in RANGE_FIELD_TYPES:
+            value = coerce_form_value(field, value)
+        elif field['type'] == 'file':
+            if not isinstance(value, str) or os.path.basename(value) != value:
+                raise ValueError(f"字段 '{field['label']}' 的文件名无效")
+        elif not isinstance(value, str):
+            value = str(value)
+        listing_data[field['name']] = value
+
+    user_id = row.get('user_id') or default_user_id
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        raise ValueError("user_id 必须是整数")
+    if user_id not in user_ids:
+        raise ValueError(f"用户 {user_id} 不存在")
 
-    listings_processed = []
-    for listing in listings:
-        listing = dict(listing)
-        listing['data'] = json.loads(listing['data'])
-        listings_processed.append(listing)
+    post_date = row.get('post_date') or now
+    try:
+        datetime.datetime.strptime(post_date, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        raise ValueError("post_date 格式应为 YYYY-MM-DD HH:MM:SS")
 
-    return render_template('index.html',
-                           listings=listings_processed,
-                           fields_to_display=fields_to_display,
-                           fields_to_filter=fields_to_filter,
-                           settings=settings
-                           )
+    status = row.get('status') or 'open'
+    if status not in LISTING_STATUSES:
+        raise ValueError(f"无效状态：{status}")
+    return listing_data, (user_id, json.dumps(listing_data), post_date, status)
+
+
+def import_listings(rows, settings, default_user_id):
+    """Validate and insert (line number, row) pairs; return (imported, rejected, errors)."""
+    store = get_store()
+    fields = settings['fields_definition']
+    user_ids = store.user_ids()
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    imported = rejected = 0
+    errors = []
+    batch = []
+    for line_no, row in rows:
+        try:
+            batch.append(validate_import_row(row, fields, user_ids, default_user_id, now))
+        except ValueError as e:
+            rejected += 1
+            if len(errors) < app.config['IMPORT_MAX_ERRORS']:
+                errors.append(f"第 {line_no} 行：{e}")
+            continue
+        if len(batch) >= batch_size:
+            store.insert_listings(batch, settings['search_fields'])
+            imported += len(batch)
+            batch = []
+    if batch:
+        store.insert_listings(batch, settings['search_fields'])
+        imported += len(batch)
+    return imported, rejected, errors
+
+
+# ====================================================================
+# Flask Routes
+# ====================================================================
+
+@app.route('/')
+def index():
+    settings = get_settings()
+    listing_query = ListingQuery(settings, request.args, app.config['PAGE_SIZE'])
+
+    cache_key = ('index', settings['version'], content_version(), cache_role(),
+                 tuple(sorted(listing_query.filter_args.items())), listing_query.sort_by, listing_query.order,
+                 listing_query.after)
+    content = cached_fragment(cache_key)
+    if content is None:
+        listings = ListingPage(get_store().page_listings(listing_query), app.config['PAGE_SIZE'], settings)
+        content = render_fragment(cache_key, '_index_content.html',
+                                  listings=listings,
+                                  fields_to_display=settings['fields_definition'],
+                                  fields_to_filter=settings['fields_to_filter'],
+                                  filter_args=listing_query.filter_args,
+                                  sort_by=listing_query.sort_by,
+                                  order=listing_query.order,
+                                  is_first_page=listing_query.cursor_key is None,
+                                  settings=settings
+                                  )
+
+    # Pop flashed messages now: the session cookie is sent before a streamed body is rendered.
+    get_flashed_messages(with_categories=True)
+    return stream_template('index.html', content=content, settings=settings)
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
-    db = get_db()
+    store = get_store()
     settings = get_settings()
     if not settings or not settings['registration_enabled']:
         flash("注册功能已关闭。", "error")
@@ -248,23 +3302,28 @@ def register():
         username = request.form['username']
         password = request.form['password']
 
-        cursor = db.cursor()
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user_exists = cursor.fetchone()
+        if not login_ip_limiter.allow(request.remote_addr):
+            flash("操作过于频繁，请稍后再试。", "error")
+            return redirect(url_for('register'))
 
-        if user_exists:
+        if store.find_user(username):
             flash("该用户名已被占用，请尝试其他用户名。", "error")
             return redirect(url_for('register'))
 
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256:260000')
+        try:
+            hashed_password = hash_password(password)
+        except HashPoolBusy:
+            flash("服务器繁忙，请稍后再试。", "error")
+            return redirect(url_for('register'))
 
         try:
-            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-            db.commit()
+            user_id = store.create_user(username, hashed_password)
+            store.commit()
+            record_history('register', f'user:{user_id}', user_id=user_id, username=username)
             flash("注册成功！请登录。", "success")
             return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
-            flash("注册失败，请稍后重试。", "error")
+        except DuplicateError:
+            flash("该用户名已被占用，请尝试其他用户名。", "error")
             return redirect(url_for('register'))
 
     return render_template('register.html', settings=settings)
@@ -277,26 +3336,47 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        db = get_db()
-        cursor = db.cursor()
+        if not login_user_limiter.allow(username) or not login_ip_limiter.allow(request.remote_addr):
+            flash("登录尝试过于频繁，请稍后再试。", "error")
+            return redirect(url_for('login'))
+
+        store = get_store()
+        user = store.find_user(username)
 
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        try:
+            password_ok = user is not None and verify_password(user['password'], password)
+        except HashPoolBusy:
+            flash("服务器繁忙，请稍后再试。", "error")
+            return redirect(url_for('login'))
 
-        if user and check_password_hash(user['password'], password):
+        if password_ok:
             if user['is_locked']:
+                record_history('login_failed', detail='账号已锁定', user_id=user['id'], username=username)
                 flash("您的账号已被锁定，请联系管理员。", "error")
                 return redirect(url_for('login'))
             if user['expiry_date'] and datetime.datetime.now().strftime("%Y-%m-%d") > user['expiry_date']:
+                record_history('login_failed', detail='账号已过期', user_id=user['id'], username=username)
                 flash("您的账号已过期，请联系管理员。", "error")
                 return redirect(url_for('login'))
 
+            if needs_rehash(user['password']):
+                try:
+                    store.update_user(user['id'], password=hash_password(password))
+                    store.commit()
+                except HashPoolBusy:
+                    pass
+
+            session.regenerate()
             session['username'] = user['username']
             session['user_id'] = user['id']
             session['is_admin'] = bool(user['is_admin'])
+            session['expiry_date'] = user['expiry_date']
+            record_history('login')
 
             return redirect(url_for('index'))
         else:
+            record_history('login_failed', detail='用户名或密码不正确', user_id=user['id'] if user else None,
+                           username=username)
             flash("用户名或密码不正确。", "error")
             return redirect(url_for('login'))
 
@@ -308,6 +3388,7 @@ def logout():
     session.pop('username', None)
     session.pop('user_id', None)
     session.pop('is_admin', None)
+    session.pop('expiry_date', None)
     return redirect(url_for('login'))
 
 
@@ -331,19 +3412,19 @@ def post_demand():
                     flash(f"字段 '{field['label']}' 是必填的。", "error")
                     return redirect(url_for('post_demand'))
                 if file and allowed_file(file.filename):
-                    filename = f"{user_id}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{secure_filename(file.filename)}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
-                    listing_data[field['name']] = filename
+                    listing_data[field['name']] = store_upload(file)
                 else:
                     listing_data[field['name']] = None
             else:
-                listing_data[field['name']] = request.form.get(field['name'])
+                try:
+                    listing_data[field['name']] = coerce_form_value(field, request.form.get(field['name']))
+                except ValueError as e:
+                    flash(f"{e}。", "error")
+                    return redirect(url_for('post_demand'))
 
-        db = get_db()
-        db.execute('INSERT INTO listings (user_id, data, post_date) VALUES (?, ?, ?)',
-                   (user_id, json.dumps(listing_data), post_date))
-        db.commit()
+        with get_store().batch() as store:
+            listing_id = store.insert_listing(user_id, listing_data, post_date, settings['search_fields'])
+        record_history('post_demand', f'listing:{listing_id}')
 
         flash("发布成功！", "success")
         return redirect(url_for('index'))
@@ -357,8 +3438,8 @@ def edit_demand(demand_id):
         flash("请先登录。", "error")
         return redirect(url_for('login'))
 
-    db = get_db()
-    demand = db.execute('SELECT * FROM listings WHERE id = ?', (demand_id,)).fetchone()
+    store = get_store()
+    demand = store.get_listing(demand_id)
 
     if not demand:
         flash("内容不存在。", "error")
@@ -374,7 +3455,8 @@ def edit_demand(demand_id):
 
     settings = get_settings()
     fields = settings['fields_definition']
-    demand_data = json.loads(demand['data'])
+    with timed('json'):
+        demand_data = migrate_listing_data(demand, json.loads(demand['data']), settings)
 
     if request.method == 'POST':
         listing_data = {}
@@ -382,18 +3464,19 @@ def edit_demand(demand_id):
             if field['type'] == 'file':
                 file = request.files.get(field['name'])
                 if file and allowed_file(file.filename):
-                    filename = f"{demand_id}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{secure_filename(file.filename)}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
-                    listing_data[field['name']] = filename
+                    listing_data[field['name']] = store_upload(file)
                 else:
                     listing_data[field['name']] = demand_data.get(field['name'])
             else:
-                listing_data[field['name']] = request.form.get(field['name'])
+                try:
+                    listing_data[field['name']] = coerce_form_value(field, request.form.get(field['name']))
+                except ValueError as e:
+                    flash(f"{e}。", "error")
+                    return redirect(url_for('edit_demand', demand_id=demand_id))
 
-        db.execute('UPDATE listings SET data = ? WHERE id = ?',
-                   (json.dumps(listing_data), demand_id))
-        db.commit()
+        with store.batch():
+            store.update_listing(demand_id, listing_data, settings['search_fields'], settings['migration_id'])
+        record_history('edit_demand', f'listing:{demand_id}')
         flash("内容更新成功！", "success")
         return redirect(url_for('index'))
 
@@ -406,8 +3489,8 @@ def delete_demand(demand_id):
         flash("请先登录。", "error")
         return redirect(url_for('login'))
 
-    db = get_db()
-    demand = db.execute('SELECT * FROM listings WHERE id = ?', (demand_id,)).fetchone()
+    store = get_store()
+    demand = store.get_listing(demand_id)
 
     if not demand:
         flash("内容不存在。", "error")
@@ -421,33 +3504,263 @@ def delete_demand(demand_id):
         flash("此内容已被接受，无法删除。", "error")
         return redirect(url_for('index'))
 
-    db.execute('DELETE FROM listings WHERE id = ?', (demand_id,))
-    db.commit()
+    with store.batch():
+        store.delete_listing(demand_id)
+    record_history('delete_demand', f'listing:{demand_id}')
     flash("内容删除成功！", "success")
     return redirect(url_for('index'))
 
 
+@app.route('/set_status/<int:demand_id>', methods=['POST'])
+def set_status(demand_id):
+    if 'username' not in session:
+        flash("请先登录。", "error")
+        return redirect(url_for('login'))
+
+    status = request.form.get('status')
+    store = get_store()
+    demand = store.get_listing(demand_id)
+    if not demand:
+        flash("内容不存在。", "error")
+        return redirect(url_for('index'))
+    if status not in STATUS_TRANSITIONS or demand['status'] not in STATUS_TRANSITIONS[status][0]:
+        flash("无法变更为该状态。", "error")
+        return redirect(url_for('view_details', demand_id=demand_id))
+
+    owner_allowed = STATUS_TRANSITIONS[status][1] and demand['user_id'] == session.get('user_id')
+    if not session.get('is_admin') and not owner_allowed:
+        flash("您无权修改此内容的状态。", "error")
+        return redirect(url_for('view_details', demand_id=demand_id))
+
+    with store.batch():
+        changed = store.set_listing_status([demand_id], status, (demand['status'],))
+    if not changed:
+        # The listing was changed or deleted since it was read above.
+        flash("无法变更为该状态。", "error")
+        return redirect(url_for('view_details', demand_id=demand_id))
+    record_history('set_status', f'listing:{demand_id}', f"{demand['status']} -> {status}")
+    flash(f"状态已更新为“{LISTING_STATUSES[status]}”。", "success")
+    return redirect(url_for('view_details', demand_id=demand_id))
+
+
+@app.route('/admin/bulk_status', methods=['POST'])
+def bulk_status():
+    if not session.get('is_admin'):
+        flash("您无权执行此操作。", "error")
+        return redirect(url_for('index'))
+
+    status = request.form.get('status')
+    demand_ids = list(dict.fromkeys(request.form.getlist('demand_ids', type=int)))
+    if status not in STATUS_TRANSITIONS or not demand_ids:
+        flash("请选择内容和目标状态。", "error")
+        return redirect(listing_referrer())
+
+    # Same transitions as /set_status: listings in any other status are skipped.
+    with get_store().batch() as store:
+        changed = store.set_listing_status(demand_ids, status, STATUS_TRANSITIONS[status][0])
+    record_history('bulk_status', detail=f"{changed} 条 -> {status}")
+    message = f"已将 {changed} 条内容的状态更新为“{LISTING_STATUSES[status]}”。"
+    if changed < len(demand_ids):
+        message += f"{len(demand_ids) - changed} 条内容的当前状态无法变更为该状态，已跳过。"
+    flash(message, "success")
+    return redirect(listing_referrer())
+
+
+def listing_referrer():
+    # Back to the filtered listing page the form was posted from, but never off-site.
+    referrer = request.referrer
+    if referrer and referrer.startswith(request.host_url):
+        return referrer
+    return url_for('index')
+
+
 @app.route('/view_details/<int:demand_id>')
 def view_details(demand_id):
-    db = get_db()
-    demand = db.execute('SELECT * FROM listings WHERE id = ?', (demand_id,)).fetchone()
+    demand = get_store().get_listing(demand_id, replica=True)
 
     if not demand:
         flash("内容不存在。", "error")
         return redirect(url_for('index'))
 
-    demand_data = json.loads(demand['data'])
     settings = get_settings()
-    fields = settings['fields_definition']
+    cache_key = ('view_details', settings['version'], demand_id, demand['rev'], cache_role())
+    content = cached_fragment(cache_key)
+    if content is None:
+        with timed('json'):
+            demand_data = migrate_listing_data(demand, json.loads(demand['data']), settings)
+        content = render_fragment(cache_key, '_view_details_content.html', demand=demand,
+                                  demand_data=demand_data, fields=settings['fields_definition'],
+                                  settings=settings)
+
+    return render_template('view_details.html', content=content, settings=settings)
+
+
+@app.route('/history')
+def history():
+    if 'username' not in session:
+        flash("请先登录。", "error")
+        return redirect(url_for('login'))
+
+    filter_args = {}
+    if session.get('is_admin'):
+        user_filter = request.args.get('user_id', type=int)
+        if user_filter is not None:
+            filter_args['user_id'] = user_filter
+    else:
+        user_filter = session['user_id']
+
+    action = request.args.get('action')
+    if action in HISTORY_ACTIONS:
+        filter_args['action'] = action
+    else:
+        action = None
+
+    before = request.args.get('before', type=int) or None
+
+    page_size = app.config['PAGE_SIZE']
+    entries = get_store().page_history(page_size + 1, user_filter, action, before)
+    next_before = entries[page_size - 1]['id'] if len(entries) > page_size else None
+
+    return render_template('history.html', entries=entries[:page_size], next_before=next_before,
+                           is_first_page=not before, filter_args=filter_args, actions=HISTORY_ACTIONS,
+                           settings=get_settings())
+
+
+@app.route('/api/settings')
+def api_settings():
+    settings = get_settings()
+    etag = api_etag('settings', settings['version'])
+    not_modified = api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    return api_response({'site_name': settings['site_name'],
+                         'registration_enabled': bool(settings['registration_enabled']),
+                         'fields': settings['fields_definition']}, etag)
+
+
+@app.route('/api/listings')
+def api_listings():
+    settings = get_settings()
+    try:
+        projection = api_projection(settings)
+    except ValueError as e:
+        return api_error(400, str(e))
+    limit = min(max(request.args.get('limit', app.config['PAGE_SIZE'], type=int), 1), app.config['API_MAX_LIMIT'])
+    listing_query = ListingQuery(settings, request.args, limit)
+    if request.args.get('after') and listing_query.cursor_key is None:
+        return api_error(400, 'invalid cursor')
+
+    key = ('api_listings', settings['version'], content_version(), tuple(sorted(listing_query.filter_args.items())),
+           listing_query.sort_by, listing_query.order, listing_query.after, tuple(projection), limit)
+    etag = api_etag(*key)
+    last_modified = content_updated_at()
+    not_modified = api_not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    body = page_cache.get(key)
+    if body is None:
+        page = ListingPage(get_store().page_listings(listing_query), limit, settings)
+        body = json.dumps({'listings': [api_listing(listing, projection) for listing in page],
+                           'next_cursor': page.next_cursor}, ensure_ascii=False, separators=(',', ':'))
+        page_cache.set(key, body)
+    return api_response(body, etag, last_modified)
+
+
+@app.route('/api/listings/<int:demand_id>')
+def api_listing_detail(demand_id):
+    settings = get_settings()
+    try:
+        projection = api_projection(settings)
+    except ValueError as e:
+        return api_error(400, str(e))
+    listing = get_store().get_listing(demand_id, replica=True)
+    if listing is None:
+        return api_error(404, 'listing not found')
 
-    return render_template('view_details.html', demand=demand, demand_data=demand_data, fields=fields,
-                           settings=settings)
+    etag = api_etag('api_listing', settings['version'], demand_id, listing['rev'], listing['status'],
+                    tuple(projection))
+    last_modified = content_updated_at()
+    not_modified = api_not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    data = listing['data']
+    with timed('json'):
+        data = migrate_listing_data(listing, json.loads(data) if data else {}, settings)
+    listing = {name: listing[name] for name in ('id', 'user_id', 'post_date', 'status')}
+    listing['data'] = data
+    return api_response(api_listing(listing, projection), etag, last_modified)
 
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    from flask import send_from_directory
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_upload(app.config['UPLOAD_FOLDER'], filename)
+
+
+@app.route('/uploads/thumbs/<filename>')
+def uploaded_thumbnail(filename):
+    return send_upload(app.config['THUMBNAIL_FOLDER'], filename)
+
+
+@app.route('/admin/db_stats')
+def db_stats():
+    if not session.get('is_admin'):
+        flash("您无权访问此页面。", "error")
+        return redirect(url_for('index'))
+
+    return jsonify(get_pool().stats())
+
+
+@app.route('/admin/metrics')
+def metrics_endpoint():
+    if not session.get('is_admin'):
+        flash("您无权访问此页面。", "error")
+        return redirect(url_for('index'))
+
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/export_listings')
+def export_listings_route():
+    if not session.get('is_admin'):
+        flash("您无权执行此操作。", "error")
+        return redirect(url_for('index'))
+
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'jsonl'
+    filename = f"listings-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return app.response_class(export_listings(fmt, get_settings()), mimetype=EXPORT_FORMATS[fmt],
+                              headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/admin/import_listings', methods=['POST'])
+def import_listings_route():
+    if not session.get('is_admin'):
+        flash("您无权执行此操作。", "error")
+        return redirect(url_for('index'))
+
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        flash("请选择要导入的文件。", "error")
+        return redirect(url_for('admin_panel'))
+
+    fmt = request.form.get('format') or export_format_for(file.filename)
+    if fmt not in EXPORT_FORMATS:
+        flash("不支持的文件格式。", "error")
+        return redirect(url_for('admin_panel'))
+
+    imported, rejected, errors = import_listings(read_import_rows(file.stream, fmt), get_settings(),
+                                                 session['user_id'])
+    record_history('import_listings', detail=f"导入 {imported} 条，跳过 {rejected} 条")
+    flash(f"导入完成：成功 {imported} 条，跳过 {rejected} 条。", "success")
+    for error in errors:
+        flash(error, "error")
+    return redirect(url_for('admin_panel'))
+
+
+USER_SORT_COLUMNS = ['id', 'username', 'post_count', 'accepted_count']
+DASHBOARD_DAYS = 30
 
 
 @app.route('/admin_panel', methods=['GET', 'POST'])
@@ -456,11 +3769,38 @@ def admin_panel():
         flash("您无权访问此页面。", "error")
         return redirect(url_for('index'))
 
-    db = get_db()
-    users = db.execute('SELECT * FROM users').fetchall()
+    store = get_store()
+    sort_by = request.args.get('sort')
+    if sort_by not in USER_SORT_COLUMNS:
+        sort_by = 'id'
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        order = 'asc'
+
+    filter_args = {}
+    q = request.args.get('q', '').strip()
+    if q:
+        filter_args['q'] = q
+    after = request.args.get('after')
+    cursor_key = decode_cursor(after) if after else None
+
+    page_size = app.config['PAGE_SIZE']
+    users = store.page_users(sort_by, order, page_size + 1, q, cursor_key)
+    next_cursor = None
+    if len(users) > page_size:
+        users = users[:page_size]
+        next_cursor = encode_cursor(users[-1][sort_by], users[-1]['id'])
+
+    since = (datetime.date.today() - datetime.timedelta(days=DASHBOARD_DAYS - 1)).isoformat()
+    per_day, per_status = store.listing_stats(since)
+    dashboard = {'per_day': per_day, 'per_status': per_status, 'top_users': store.top_users(10),
+                 'total': sum(row['count'] for row in per_status)}
+    migrations = store.recent_field_migrations(5)
     settings = get_settings()
 
-    return render_template('admin.html', users=users, settings=settings)
+    return render_template('admin.html', users=users, next_cursor=next_cursor, is_first_page=cursor_key is None,
+                           sort_by=sort_by, order=order, filter_args=filter_args, dashboard=dashboard,
+                           migrations=migrations, settings=settings)
 
 
 @app.route('/admin/set_site_name', methods=['POST'])
@@ -474,9 +3814,11 @@ def set_site_name():
         flash("网站名称不能为空。", "error")
         return redirect(url_for('admin_panel'))
 
-    db = get_db()
-    db.execute('UPDATE settings SET site_name = ? WHERE id = 1', (site_name,))
-    db.commit()
+    store = get_store()
+    store.update_settings(site_name=site_name)
+    store.commit()
+    invalidate_settings()
+    record_history('set_site_name', detail=site_name)
 
     flash(f"网站名称已更新为 '{site_name}'。", "success")
     return redirect(url_for('admin_panel'))
@@ -488,12 +3830,14 @@ def toggle_registration():
         flash("您无权执行此操作。", "error")
         return redirect(url_for('index'))
 
-    db = get_db()
+    store = get_store()
     settings = get_settings()
 
     new_status = 1 if not settings or not settings['registration_enabled'] else 0
-    db.execute('UPDATE settings SET registration_enabled = ? WHERE id = 1', (new_status,))
-    db.commit()
+    store.update_settings(registration_enabled=new_status)
+    store.commit()
+    invalidate_settings()
+    record_history('toggle_registration', detail='开启' if new_status else '关闭')
 
     flash(f"注册功能已{'开启' if new_status else '关闭'}。", "success")
     return redirect(url_for('admin_panel'))
@@ -505,15 +3849,18 @@ def toggle_lock(user_id):
         flash("您无权执行此操作。", "error")
         return redirect(url_for('index'))
 
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    store = get_store()
+    user = store.get_user(user_id)
     if not user or user['is_admin']:
         flash("无效用户或无法锁定管理员账号。", "error")
         return redirect(url_for('admin_panel'))
 
     new_status = 0 if user['is_locked'] else 1
-    db.execute('UPDATE users SET is_locked = ? WHERE id = ?', (new_status, user_id))
-    db.commit()
+    with store.batch():
+        store.update_user(user_id, is_locked=new_status)
+        if new_status:
+            revoke_user_sessions(store.writer(), user_id)
+    record_history('toggle_lock', f'user:{user_id}', '锁定' if new_status else '解锁')
 
     flash(f"用户 {user['username']} 账号已{'解锁' if user['is_locked'] else '锁定'}。", "success")
     return redirect(url_for('admin_panel'))
@@ -530,9 +3877,10 @@ def set_expiry(user_id):
         flash("请选择有效的日期。", "error")
         return redirect(url_for('admin_panel'))
 
-    db = get_db()
-    db.execute('UPDATE users SET expiry_date = ? WHERE id = ?', (expiry_date, user_id))
-    db.commit()
+    with get_store().batch() as store:
+        store.update_user(user_id, expiry_date=expiry_date)
+        revoke_user_sessions(store.writer(), user_id)
+    record_history('set_expiry', f'user:{user_id}', expiry_date)
 
     flash(f"用户有效期已设置为 {expiry_date}。", "success")
     return redirect(url_for('admin_panel'))
@@ -544,14 +3892,16 @@ def delete_user(user_id):
         flash("您无权执行此操作。", "error")
         return redirect(url_for('index'))
 
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    store = get_store()
+    user = store.get_user(user_id)
     if not user or user['is_admin']:
         flash("无效用户或无法删除管理员账号。", "error")
         return redirect(url_for('admin_panel'))
 
-    db.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    db.commit()
+    with store.batch():
+        store.delete_user(user_id)
+        revoke_user_sessions(store.writer(), user_id)
+    record_history('delete_user', f'user:{user_id}', user['username'])
 
     flash(f"用户 {user['username']} 已被删除。", "success")
     return redirect(url_for('admin_panel'))
@@ -564,32 +3914,337 @@ def update_fields():
         return redirect(url_for('index'))
 
     new_fields = []
-    i = 0
-    while True:
+    originals = []
+    # Rows removed in the form leave gaps in the numbering, and fields after a
+    # gap must not be mistaken for deleted ones now that deletion drops data.
+    indexes = sorted(int(key[len('field_name_'):]) for key in request.form
+                     if re.fullmatch(r'field_name_\d+', key))
+    for i in indexes:
         field_name = request.form.get(f'field_name_{i}')
         if not field_name:
-            break
+            continue
 
         field_label = request.form.get(f'field_label_{i}')
         field_type = request.form.get(f'field_type_{i}')
         field_required = request.form.get(f'field_required_{i}') == 'on'
+        field_default = request.form.get(f'field_default_{i}', '').strip()
 
-        new_fields.append({
+        # Names are spliced into JSON paths and column names.
+        if not FIELD_NAME_PATTERN.match(field_name):
+            flash(f"字段名无效：{field_name}（只能包含英文字母、数字和下划线，且不能以数字开头）", "error")
+            return redirect(url_for('admin_panel'))
+        if any(field['name'] == field_name for field in new_fields):
+            flash(f"字段名重复：{field_name}", "error")
+            return redirect(url_for('admin_panel'))
+
+        new_field = {
             "name": field_name,
             "label": field_label,
             "type": field_type,
             "required": field_required
-        })
-        i += 1
+        }
+        if field_default:
+            new_field['default'] = field_default
+        new_fields.append(new_field)
+        originals.append(request.form.get(f'field_original_{i}', ''))
 
-    db = get_db()
-    db.execute('UPDATE settings SET fields_definition = ? WHERE id = 1', (json.dumps(new_fields),))
-    db.commit()
+    store = get_store()
+    db = store.writer()
+    plan = plan_field_migration(get_settings()['fields_definition'], new_fields, originals)
+    # The definitions, the generated columns and the plan that rewrites rows to
+    # match them change together or not at all. None of this reads the listings:
+    # the runner rewrites their data and search rows batch by batch and builds
+    # the indexes of new columns afterwards.
+    with store.batch():
+        store.update_settings(fields_definition=json.dumps(new_fields))
+        sync_field_columns(db, new_fields)
+        if plan:
+            record_field_migration(db, plan)
+    invalidate_settings()
+    start_field_migration()
+    record_history('update_fields', detail=', '.join(f['name'] for f in new_fields))
 
     flash("动态字段已更新！", "success")
     return redirect(url_for('admin_panel'))
 
 
+# ====================================================================
+# CLI Commands
+# ====================================================================
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations."""
+    db = get_db()
+    applied = migrate_schema(db)
+    load_schema_state(db)
+    if not applied:
+        print(f"Database schema is up to date (version {schema_version(db)}).")
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the full-text search index from listings.data."""
+    if rebuild_search_index(get_db(), get_settings()['fields_definition']):
+        print("Full-text search index rebuilt.")
+    else:
+        print("Full-text search is not available in this SQLite build.")
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute users.post_count/accepted_count and the listing_stats rollup."""
+    rebuild_listing_stats(get_db())
+    print("Listing statistics rebuilt.")
+
+
+@app.cli.command('export-listings')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), help='Defaults to the file extension.')
+def export_listings_command(output, fmt):
+    """Stream all listings to OUTPUT (stdout by default) as JSONL or CSV."""
+    fmt = fmt or export_format_for(output.name)
+    for chunk in export_listings(fmt, get_settings()):
+        output.write(chunk)
+
+
+@app.cli.command('import-listings')
+@click.argument('input', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), help='Defaults to the file extension.')
+@click.option('--user-id', type=int, help='Owner of rows without user_id (defaults to the admin account).')
+def import_listings_command(input, fmt, user_id):
+    """Import listings from a JSONL or CSV file."""
+    if user_id is None:
+        user_id = get_store().find_user('admin')['id']
+    started = time.perf_counter()
+    imported, rejected, errors = import_listings(read_import_rows(input, fmt or export_format_for(input.name)),
+                                                 get_settings(), user_id)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f"Imported {imported} listings, rejected {rejected}, in {time.perf_counter() - started:.1f}s.")
+
+
+@app.cli.command('run-job')
+@click.argument('name', type=click.Choice(list(SCHEDULED_JOBS)))
+def run_job_command(name):
+    """Run one scheduled maintenance job now, regardless of its interval."""
+    status, result = run_job(get_db(), name)
+    print(f"{name}: {status}, {result}")
+
+
+@app.cli.command('vacuum')
+def vacuum_command():
+    """Switch the database to incremental auto-vacuum and rebuild it (locks it while running)."""
+    db = get_db()
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    started = time.perf_counter()
+    db.execute('VACUUM')
+    print(f"Database vacuumed in {time.perf_counter() - started:.1f}s.")
+
+
+# ====================================================================
+# ASGI Mode
+# ====================================================================
+# asgi_app serves this Flask app under an ASGI server, e.g.
+#     uvicorn app:asgi_app --workers 4
+# The event loop receives each request body without blocking: uploads are
+# buffered in memory up to ASGI_SPOOL_MEMORY and then written to a temporary
+# file from a small I/O pool, so a slow client ties up a connection, not a
+# thread. Only the complete request runs through Flask, on one of
+# ASGI_THREADS handler threads, which is where every database call happens;
+# sizing it like DB_POOL_SIZE keeps threads from waiting for connections.
+# Response chunks are collected up to ASGI_SEND_BUFFER bytes, handed back
+# through a short queue and written to the client by the event loop.
+
+class ASGIApp(object):
+    """ASGI adapter around a WSGI app with async body spooling and bounded handler threads."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.pid = None
+        self._handlers = None
+        self._io = None
+        self._lock = threading.Lock()
+        self.metrics = {'requests': 0, 'in_flight': 0, 'spooled': 0, 'too_large': 0, 'disconnects': 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics)
+
+    def executors(self):
+        if self.pid != os.getpid():
+            self._handlers = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='asgi-handler')
+            self._io = ThreadPoolExecutor(app.config['ASGI_IO_THREADS'], thread_name_prefix='asgi-io')
+            self.pid = os.getpid()
+        return self._handlers, self._io
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.executors()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                flush_history()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        handlers, io_pool = self.executors()
+        loop = asyncio.get_running_loop()
+        body = await self.read_body(receive, io_pool)
+        if body is None:
+            return
+        if body is False:
+            self.count('too_large')
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'connection', b'close')]})
+            await send({'type': 'http.response.body', 'body': '上传内容过大。'.encode('utf-8')})
+            return
+
+        self.count('requests')
+        self.count('in_flight')
+        chunks = asyncio.Queue(app.config['ASGI_RESPONSE_QUEUE'])
+        handler = loop.run_in_executor(handlers, self.handle, scope, body, chunks, loop)
+        item = ()
+        try:
+            item = await chunks.get()
+            if item is None:
+                return
+            status, headers = item
+            await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers]})
+            while True:
+                item = await chunks.get()
+                if item is None:
+                    break
+                await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            self.count('disconnects')
+        finally:
+            # Drain so a handler blocked on a full queue can finish after a disconnect.
+            while item is not None:
+                item = await chunks.get()
+            await handler
+            self.count('in_flight', -1)
+
+    async def read_body(self, receive, io_pool):
+        """Body as a readable file, None if the client went away, False if over MAX_CONTENT_LENGTH."""
+        loop = asyncio.get_running_loop()
+        limit = app.config['MAX_CONTENT_LENGTH']
+        body = io.BytesIO()
+        spooled = False
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            size += len(chunk)
+            if limit is not None and size > limit:
+                body.close()
+                return False
+            if not spooled and size > app.config['ASGI_SPOOL_MEMORY']:
+                spool = await loop.run_in_executor(io_pool, tempfile.TemporaryFile)
+                await loop.run_in_executor(io_pool, spool.write, body.getvalue())
+                body, spooled = spool, True
+                self.count('spooled')
+            if spooled:
+                await loop.run_in_executor(io_pool, body.write, chunk)
+            else:
+                body.write(chunk)
+        body.seek(0)
+        return body
+
+    def handle(self, scope, body, chunks, loop):
+        """Run the WSGI app on a handler thread, passing (status, headers), then body chunks, then None."""
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        try:
+            result = self.wsgi_app(self.environ(scope, body), start_response)
+            try:
+                put(tuple(response))
+                # Streamed templates yield thousands of small chunks; each one
+                # handed over costs a round-trip through the event loop.
+                buffered, size = [], 0
+                for chunk in result:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    if size >= app.config['ASGI_SEND_BUFFER']:
+                        put(b''.join(buffered))
+                        buffered, size = [], 0
+                if size:
+                    put(b''.join(buffered))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            body.close()
+            put(None)
+
+    @staticmethod
+    def environ(scope, body):
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(body.seek(0, io.SEEK_END)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        body.seek(0)
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+
+asgi_app = ASGIApp(app)
+
+
 # ====================================================================
 # Main entry point
 # ====================================================================
@@ -0,0 +1,558 @@
+# coding=utf-8
+"""Benchmark and load-test harness for the Flask routes in app.py.
+
+Seeds a scratch database.db with N users and M listings for a chosen
+fields_definition shape, then drives the hot routes either in-process through
+the Flask test client or over HTTP against a local gunicorn (sync) or uvicorn
+(ASGI) server, and reports p50/p95/p99 latency, throughput and peak RSS per
+scenario.
+
+    python bench.py --users 1000 --listings 100000 --shape default
+    python bench.py --mode gunicorn --workers 4 --concurrency 16
+    python bench.py --mode both --json results.json
+    python bench.py --mode compare --slow-uploads 32 --scenarios index,view_details
+
+--slow-uploads N keeps N clients trickling multipart uploads at the server
+while the scenarios run, to compare how each server copes with slow clients.
+
+The scratch directory (``--workdir``, a temporary directory by default) holds
+database.db and uploads/, so the real database is never touched.
+"""
+import argparse
+import http.client
+import http.cookiejar
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_PASSWORD = 'bench_password'
+ADMIN_USERNAME = 'admin'
+ADMIN_PASSWORD = 'admin_password_123'
+
+WORDS = ['apple', 'banana', 'cherry', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet',
+         '北京', '上海', '广州', '深圳', '杭州', '苹果', '香蕉', '需求', '服务', '设计']
+
+SHAPES = {
+    'default': [
+        {"name": "field_name_1", "label": "字段1", "type": "text", "required": True},
+        {"name": "field_name_2", "label": "字段2", "type": "number", "required": False},
+        {"name": "field_name_3", "label": "字段3", "type": "textarea", "required": False},
+    ],
+    'wide': [
+        {"name": f"text_{i}", "label": f"文本{i}", "type": "text", "required": False} for i in range(6)
+    ] + [
+        {"name": f"number_{i}", "label": f"数字{i}", "type": "number", "required": False} for i in range(4)
+    ] + [
+        {"name": f"notes_{i}", "label": f"备注{i}", "type": "textarea", "required": False} for i in range(2)
+    ],
+    'files': [
+        {"name": "title", "label": "标题", "type": "text", "required": True},
+        {"name": "price", "label": "价格", "type": "number", "required": False},
+        {"name": "photo", "label": "图片", "type": "file", "required": False},
+    ],
+}
+
+
+# ====================================================================
+# Seeding
+# ====================================================================
+
+def random_value(rng, field):
+    # Stored the way post_demand stores them: numbers as JSON numbers, dates as YYYY-MM-DD.
+    if field['type'] == 'number':
+        return rng.randint(0, 100000)
+    if field['type'] == 'date':
+        return time.strftime('%Y-%m-%d', time.localtime(time.time() - rng.randrange(365 * 24 * 3600)))
+    if field['type'] == 'textarea':
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 40)))
+    if field['type'] == 'file':
+        return None
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def random_listing(rng, fields):
+    return {f['name']: random_value(rng, f) for f in fields}
+
+
+def seed(app_module, users, listings, fields, rng, batch_size=10000):
+    app = app_module.app
+    with app.app_context():
+        db = app_module.get_db()
+        db.execute('UPDATE settings SET fields_definition = ?, version = version + 1 WHERE id = 1',
+                   (json.dumps(fields),))
+        db.commit()
+        app_module.invalidate_settings()
+        app_module.sync_field_columns(db, fields)
+
+        # One hash for every seeded user keeps seeding fast; logins still pay the full cost.
+        pwhash = app_module.generate_password_hash(BENCH_PASSWORD, method=app.config['PASSWORD_HASH_METHOD'])
+        db.executemany('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)',
+                       ((f'bench_user_{i}', pwhash) for i in range(users)))
+        db.commit()
+        user_ids = [row['id'] for row in db.execute('SELECT id FROM users')]
+
+        start = time.time() - 365 * 24 * 3600
+        for offset in range(0, listings, batch_size):
+            rows = []
+            for _ in range(min(batch_size, listings - offset)):
+                post_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + rng.random() * 365 * 24 * 3600))
+                rows.append((rng.choice(user_ids), json.dumps(random_listing(rng, fields)), post_date,
+                             rng.choice(['open', 'open', 'open', 'closed'])))
+            db.executemany('INSERT INTO listings (user_id, data, post_date, status) VALUES (?, ?, ?, ?)', rows)
+            db.commit()
+
+        app_module.rebuild_search_index(db, fields)
+        app_module.bump_content_version(db)
+        db.commit()
+        listing_ids = [row['id'] for row in db.execute('SELECT id FROM listings')]
+    return user_ids, listing_ids
+
+
+# ====================================================================
+# Scenarios
+# ====================================================================
+
+def png_bytes(rng):
+    # A valid 1x1 PNG with random trailing bytes, so uploads do not all deduplicate.
+    def chunk(kind, data):
+        body = kind + data
+        return len(data).to_bytes(4, 'big') + body + zlib.crc32(body).to_bytes(4, 'big')
+    header = chunk(b'IHDR', (1).to_bytes(4, 'big') * 2 + bytes([8, 2, 0, 0, 0]))
+    pixels = chunk(b'IDAT', zlib.compress(b'\x00' + bytes(rng.randrange(256) for _ in range(3))))
+    return b'\x89PNG\r\n\x1a\n' + header + pixels + chunk(b'IEND', b'') + os.urandom(16)
+
+
+def build_scenarios(fields, listing_ids, users):
+    text_field = next((f for f in fields if f['type'] == 'text'), None)
+    sort_field = next((f for f in fields if f['type'] == 'number'), text_field)
+    file_field = next((f for f in fields if f['type'] == 'file'), None)
+
+    def form_data(rng):
+        data = {}
+        files = {}
+        for field in fields:
+            if field['type'] == 'file':
+                files[field['name']] = ('bench.png', png_bytes(rng))
+            else:
+                data[field['name']] = str(random_value(rng, field))
+        return data, files
+
+    scenarios = [
+        ('index', 'GET', lambda rng: ('/', None, None), None),
+        ('index_sorted', 'GET',
+         lambda rng: (f"/?sort={sort_field['name']}&order={rng.choice(['asc', 'desc'])}", None, None), None),
+        ('index_search', 'GET',
+         lambda rng: ('/?' + urllib.parse.urlencode({'q': rng.choice(WORDS)}), None, None), None),
+    ]
+    if text_field:
+        scenarios.append(('index_filter', 'GET',
+                          lambda rng: ('/?' + urllib.parse.urlencode({text_field['name']: rng.choice(WORDS)}),
+                                       None, None), None))
+    if listing_ids:
+        scenarios.append(('view_details', 'GET',
+                          lambda rng: (f'/view_details/{rng.choice(listing_ids)}', None, None), None))
+    scenarios.append(('post_demand', 'POST', lambda rng: ('/post_demand', form_data(rng)[0], None), 'admin'))
+    if file_field:
+        scenarios.append(('upload', 'POST', lambda rng: ('/post_demand',) + form_data(rng), 'admin'))
+    if users:
+        scenarios.append(('login', 'POST',
+                          lambda rng: ('/login', {'username': f'bench_user_{rng.randrange(users)}',
+                                                  'password': BENCH_PASSWORD}, None), None))
+    return scenarios
+
+
+# ====================================================================
+# Drivers
+# ====================================================================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, send, make_request, requests, concurrency, seed_value):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one(i):
+        rng = random.Random(seed_value * 100003 + i)
+        path, data, files = make_request(rng)
+        started = time.perf_counter()
+        try:
+            status = send(path, data, files)
+        except Exception:
+            status = None
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status is None or status >= 400:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'scenario': name,
+        'requests': requests,
+        'errors': errors[0],
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'throughput_rps': requests / wall if wall else None,
+    }
+
+
+def make_client_sender(app, role):
+    local = threading.local()
+
+    def send(path, data, files):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+            if role == 'admin':
+                with client.session_transaction() as sess:
+                    sess['username'] = ADMIN_USERNAME
+                    sess['user_id'] = 1
+                    sess['is_admin'] = True
+        if data is None and not files:
+            response = client.get(path)
+        else:
+            payload = dict(data or {})
+            for key, (filename, content) in (files or {}).items():
+                payload[key] = (io.BytesIO(content), filename)
+            response = client.post(path, data=payload, content_type='multipart/form-data' if files else None)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    return send
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def encode_multipart(data, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in (data or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'.encode('utf-8'))
+        parts.append(str(value if value is not None else '').encode('utf-8') + b'\r\n')
+    for key, (filename, content) in (files or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8'))
+        parts.append(content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def make_http_sender(base_url, role):
+    local = threading.local()
+
+    def opener():
+        if getattr(local, 'opener', None) is None:
+            jar = http.cookiejar.CookieJar()
+            local.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect)
+            if role == 'admin':
+                body = urllib.parse.urlencode({'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD}).encode()
+                send_with(local.opener, '/login', body, 'application/x-www-form-urlencoded')
+        return local.opener
+
+    def send_with(http_opener, path, body, content_type):
+        request = urllib.request.Request(base_url + path, data=body)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            with http_opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def send(path, data, files):
+        if data is None and not files:
+            return send_with(opener(), path, None, None)
+        if files:
+            body, content_type = encode_multipart(data, files)
+        else:
+            body, content_type = urllib.parse.urlencode(data).encode('utf-8'), 'application/x-www-form-urlencoded'
+        return send_with(opener(), path, body, content_type)
+
+    return send
+
+
+def process_tree_peak_rss_kb(pid):
+    # VmHWM is the peak resident set size of each process; Linux only.
+    total = 0
+    pids = [pid]
+    try:
+        children = subprocess.run(['pgrep', '-P', str(pid)], capture_output=True, text=True).stdout.split()
+        pids.extend(int(child) for child in children)
+    except OSError:
+        pass
+    for each in pids:
+        try:
+            with open(f'/proc/{each}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return total
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_app():
+    """gunicorn entry point: the application with login throttling disabled."""
+    import app as app_module
+    configure(app_module)
+    return app_module.app
+
+
+def bench_asgi():
+    """uvicorn factory: the ASGI application with login throttling disabled."""
+    import app as app_module
+    configure(app_module)
+    return app_module.asgi_app
+
+
+def configure(app_module):
+    app_module.login_user_limiter = app_module.RateLimiter(10 ** 9, 1)
+    app_module.login_ip_limiter = app_module.RateLimiter(10 ** 9, 1)
+    if os.environ.get('BENCH_PAGE_CACHE') == '0':
+        app_module.page_cache.max_bytes = 0
+
+
+def run_client_mode(app_module, scenarios, args):
+    results = []
+    for index, (name, method, make_request, role) in enumerate(scenarios):
+        send = make_client_sender(app_module.app, role)
+        for i in range(args.warmup):
+            send(*make_request(random.Random(-i - 1)))
+        results.append(run_scenario(name, send, make_request, args.requests, args.concurrency, index))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for result in results:
+        result['mode'] = 'client'
+        result['peak_rss_kb'] = peak
+    return results
+
+
+class SlowUploads(object):
+    """Clients that keep posting multipart uploads a few KB at a time until stopped."""
+
+    def __init__(self, base_url, clients, size, rate):
+        self.base_url = base_url
+        self.size = size
+        self.rate = rate
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._run, args=(i,), daemon=True) for i in range(clients)]
+
+    def __enter__(self):
+        jar = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect)
+        body = urllib.parse.urlencode({'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD}).encode()
+        try:
+            opener.open(self.base_url + '/login', body, timeout=60).read()
+        except urllib.error.HTTPError as e:
+            e.read()
+        self.cookie = '; '.join(f'{c.name}={c.value}' for c in jar)
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=60)
+
+    def _run(self, index):
+        rng = random.Random(index)
+        host, port = urllib.parse.urlsplit(self.base_url).netloc.split(':')
+        chunk_size = 4096
+        while not self._stop.is_set():
+            # Not a valid image, so the trickled uploads never add real files.
+            body, content_type = encode_multipart({}, {'file': ('slow.bin', os.urandom(self.size))})
+            connection = http.client.HTTPConnection(host, int(port), timeout=120)
+            try:
+                connection.putrequest('POST', '/post_demand')
+                connection.putheader('Content-Type', content_type)
+                connection.putheader('Content-Length', str(len(body)))
+                connection.putheader('Cookie', self.cookie)
+                connection.endheaders()
+                for i in range(0, len(body), chunk_size):
+                    connection.send(body[i:i + chunk_size])
+                    self._stop.wait(chunk_size / self.rate * rng.uniform(0.5, 1.5))
+                connection.getresponse().read()
+                with self._lock:
+                    self.completed += 1
+            except (OSError, http.client.HTTPException):
+                with self._lock:
+                    self.failed += 1
+            finally:
+                connection.close()
+
+
+SERVERS = {
+    'gunicorn': lambda args, port: [sys.executable, '-m', 'gunicorn', '--chdir', args.workdir,
+                                    '-w', str(args.workers), '-b', f'127.0.0.1:{port}', '--log-level', 'warning',
+                                    'bench:bench_app()'],
+    'uvicorn': lambda args, port: [sys.executable, '-m', 'uvicorn', '--app-dir', ROOT, '--factory',
+                                   '--workers', str(args.workers), '--host', '127.0.0.1', '--port', str(port),
+                                   '--log-level', 'warning', 'bench:bench_asgi'],
+}
+
+
+def run_server_mode(server_name, scenarios, args):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if args.no_page_cache:
+        env['BENCH_PAGE_CACHE'] = '0'
+    server = subprocess.Popen(SERVERS[server_name](args, port), env=env, cwd=args.workdir)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                urllib.request.urlopen(base_url + '/login', timeout=1).read()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError(f'{server_name} did not start')
+                time.sleep(0.2)
+
+        results = []
+        with SlowUploads(base_url, args.slow_uploads, args.slow_upload_size, args.slow_upload_rate) as slow:
+            for index, (name, method, make_request, role) in enumerate(scenarios):
+                send = make_http_sender(base_url, role)
+                for i in range(args.warmup):
+                    send(*make_request(random.Random(-i - 1)))
+                results.append(run_scenario(name, send, make_request, args.requests, args.concurrency, index))
+        peak = process_tree_peak_rss_kb(server.pid)
+        for result in results:
+            result['mode'] = f'{server_name} x{args.workers}'
+            result['peak_rss_kb'] = peak
+            result['slow_uploads'] = {'clients': args.slow_uploads, 'completed': slow.completed,
+                                      'failed': slow.failed}
+        if args.slow_uploads:
+            print(f"{server_name}: {slow.completed} slow uploads completed, {slow.failed} failed")
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def print_report(results):
+    header = f"{'mode':<14} {'scenario':<14} {'reqs':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} " \
+             f"{'p99 ms':>9} {'req/s':>9} {'peak RSS MB':>12}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        rss = f"{r['peak_rss_kb'] / 1024:.1f}" if r['peak_rss_kb'] else 'n/a'
+        print(f"{r['mode']:<14} {r['scenario']:<14} {r['requests']:>6} {r['errors']:>5} {r['p50_ms']:>9.2f} "
+              f"{r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['throughput_rps']:>9.1f} {rss:>12}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--listings', type=int, default=10000)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='default')
+    parser.add_argument('--fields-json', help='path to a custom fields_definition JSON file')
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'uvicorn', 'both', 'compare'],
+                        default='client', help='both: client and gunicorn; compare: gunicorn and uvicorn')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn or uvicorn workers')
+    parser.add_argument('--slow-uploads', type=int, default=0, help='slow uploading clients during server modes')
+    parser.add_argument('--slow-upload-size', type=int, default=256 * 1024, help='bytes per slow upload')
+    parser.add_argument('--slow-upload-rate', type=int, default=64 * 1024, help='bytes per second per slow client')
+    parser.add_argument('--scenarios', help='comma-separated subset of scenarios to run')
+    parser.add_argument('--no-page-cache', action='store_true', help='disable the rendered page cache')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help='scratch directory for database.db and uploads/')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    if args.fields_json:
+        with open(args.fields_json) as f:
+            fields = json.load(f)
+    else:
+        fields = SHAPES[args.shape]
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    own_workdir = args.workdir is None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='bench-'))
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    sys.path.insert(0, ROOT)
+    try:
+        import app as app_module
+        configure(app_module)
+        if args.no_page_cache:
+            app_module.page_cache.max_bytes = 0
+
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        user_ids, listing_ids = seed(app_module, args.users, args.listings, fields, rng)
+        print(f"Seeded {len(user_ids)} users and {len(listing_ids)} listings ({args.shape}) "
+              f"in {time.perf_counter() - started:.1f}s under {args.workdir}")
+
+        scenarios = build_scenarios(fields, listing_ids, args.users)
+        if args.scenarios:
+            wanted = set(args.scenarios.split(','))
+            scenarios = [s for s in scenarios if s[0] in wanted]
+
+        results = []
+        if args.mode in ('client', 'both'):
+            results.extend(run_client_mode(app_module, scenarios, args))
+        if args.mode in ('gunicorn', 'both', 'compare'):
+            results.extend(run_server_mode('gunicorn', scenarios, args))
+        if args.mode in ('uvicorn', 'compare'):
+            results.extend(run_server_mode('uvicorn', scenarios, args))
+
+        print_report(results)
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    finally:
+        os.chdir(ROOT)
+        if own_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
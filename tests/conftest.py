@@ -0,0 +1,68 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py creates database.db and the upload folders in the working directory
+# when it is imported, so the tests import it from a scratch directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='app-tests-'))
+
+import app as app_module  # noqa: E402
+
+app_module.app.config.update(TESTING=True, HASH_WORKERS=0, SCHEDULER_ENABLED=False)
+# send_from_directory() resolves relative folders against the app root, not the working directory.
+app_module.app.config.update(UPLOAD_FOLDER=os.path.abspath(app_module.app.config['UPLOAD_FOLDER']),
+                             THUMBNAIL_FOLDER=os.path.abspath(app_module.app.config['THUMBNAIL_FOLDER']))
+app_module.login_user_limiter.allow = lambda key: True
+app_module.login_ip_limiter.allow = lambda key: True
+
+ADMIN_PASSWORD = 'admin_password_123'
+_usernames = itertools.count(1)
+
+
+@pytest.fixture
+def app():
+    return app_module.app
+
+
+@pytest.fixture
+def ctx(app):
+    with app.test_request_context():
+        yield
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def login(client, username, password):
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302 and response.headers['Location'] == '/'
+    return client
+
+
+@pytest.fixture
+def admin(app):
+    return login(app.test_client(), 'admin', ADMIN_PASSWORD)
+
+
+@pytest.fixture
+def user(app):
+    """A fresh regular account, returned as (id, username, password)."""
+    username, password = f'user{next(_usernames)}', 'secret'
+    with app.app_context():
+        store = app_module.get_store()
+        user_id = store.create_user(username, app_module.hash_password(password))
+        store.commit()
+    return user_id, username, password
+
+
+@pytest.fixture
+def user_client(app, user):
+    """A client logged in as the fresh account, returned as (client, user id)."""
+    user_id, username, password = user
+    return login(app.test_client(), username, password), user_id
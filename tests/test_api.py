@@ -0,0 +1,55 @@
+def test_settings_etag(client, admin):
+    response = client.get('/api/settings')
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and response.headers['Cache-Control'] == 'no-cache'
+
+    response = client.get('/api/settings', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert response.headers['ETag'] == etag
+
+    admin.post('/admin/set_site_name', data={'site_name': 'ETag 测试站点'})
+    response = client.get('/api/settings', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.get_json()['site_name'] == 'ETag 测试站点'
+
+
+def test_listings_etag_follows_content(client, admin):
+    response = client.get('/api/listings?limit=5')
+    etag = response.headers['ETag']
+    assert client.get('/api/listings?limit=5', headers={'If-None-Match': etag}).status_code == 304
+    # The validator covers the query, not just the content.
+    assert client.get('/api/listings?limit=6', headers={'If-None-Match': etag}).status_code == 200
+
+    admin.post('/post_demand', data={'field_name_1': 'fresh listing', 'field_name_2': '', 'field_name_3': ''})
+    response = client.get('/api/listings?limit=5', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['listings'][0]['data']['field_name_1'] == 'fresh listing'
+
+
+def test_listings_if_modified_since(client):
+    response = client.get('/api/listings')
+    last_modified = response.headers['Last-Modified']
+    assert client.get('/api/listings', headers={'If-Modified-Since': last_modified}).status_code == 304
+    assert client.get('/api/listings', headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'}).status_code \
+        == 200
+    # If-None-Match takes precedence over If-Modified-Since.
+    assert client.get('/api/listings', headers={'If-Modified-Since': last_modified,
+                                                'If-None-Match': '"stale"'}).status_code == 200
+
+
+def test_listing_detail_etag(client, admin):
+    admin.post('/post_demand', data={'field_name_1': 'detail listing', 'field_name_2': '', 'field_name_3': ''})
+    listing_id = client.get('/api/listings?limit=1').get_json()['listings'][0]['id']
+    url = f'/api/listings/{listing_id}'
+    etag = client.get(url).headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    admin.post(f'/edit_demand/{listing_id}', data={'field_name_1': 'edited', 'field_name_2': '', 'field_name_3': ''})
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.get_json()['data']['field_name_1'] == 'edited'
+
+
+def test_errors(client):
+    assert client.get('/api/listings/999999').status_code == 404
+    assert client.get('/api/listings?fields=nope').status_code == 400
+    assert client.get('/api/listings?after=garbage').status_code == 400
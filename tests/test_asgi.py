@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from app import ASGIApp, asgi_app
+
+
+def scope(method='GET', path='/', query=b'', headers=(), root_path=''):
+    return {'type': 'http', 'method': method, 'path': path, 'root_path': root_path, 'query_string': query,
+            'headers': list(headers), 'http_version': '1.1', 'server': ('testserver', 80),
+            'client': ('127.0.0.1', 5000)}
+
+
+def call(asgi, scope, messages):
+    """Run one request; returns the messages sent back."""
+    sent = []
+
+    async def run():
+        queue = asyncio.Queue()
+        for message in messages:
+            queue.put_nowait(message)
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi(scope, queue.get, send)
+
+    asyncio.run(run())
+    return sent
+
+
+def body(sent):
+    return b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+
+
+def echo(environ, start_response):
+    start_response('201 Created', [('Content-Type', 'text/plain'), ('X-Path', environ['SCRIPT_NAME'] + '|' +
+                                                                     environ['PATH_INFO'])])
+    data = environ['wsgi.input'].read()
+    return [environ.get('HTTP_X_TAG', '').encode('latin-1'), b':', data]
+
+
+def test_request_body_and_response(app):
+    asgi = ASGIApp(echo)
+    sent = call(asgi, scope('POST', '/base/echo', headers=[(b'x-tag', b'a'), (b'x-tag', b'b')], root_path='/base'),
+                [{'type': 'http.request', 'body': b'hel', 'more_body': True}, {'type': 'http.request', 'body': b'lo'}])
+    assert sent[0]['status'] == 201
+    assert (b'x-path', b'/base|/echo') in sent[0]['headers']
+    assert body(sent) == b'a,b:hello'
+    assert asgi.stats()['requests'] == 1 and asgi.stats()['in_flight'] == 0
+
+
+def test_large_bodies_are_spooled(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'ASGI_SPOOL_MEMORY', 4)
+    asgi = ASGIApp(echo)
+    chunks = [{'type': 'http.request', 'body': b'abc', 'more_body': True}] * 3 + [{'type': 'http.request'}]
+    assert body(call(asgi, scope('POST'), chunks)) == b':abcabcabc'
+    assert asgi.stats()['spooled'] == 1
+
+
+def test_oversized_body_is_rejected(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 5)
+    asgi = ASGIApp(echo)
+    sent = call(asgi, scope('POST'), [{'type': 'http.request', 'body': b'123456'}])
+    assert sent[0]['status'] == 413
+    assert asgi.stats()['too_large'] == 1 and asgi.stats()['requests'] == 0
+
+
+def test_disconnect_before_the_body_sends_nothing(app):
+    asgi = ASGIApp(echo)
+    assert call(asgi, scope('POST'), [{'type': 'http.request', 'body': b'x', 'more_body': True},
+                                      {'type': 'http.disconnect'}]) == []
+
+
+def test_streamed_response_is_buffered(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'ASGI_SEND_BUFFER', 10)
+
+    def stream(environ, start_response):
+        start_response('200 OK', [])
+        return (b'x' * 4 for _ in range(6))
+
+    sent = call(ASGIApp(stream), scope(), [{'type': 'http.request'}])
+    chunks = [message['body'] for message in sent[1:] if message['body']]
+    assert b''.join(chunks) == b'x' * 24 and len(chunks) == 2
+    assert sent[-1] == {'type': 'http.response.body', 'body': b''}
+
+
+def test_lifespan(app):
+    sent = call(ASGIApp(echo), {'type': 'lifespan'}, [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+@pytest.mark.parametrize('path', ['/api/settings', '/'])
+def test_flask_app(app, path):
+    sent = call(asgi_app, scope(path=path), [{'type': 'http.request'}])
+    assert sent[0]['status'] == 200
+    assert body(sent)
@@ -0,0 +1,26 @@
+import base64
+import json
+
+import pytest
+
+from app import decode_cursor, encode_cursor
+
+
+def token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('sort_value', ['2024-01-02 03:04:05', '标题', 42, -1.5, None, ''])
+def test_round_trip(sort_value):
+    cursor = encode_cursor(sort_value, 17)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == (sort_value, 17)
+
+
+@pytest.mark.parametrize('bad', [
+    '', '!!!', 'not-base64', token('string'), token([1]), token([1, 2, 3]), token(['x', '17']),
+    token(['x', 1.5]), token(['x', None]), token([[1], 17]), token([{'a': 1}, 17]),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'),
+])
+def test_bad_cursors_are_rejected(bad):
+    assert decode_cursor(bad) is None
@@ -0,0 +1,69 @@
+from app import apply_field_migration, plan_field_migration
+
+
+def field(name, type='text', required=False, default=None):
+    return {'name': name, 'label': name, 'type': type, 'required': required, 'default': default}
+
+
+def test_unchanged_fields_need_no_plan():
+    fields = [field('a'), field('b', 'number')]
+    assert plan_field_migration(fields, fields, ['a', 'b']) is None
+
+
+def test_new_field():
+    old = [field('a')]
+    plan = plan_field_migration(old, old + [field('b')], ['a', ''])
+    assert plan[1] == {'name': 'b', 'source': None, 'type': 'text', 'coerce': False, 'default': None}
+    assert apply_field_migration({'a': 'x'}, plan) == {'a': 'x', 'b': None}
+
+
+def test_rename():
+    plan = plan_field_migration([field('a')], [field('b')], ['a'])
+    assert plan == [{'name': 'b', 'source': 'a', 'type': 'text', 'coerce': False, 'default': None}]
+    assert apply_field_migration({'a': 'x'}, plan) == {'b': 'x'}
+
+
+def test_swap():
+    old = [field('a'), field('b')]
+    plan = plan_field_migration(old, [field('b'), field('a')], ['a', 'b'])
+    assert [(step['name'], step['source']) for step in plan] == [('b', 'a'), ('a', 'b')]
+    assert apply_field_migration({'a': 'x', 'b': 'y'}, plan) == {'b': 'x', 'a': 'y'}
+
+
+def test_rename_onto_a_dropped_name_keeps_the_renamed_source():
+    # a is dropped and b takes over its name; the old a values must not come back.
+    old = [field('a'), field('b')]
+    plan = plan_field_migration(old, [field('a')], ['b'])
+    assert plan == [{'name': 'a', 'source': 'b', 'type': 'text', 'coerce': False, 'default': None}]
+    assert apply_field_migration({'a': 'x', 'b': 'y'}, plan) == {'a': 'y'}
+
+
+def test_drop():
+    old = [field('a'), field('b')]
+    plan = plan_field_migration(old, [field('a')], ['a'])
+    assert plan == [{'name': 'a', 'source': 'a', 'type': 'text', 'coerce': False, 'default': None}]
+    assert apply_field_migration({'a': 'x', 'b': 'y'}, plan) == {'a': 'x'}
+
+
+def test_type_change_coerces():
+    plan = plan_field_migration([field('a')], [field('a', 'number')], ['a'])
+    assert plan[0]['coerce']
+    assert apply_field_migration({'a': '12.5'}, plan) == {'a': 12.5}
+    assert apply_field_migration({'a': 'abc'}, plan) == {'a': None}
+
+
+def test_new_default_fills_missing_values():
+    plan = plan_field_migration([field('a')], [field('a', default='n/a')], ['a'])
+    assert plan[0]['default'] == 'n/a'
+    assert apply_field_migration({'a': ''}, plan) == {'a': 'n/a'}
+    assert apply_field_migration({'a': 'x'}, plan) == {'a': 'x'}
+
+
+def test_unchanged_default_needs_no_plan():
+    fields = [field('a', default='n/a')]
+    assert plan_field_migration(fields, fields, ['a']) is None
+
+
+def test_rows_written_after_the_change_keep_their_values():
+    plan = plan_field_migration([field('a')], [field('b')], ['a'])
+    assert apply_field_migration({'b': 'new'}, plan) == {'b': 'new'}
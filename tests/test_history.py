@@ -0,0 +1,39 @@
+from app import flush_history, get_store, record_history
+
+
+def test_page_history_filters_and_pages(ctx, user):
+    user_id = user[0]
+    for i in range(3):
+        record_history('post_demand', f'listing:{i}', user_id=user_id, username=user[1])
+    record_history('edit_demand', 'listing:0', user_id=user_id, username=user[1])
+    flush_history()
+
+    store = get_store()
+    entries = store.page_history(10, user_id=user_id)
+    assert [entry['action'] for entry in entries] == ['edit_demand', 'post_demand', 'post_demand', 'post_demand']
+    assert [entry['target'] for entry in store.page_history(10, user_id, 'post_demand')] == \
+        ['listing:2', 'listing:1', 'listing:0']
+    assert [entry['target'] for entry in store.page_history(2, user_id, 'post_demand', entries[2]['id'])] == \
+        ['listing:0']
+
+
+def test_history_page_shows_only_own_entries(admin, user_client):
+    client, user_id = user_client
+    client.post('/post_demand', data={'field_name_1': 'history entry', 'field_name_2': '', 'field_name_3': ''})
+    admin.post('/admin/set_site_name', data={'site_name': '历史测试站点'})
+    flush_history()
+
+    page = client.get('/history').get_data(as_text=True)
+    assert '<td>发布内容</td>' in page and '<td>admin</td>' not in page
+    page = admin.get('/history?action=set_site_name').get_data(as_text=True)
+    assert '<td>修改网站名称</td>' in page and '<td>admin</td>' in page
+    page = admin.get(f'/history?user_id={user_id}&action=set_site_name').get_data(as_text=True)
+    assert '暂无操作记录' in page
+
+
+def test_recent_field_migrations(app, admin):
+    assert admin.get('/admin_panel').status_code == 200
+    with app.app_context():
+        migrations = get_store().recent_field_migrations(2)
+    assert len(migrations) <= 2
+    assert [migration['id'] for migration in migrations] == sorted((m['id'] for m in migrations), reverse=True)
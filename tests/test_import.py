@@ -0,0 +1,102 @@
+import io
+import json
+
+import pytest
+
+from app import get_settings, get_store, import_listings, read_import_rows, validate_import_row
+
+FIELDS = [
+    {'name': 'title', 'label': '标题', 'type': 'text', 'required': True},
+    {'name': 'price', 'label': '价格', 'type': 'number', 'required': False},
+    {'name': 'due', 'label': '日期', 'type': 'date', 'required': False},
+    {'name': 'photo', 'label': '图片', 'type': 'file', 'required': False},
+]
+NOW = '2024-06-01 12:00:00'
+
+
+def validate(row):
+    return validate_import_row(row, FIELDS, {1, 2}, 1, NOW)
+
+
+def test_valid_row():
+    data, params = validate({'user_id': 2, 'post_date': '2024-01-01 08:00:00', 'status': 'accepted',
+                             'data': {'title': 'lamp', 'price': '12', 'due': '2024-02-03', 'photo': 'a.png'}})
+    assert data == {'title': 'lamp', 'price': 12, 'due': '2024-02-03', 'photo': 'a.png'}
+    assert params == (2, json.dumps(data), '2024-01-01 08:00:00', 'accepted')
+
+
+def test_defaults_and_flat_rows():
+    # CSV rows carry the fields as top-level columns and may leave the listing columns empty.
+    data, params = validate({'id': '9', 'user_id': '', 'post_date': '', 'status': '', 'title': 'chair',
+                             'price': '', 'due': '', 'photo': ''})
+    assert data == {'title': 'chair', 'price': None, 'due': None, 'photo': None}
+    assert params == (1, json.dumps(data), NOW, 'open')
+
+
+def test_non_text_values_are_stored_as_text():
+    data, _ = validate({'data': {'title': 42}})
+    assert data['title'] == '42'
+
+
+@pytest.mark.parametrize('row, message', [
+    ({'data': {'price': 1}}, "字段 '标题' 是必填的"),
+    ({'data': {'title': 'x', 'colour': 'red'}}, '未知字段：colour'),
+    ({'data': ['title']}, 'data 必须是 JSON 对象'),
+    ({'data': {'title': 'x', 'price': 'cheap'}}, '价格'),
+    ({'data': {'title': 'x', 'due': '03/02/2024'}}, '日期'),
+    ({'data': {'title': 'x', 'photo': '../../etc/passwd'}}, "字段 '图片' 的文件名无效"),
+    ({'data': {'title': 'x', 'photo': 5}}, "字段 '图片' 的文件名无效"),
+    ({'data': {'title': 'x'}, 'user_id': 'abc'}, 'user_id 必须是整数'),
+    ({'data': {'title': 'x'}, 'user_id': 99}, '用户 99 不存在'),
+    ({'data': {'title': 'x'}, 'post_date': '2024-01-01'}, 'post_date 格式应为'),
+    ({'data': {'title': 'x'}, 'status': 'deleted'}, '无效状态：deleted'),
+])
+def test_invalid_rows(row, message):
+    with pytest.raises(ValueError, match=message):
+        validate(row)
+
+
+def test_read_jsonl_rows():
+    stream = io.BytesIO('{"data": {"title": "a"}}\n\nnot json\n[1]\n'.encode('utf-8'))
+    rows = list(read_import_rows(stream, 'jsonl'))
+    assert [line_no for line_no, row in rows] == [1, 3, 4]
+    assert rows[0][1] == {'data': {'title': 'a'}}
+    with pytest.raises(ValueError, match='JSON 格式错误'):
+        validate(rows[1][1])
+    with pytest.raises(ValueError, match='每行必须是一个 JSON 对象'):
+        validate(rows[2][1])
+
+
+def test_read_csv_rows():
+    stream = io.BytesIO('\ufefftitle,price\nlamp,3\n"two\nlines",\n'.encode('utf-8'))
+    rows = list(read_import_rows(stream, 'csv'))
+    assert rows == [(2, {'title': 'lamp', 'price': '3'}), (4, {'title': 'two\nlines', 'price': ''})]
+
+
+def test_import_listings_skips_bad_rows(ctx):
+    settings = get_settings()
+    store = get_store()
+    before = store.writer().execute('SELECT count(*) FROM listings').fetchone()[0]
+    rows = [(1, {'data': {'field_name_1': 'imported one'}}),
+            (2, {'data': {'field_name_2': 5}}),
+            (3, {'data': {'field_name_1': 'imported two', 'field_name_2': '7'}, 'status': 'closed'}),
+            (4, ValueError('JSON 格式错误：boom'))]
+    imported, rejected, errors = import_listings(rows, settings, 1)
+    assert (imported, rejected) == (2, 2)
+    assert errors == ["第 2 行：字段 '字段1' 是必填的", '第 4 行：JSON 格式错误：boom']
+
+    listings = store.writer().execute('SELECT data, status FROM listings ORDER BY id DESC LIMIT 2').fetchall()
+    assert [(json.loads(row['data']), row['status']) for row in reversed(listings)] == [
+        ({'field_name_1': 'imported one', 'field_name_2': None, 'field_name_3': None}, 'open'),
+        ({'field_name_1': 'imported two', 'field_name_2': 7, 'field_name_3': None}, 'closed'),
+    ]
+    assert store.writer().execute('SELECT count(*) FROM listings').fetchone()[0] == before + 2
+
+
+def test_import_route(admin):
+    body = '{"data": {"field_name_1": "via upload"}}\n{"data": {"nope": 1}}\n'.encode('utf-8')
+    response = admin.post('/admin/import_listings', data={'file': (io.BytesIO(body), 'listings.jsonl')},
+                          follow_redirects=True)
+    page = response.get_data(as_text=True)
+    assert '导入完成：成功 1 条，跳过 1 条。' in page
+    assert '第 2 行：未知字段：nope' in page
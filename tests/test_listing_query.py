@@ -0,0 +1,52 @@
+import pytest
+
+from app import ListingQuery, get_settings, get_store
+
+TAG = 'numericsort'
+
+
+@pytest.fixture
+def listings(admin):
+    if not admin.get('/api/listings', query_string={'q': TAG}).get_json()['listings']:
+        for value in ('9', '100', '', '10', '-2.5'):
+            admin.post('/post_demand', data={'field_name_1': f'{TAG} {value or "none"}', 'field_name_2': value,
+                                             'field_name_3': ''})
+
+
+def values(client, **args):
+    args.setdefault('limit', 20)
+    listings = client.get('/api/listings', query_string=dict(args, q=TAG)).get_json()['listings']
+    return [listing['data']['field_name_2'] for listing in listings]
+
+
+def test_number_sort_is_numeric(client, listings):
+    assert values(client, sort='field_name_2', order='asc') == [None, -2.5, 9, 10, 100]
+    assert values(client, sort='field_name_2', order='desc') == [100, 10, 9, -2.5, None]
+
+
+def test_number_sort_pages_with_cursor(client, listings):
+    seen = []
+    args = {'q': TAG, 'sort': 'field_name_2', 'order': 'asc', 'limit': 2}
+    while True:
+        body = client.get('/api/listings', query_string=args).get_json()
+        seen += [listing['data']['field_name_2'] for listing in body['listings']]
+        if not body['next_cursor']:
+            break
+        args['after'] = body['next_cursor']
+    assert seen == [None, -2.5, 9, 10, 100]
+
+
+@pytest.mark.parametrize('bounds, expected', [
+    ({'field_name_2_min': '10'}, [10, 100]),
+    ({'field_name_2_max': '10'}, [-2.5, 9, 10]),
+    ({'field_name_2_min': '-3', 'field_name_2_max': '9.5'}, [-2.5, 9]),
+    ({'field_name_2_min': 'abc'}, [None, -2.5, 9, 10, 100]),
+])
+def test_number_range_filters(client, listings, bounds, expected):
+    assert values(client, sort='field_name_2', order='asc', **bounds) == expected
+
+
+def test_field_column_index_serves_the_sort(ctx):
+    query = ListingQuery(get_settings(), {'sort': 'field_name_2', 'order': 'asc'}, 20)
+    plan = ' '.join(row[3] for row in get_store().writer().execute('EXPLAIN QUERY PLAN ' + query.sql, query.params))
+    assert 'idx_listings_f_field_name_2' in plan and 'TEMP B-TREE' not in plan
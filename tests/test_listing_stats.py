@@ -0,0 +1,68 @@
+import sqlite3
+
+import app as app_module
+from app import DATABASE
+
+
+def query(sql, params=()):
+    db = sqlite3.connect(DATABASE)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+
+def counts(user_id):
+    return query('SELECT post_count, accepted_count FROM users WHERE id = ?', (user_id,))[0]
+
+
+def rollup():
+    return dict(((day, status), count) for day, status, count in
+                query('SELECT day, status, count FROM listing_stats WHERE count != 0'))
+
+
+def test_counters_follow_every_write(admin, user_client):
+    client, user_id = user_client
+    for i in range(3):
+        client.post('/post_demand', data={'field_name_1': f'counted {i}', 'field_name_2': '', 'field_name_3': ''})
+    assert counts(user_id) == (3, 0)
+    first, second, third = [row[0] for row in query('SELECT id FROM listings WHERE user_id = ? ORDER BY id',
+                                                    (user_id,))]
+
+    admin.post(f'/set_status/{first}', data={'status': 'accepted'})
+    admin.post(f'/set_status/{second}', data={'status': 'accepted'})
+    assert counts(user_id) == (3, 2)
+    client.post(f'/set_status/{first}', data={'status': 'closed'})
+    assert counts(user_id) == (3, 2)
+    admin.post(f'/set_status/{second}', data={'status': 'open'})
+    assert counts(user_id) == (3, 1)
+
+    client.get(f'/delete_demand/{first}')
+    assert counts(user_id) == (3, 1)
+    admin.get(f'/delete_demand/{first}')
+    client.get(f'/delete_demand/{third}')
+    assert counts(user_id) == (1, 0)
+
+
+def test_bulk_import_updates_counters(ctx, user):
+    user_id = user[0]
+    store = app_module.get_store()
+    store.insert_listings([({'field_name_1': 'bulk'}, (user_id, '{"field_name_1": "bulk"}', '2020-02-02 10:00:00',
+                                                       status)) for status in ('open', 'accepted', 'closed')],
+                          app_module.get_settings()['search_fields'])
+    assert counts(user_id) == (3, 2)
+    assert rollup()[('2020-02-02', 'accepted')] >= 1
+
+
+def test_triggers_agree_with_a_full_recount(app, user_client):
+    client, user_id = user_client
+    client.post('/post_demand', data={'field_name_1': 'recount', 'field_name_2': '', 'field_name_3': ''})
+    before = (query('SELECT id, post_count, accepted_count FROM users ORDER BY id'), rollup())
+    with app.app_context():
+        db = app_module.get_pool().acquire()
+        try:
+            app_module.rebuild_listing_stats(db)
+            db.commit()
+        finally:
+            app_module.get_pool().release(db)
+    assert (query('SELECT id, post_count, accepted_count FROM users ORDER BY id'), rollup()) == before
@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+from app import DATABASE, SQLiteStore, flush_history, get_store
+
+
+def status(listing_id):
+    db = sqlite3.connect(DATABASE)
+    try:
+        return db.execute('SELECT status FROM listings WHERE id = ?', (listing_id,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def listing(user_client):
+    client, user_id = user_client
+    client.post('/post_demand', data={'field_name_1': 'status listing', 'field_name_2': '', 'field_name_3': ''})
+    return client.get('/api/listings?limit=1').get_json()['listings'][0]['id']
+
+
+def set_status(client, listing_id, target):
+    response = client.post(f'/set_status/{listing_id}', data={'status': target}, follow_redirects=True)
+    return response.get_data(as_text=True)
+
+
+def test_owner_and_admin_transitions(admin, user_client, listing):
+    owner, _ = user_client
+    assert '您无权修改此内容的状态' in set_status(owner, listing, 'accepted')
+    assert status(listing) == 'open'
+    assert '无法变更为该状态' in set_status(admin, listing, 'closed')
+    assert status(listing) == 'open'
+
+    assert '状态已更新为“已接受”' in set_status(admin, listing, 'accepted')
+    assert '状态已更新为“已完成”' in set_status(owner, listing, 'closed')
+    assert '您无权修改此内容的状态' in set_status(owner, listing, 'open')
+    assert '状态已更新为“开放”' in set_status(admin, listing, 'open')
+    assert status(listing) == 'open'
+
+
+def test_unknown_status_is_rejected(admin, listing):
+    assert '无法变更为该状态' in set_status(admin, listing, 'deleted')
+    assert status(listing) == 'open'
+
+
+def test_bulk_status_skips_listings_in_other_states(admin, user_client):
+    client, _ = user_client
+    for i in range(3):
+        client.post('/post_demand', data={'field_name_1': f'bulk {i}', 'field_name_2': '', 'field_name_3': ''})
+    ids = [listing['id'] for listing in client.get('/api/listings?limit=3').get_json()['listings']]
+    set_status(admin, ids[0], 'accepted')
+
+    response = admin.post('/admin/bulk_status', data={'status': 'accepted', 'demand_ids': ids}, follow_redirects=True)
+    page = response.get_data(as_text=True)
+    assert '已将 2 条内容的状态更新为“已接受”' in page and '1 条内容的当前状态无法变更为该状态' in page
+    assert [status(listing_id) for listing_id in ids] == ['accepted'] * 3
+
+    client.post('/admin/bulk_status', data={'status': 'open', 'demand_ids': ids})
+    assert [status(listing_id) for listing_id in ids] == ['accepted'] * 3
+
+
+
+def set_status_entries(app, listing_id):
+    flush_history()
+    with app.app_context():
+        return [entry for entry in get_store().page_history(1000, action='set_status')
+                if entry['target'] == f'listing:{listing_id}']
+
+
+def test_concurrent_change_is_reported(app, admin, listing, monkeypatch):
+    get_listing = SQLiteStore.get_listing
+
+    def stale_get_listing(self, listing_id, replica=False):
+        # Another request accepts the listing right after this one has read it.
+        row = get_listing(self, listing_id, replica)
+        db = sqlite3.connect(DATABASE)
+        db.execute("UPDATE listings SET status = 'accepted' WHERE id = ?", (listing_id,))
+        db.commit()
+        db.close()
+        return row
+
+    monkeypatch.setattr(SQLiteStore, 'get_listing', stale_get_listing)
+    assert '无法变更为该状态' in set_status(admin, listing, 'accepted')
+    assert set_status_entries(app, listing) == []
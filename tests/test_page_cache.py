@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from app import DATABASE, PageCache, page_cache
+
+
+def test_lru_eviction_by_size():
+    cache = PageCache(max_bytes=80, ttl=60)
+    for key in 'abc':
+        cache.set(key, 'x' * 10)
+    cache.get('a')
+    for key in 'defghi':
+        cache.set(key, 'x' * 10)
+    assert cache.get('a') is not None and cache.get('b') is None
+    assert cache.stats()['bytes'] <= 80
+    cache.set('big', 'x' * 11)
+    assert cache.get('big') is None
+
+
+def test_ttl_expiry(monkeypatch):
+    cache = PageCache(max_bytes=1000, ttl=5)
+    now = [100.0]
+    monkeypatch.setattr('app.time.monotonic', lambda: now[0])
+    cache.set('key', 'html')
+    assert cache.get('key') == 'html'
+    now[0] += 6
+    assert cache.get('key') is None and cache.stats()['entries'] == 0
+
+
+@pytest.fixture
+def listing_id(admin):
+    admin.post('/post_demand', data={'field_name_1': 'cached original', 'field_name_2': '', 'field_name_3': ''})
+    return admin.get('/api/listings?limit=1').get_json()['listings'][0]['id']
+
+
+def test_repeat_requests_hit_the_cache(client, listing_id):
+    client.get(f'/view_details/{listing_id}')
+    hits = page_cache.stats()['hits']
+    assert 'cached original' in client.get(f'/view_details/{listing_id}').get_data(as_text=True)
+    assert page_cache.stats()['hits'] == hits + 1
+
+    # Writes that bypass the store do not bump a version, so the cached fragment is served.
+    db = sqlite3.connect(DATABASE)
+    db.execute("UPDATE listings SET data = json_set(data, '$.field_name_1', 'sneaky') WHERE id = ?", (listing_id,))
+    db.commit()
+    db.close()
+    assert 'cached original' in client.get(f'/view_details/{listing_id}').get_data(as_text=True)
+
+
+def test_writes_invalidate_listing_pages(client, admin, listing_id):
+    assert 'cached original' in client.get('/').get_data(as_text=True)
+    assert 'cached original' in client.get(f'/view_details/{listing_id}').get_data(as_text=True)
+
+    admin.post(f'/edit_demand/{listing_id}', data={'field_name_1': 'cached edited', 'field_name_2': '',
+                                                   'field_name_3': ''})
+    assert 'cached edited' in client.get('/').get_data(as_text=True)
+    assert 'cached edited' in client.get(f'/view_details/{listing_id}').get_data(as_text=True)
+
+    admin.post(f'/set_status/{listing_id}', data={'status': 'accepted'})
+    assert '已接受' in client.get(f'/view_details/{listing_id}').get_data(as_text=True)
+
+    admin.get(f'/delete_demand/{listing_id}')
+    assert 'cached edited' not in client.get('/').get_data(as_text=True)
+
+
+def test_cache_is_per_role(client, admin, listing_id):
+    assert f'/edit_demand/{listing_id}' in admin.get('/').get_data(as_text=True)
+    assert f'/edit_demand/{listing_id}' not in client.get('/').get_data(as_text=True)
+
+
+def test_filter_inputs_come_from_the_cache_key(client):
+    # ' kale ' and 'kale' share a cache entry, so the form must not echo the raw argument.
+    assert 'value=" kale "' not in client.get('/?q=+kale+&field_name_1=+leek').get_data(as_text=True)
+    page = client.get('/?q=kale&field_name_1=+leek').get_data(as_text=True)
+    assert 'value="kale"' in page and 'value=" leek"' in page
@@ -0,0 +1,66 @@
+import datetime
+import sqlite3
+from collections import OrderedDict
+
+import pytest
+
+import app as app_module
+from app import Scheduler, acquire_lease, migrate_scheduler, off_peak
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'leases.db'))
+    migrate_scheduler(db)
+    yield db
+    db.close()
+
+
+def test_lease_is_exclusive_until_it_expires(db, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('app.time.time', lambda: now[0])
+    assert acquire_lease(db, 'scheduler', 'a', 30)
+    assert not acquire_lease(db, 'scheduler', 'b', 30)
+    now[0] += 20
+    assert acquire_lease(db, 'scheduler', 'a', 30)
+    now[0] += 20
+    assert not acquire_lease(db, 'scheduler', 'b', 30)
+    now[0] += 11
+    assert acquire_lease(db, 'scheduler', 'b', 30)
+    assert not acquire_lease(db, 'scheduler', 'a', 30)
+    assert db.execute('SELECT owner FROM scheduler_leases').fetchall() == [('b',)]
+
+
+@pytest.mark.parametrize('hours, hour, expected', [
+    ((2, 5), 1, False), ((2, 5), 2, True), ((2, 5), 5, False),
+    ((22, 4), 23, True), ((22, 4), 3, True), ((22, 4), 4, False), ((22, 4), 12, False),
+])
+def test_off_peak_window(app, monkeypatch, hours, hour, expected):
+    monkeypatch.setitem(app.config, 'MAINTENANCE_HOURS', hours)
+    assert off_peak(datetime.datetime(2024, 1, 1, hour)) is expected
+
+
+def test_only_the_leader_runs_jobs(app, monkeypatch):
+    runs = []
+    monkeypatch.setattr(app_module, 'SCHEDULED_JOBS', OrderedDict([
+        ('test_job', (lambda db: runs.append(1) or 'done', 3600, False)),
+    ]))
+    with app.app_context():
+        db = app_module.get_pool().acquire()
+        try:
+            db.execute("DELETE FROM scheduler_leases WHERE name = 'scheduler'")
+            db.execute("DELETE FROM scheduled_jobs WHERE name = 'test_job'")
+            db.commit()
+        finally:
+            app_module.get_pool().release(db)
+
+        leader, follower = Scheduler(3600, 30), Scheduler(3600, 30)
+        leader.tick()
+        follower.tick()
+        assert runs == [1]
+        assert leader.stats()['leader'] == 1 and leader.stats()['runs'] == 1
+        assert follower.stats()['leader'] == 0 and follower.stats()['runs'] == 0
+
+        # The job interval is kept in scheduled_jobs, so the next tick does not run it again.
+        leader.tick()
+        assert runs == [1]
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+
+import pytest
+
+import app as app_module
+from app import SCHEMA_VERSION, fts_phrase, migrate_schema, schema_version
+
+# The schema as it was before schema_version existed.
+BASELINE_SCHEMA = '''
+CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL,
+                    is_admin INTEGER DEFAULT 0, is_locked INTEGER DEFAULT 0, expiry_date TEXT,
+                    post_count INTEGER DEFAULT 0, accepted_count INTEGER DEFAULT 0, last_rating INTEGER,
+                    UNIQUE (username));
+CREATE TABLE listings (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, data TEXT,
+                       post_date TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'open',
+                       FOREIGN KEY (user_id) REFERENCES users (id));
+CREATE TABLE settings (id INTEGER PRIMARY KEY AUTOINCREMENT, site_name TEXT DEFAULT '通用网站平台',
+                       registration_enabled INTEGER DEFAULT 1, fields_definition TEXT DEFAULT '[]');
+'''
+FIELDS = [
+    {"name": "title", "label": "标题", "type": "text", "required": True},
+    {"name": "price", "label": "价格", "type": "number", "required": False},
+]
+
+
+@pytest.fixture
+def baseline_db(tmp_path, ctx):
+    db = sqlite3.connect(str(tmp_path / 'baseline.db'))
+    db.row_factory = sqlite3.Row
+    db.executescript(BASELINE_SCHEMA)
+    db.execute("INSERT INTO users (username, password, is_admin) VALUES ('admin', 'x', 1), ('bob', 'x', 0)")
+    db.execute('INSERT INTO settings (site_name, fields_definition) VALUES (?, ?)', ('旧站点', json.dumps(FIELDS)))
+    db.executemany('INSERT INTO listings (user_id, data, post_date, status) VALUES (?, ?, ?, ?)', [
+        (2, json.dumps({'title': 'vintage bicycle', 'price': 120}), '2023-05-01 10:00:00', 'open'),
+        (2, json.dumps({'title': 'oak bookshelf', 'price': '80'}), '2023-05-02 10:00:00', 'accepted'),
+    ])
+    db.commit()
+    yield db
+    db.close()
+
+
+def test_migrate_from_baseline(baseline_db):
+    db = baseline_db
+    assert schema_version(db) == 0
+    assert migrate_schema(db) == list(range(1, SCHEMA_VERSION + 1))
+    assert schema_version(db) == SCHEMA_VERSION
+
+    settings = db.execute('SELECT * FROM settings WHERE id = 1').fetchone()
+    assert settings['site_name'] == '旧站点'
+    assert json.loads(settings['fields_definition']) == FIELDS
+    assert [row['status'] for row in db.execute('SELECT status FROM listings ORDER BY id')] == ['open', 'accepted']
+    assert db.execute("SELECT count(*) FROM users WHERE username = 'admin'").fetchone()[0] == 1
+
+    bob = db.execute("SELECT post_count, accepted_count FROM users WHERE username = 'bob'").fetchone()
+    assert (bob['post_count'], bob['accepted_count']) == (2, 1)
+    hits = db.execute('SELECT d.listing_id FROM listings_fts JOIN search_docs d ON d.id = listings_fts.rowid '
+                      'WHERE listings_fts MATCH ?', (fts_phrase('bookshelf'),)).fetchall()
+    assert [row[0] for row in hits] == [2]
+    for table in ('history', 'field_migrations', 'sessions', 'session_revocations', 'scheduled_jobs'):
+        assert db.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (table,)).fetchone() is not None
+
+
+def test_migrate_is_idempotent(baseline_db):
+    migrate_schema(baseline_db)
+    assert migrate_schema(baseline_db) == []
+    assert schema_version(baseline_db) == SCHEMA_VERSION
+
+
+def test_migrate_resumes_from_recorded_version(baseline_db):
+    db = baseline_db
+    migrate_schema(db)
+    db.execute('DELETE FROM schema_version WHERE version > 5')
+    db.execute('DROP TABLE sessions')
+    db.commit()
+    assert migrate_schema(db) == list(range(6, SCHEMA_VERSION + 1))
+    assert db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sessions'").fetchone() is not None
+
+
+def test_outdated_schema_answers_503(client, monkeypatch):
+    monkeypatch.setattr(app_module, '_schema_outdated', True)
+    monkeypatch.setattr(app_module, 'load_schema_state', lambda db: SCHEMA_VERSION - 1)
+    assert client.get('/').status_code == 503
+    assert client.get('/api/listings').status_code == 503
@@ -0,0 +1,60 @@
+import pytest
+
+from app import fts_phrase, get_settings, get_store
+
+
+def matches(term):
+    db = get_store().writer()
+    return {row[0] for row in db.execute('SELECT d.listing_id FROM listings_fts '
+                                         'JOIN search_docs d ON d.id = listings_fts.rowid '
+                                         'WHERE listings_fts MATCH ?', (fts_phrase(term),))}
+
+
+@pytest.fixture
+def store(ctx):
+    return get_store()
+
+
+def insert(store, data):
+    with store.batch():
+        return store.insert_listing(1, data, '2024-01-01 00:00:00', get_settings()['search_fields'])
+
+
+def test_insert_indexes_text_fields(store):
+    listing_id = insert(store, {'field_name_1': 'aubergine', 'field_name_2': 7, 'field_name_3': 'zucchini'})
+    assert matches('aubergine') == {listing_id}
+    assert matches('ucchin') == {listing_id}
+    assert matches('7') == set()
+
+
+def test_update_replaces_indexed_text(store):
+    listing_id = insert(store, {'field_name_1': 'parsnip', 'field_name_2': None, 'field_name_3': None})
+    with store.batch():
+        store.update_listing(listing_id, {'field_name_1': 'rutabaga', 'field_name_2': None, 'field_name_3': None},
+                             get_settings()['search_fields'], 0)
+    assert matches('parsnip') == set()
+    assert matches('rutabaga') == {listing_id}
+
+
+def test_delete_removes_indexed_text(store):
+    listing_id = insert(store, {'field_name_1': 'kohlrabi', 'field_name_2': None, 'field_name_3': 'celeriac'})
+    with store.batch():
+        store.delete_listing(listing_id)
+    assert matches('kohlrabi') == set()
+    assert matches('celeriac') == set()
+    assert store.writer().execute('SELECT count(*) FROM search_docs WHERE listing_id = ?',
+                                  (listing_id,)).fetchone()[0] == 0
+
+
+def test_bulk_insert_indexes_text_fields(store):
+    store.insert_listings([({'field_name_1': 'salsify'}, (1, '{"field_name_1": "salsify"}', '2024-01-01 00:00:00',
+                                                          'open'))], get_settings()['search_fields'])
+    listing_id = store.writer().execute('SELECT max(id) FROM listings').fetchone()[0]
+    assert matches('salsify') == {listing_id}
+
+
+def test_search_page(admin):
+    admin.post('/post_demand', data={'field_name_1': 'chayote squash', 'field_name_2': '', 'field_name_3': ''})
+    assert 'chayote squash' in admin.get('/?q=chayote').get_data(as_text=True)
+    assert 'chayote squash' not in admin.get('/?q=romanesco').get_data(as_text=True)
+    assert admin.get('/?q=%00').status_code == 200
@@ -0,0 +1,72 @@
+import sqlite3
+
+import pytest
+
+from app import DATABASE
+
+
+def session_rows(user_id):
+    db = sqlite3.connect(DATABASE)
+    try:
+        return db.execute('SELECT count(*) FROM sessions WHERE user_id IS ?', (user_id,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def logged_in(client):
+    response = client.get('/post_demand')
+    return response.status_code == 200
+
+
+def test_login_is_stored_server_side(user_client):
+    client, user_id = user_client
+    assert logged_in(client)
+    assert session_rows(user_id) == 1
+    assert not client.get_cookie('session').value.startswith('c.')
+
+
+def test_anonymous_sessions_are_not_stored(client):
+    client.get('/post_demand')
+    assert client.get_cookie('session').value.startswith('c.')
+    assert session_rows(None) == 0
+
+
+def test_logout(user_client):
+    client, user_id = user_client
+    client.get('/logout')
+    assert not logged_in(client)
+    assert session_rows(user_id) == 0
+
+
+@pytest.mark.parametrize('action', [
+    lambda admin, user_id: admin.get(f'/admin/toggle_lock/{user_id}'),
+    lambda admin, user_id: admin.post(f'/admin/set_expiry/{user_id}', data={'expiry_date': '2000-01-01'}),
+    lambda admin, user_id: admin.get(f'/admin/delete_user/{user_id}'),
+], ids=['lock', 'expiry', 'delete'])
+def test_admin_actions_revoke_sessions(admin, user_client, action):
+    client, user_id = user_client
+    assert logged_in(client)
+    action(admin, user_id)
+    assert session_rows(user_id) == 0
+    assert not logged_in(client)
+
+
+def test_future_expiry_also_revokes(admin, user_client):
+    # Changing the expiry date logs the user out, so the new date is picked up on the next login.
+    client, user_id = user_client
+    admin.post(f'/admin/set_expiry/{user_id}', data={'expiry_date': '2999-01-01'})
+    assert not logged_in(client)
+
+
+def test_revocation_by_another_worker(app, user_client):
+    client, user_id = user_client
+    db = sqlite3.connect(DATABASE)
+    db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+    db.execute('INSERT INTO session_revocations (user_id, created_at) VALUES (?, 0)', (user_id,))
+    db.commit()
+    db.close()
+    app.config['SESSION_SYNC_INTERVAL'] = 0
+    try:
+        assert not logged_in(client)
+    finally:
+        app.config['SESSION_SYNC_INTERVAL'] = 1.0
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+import app as app_module
+from app import DATABASE
+
+
+def query(sql, params=()):
+    db = sqlite3.connect(DATABASE)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+
+def post_fields(admin, fields, wait=True):
+    form = {}
+    for i, (field, original) in enumerate(fields, 1):
+        form.update({f'field_name_{i}': field['name'], f'field_label_{i}': field['label'],
+                     f'field_type_{i}': field['type'], f'field_original_{i}': original})
+        if field['required']:
+            form[f'field_required_{i}'] = 'on'
+    admin.post('/admin/update_fields', data=form)
+    if not wait:
+        return
+    deadline = time.time() + 10
+    while query("SELECT 1 FROM field_migrations WHERE status != 'done'") and time.time() < deadline:
+        time.sleep(0.05)
+    assert not query("SELECT 1 FROM field_migrations WHERE status != 'done'")
+
+
+@pytest.fixture
+def fields(admin):
+    original = json.loads(query('SELECT fields_definition FROM settings WHERE id = 1')[0][0])
+    yield original
+    post_fields(admin, [(field, field['name']) for field in original])
+
+
+def test_swap_fields(admin, fields):
+    admin.post('/post_demand', data={'field_name_1': 'first value', 'field_name_2': '3', 'field_name_3': 'third'})
+    listing_id = query('SELECT max(id) FROM listings')[0][0]
+    first, second, third = fields
+
+    post_fields(admin, [(dict(first, name='field_name_3'), 'field_name_1'), (second, 'field_name_2'),
+                        (dict(third, name='field_name_1'), 'field_name_3')])
+    data = json.loads(query('SELECT data FROM listings WHERE id = ?', (listing_id,))[0][0])
+    assert data == {'field_name_3': 'first value', 'field_name_2': 3, 'field_name_1': 'third'}
+    assert dict(query('SELECT field, body FROM search_docs WHERE listing_id = ?', (listing_id,))) == \
+        {'field_name_3': 'first value', 'field_name_1': 'third'}
+
+
+def test_drop_field(admin, fields):
+    admin.post('/post_demand', data={'field_name_1': 'kept', 'field_name_2': '', 'field_name_3': 'dropped'})
+    listing_id = query('SELECT max(id) FROM listings')[0][0]
+
+    post_fields(admin, [(field, field['name']) for field in fields[:2]])
+    data = json.loads(query('SELECT data FROM listings WHERE id = ?', (listing_id,))[0][0])
+    assert data == {'field_name_1': 'kept', 'field_name_2': None}
+    assert query('SELECT field FROM search_docs WHERE listing_id = ?', (listing_id,)) == [('field_name_1',)]
+
+
+@pytest.fixture
+def paused_runner(monkeypatch):
+    """Keep the background runner away from migrations started by the test; run_migrations() finishes them."""
+    monkeypatch.setattr(app_module, 'start_field_migration', lambda: None)
+    monkeypatch.setattr(app_module, '_migrations_pending', False)
+
+
+def run_migrations(app):
+    with app.app_context():
+        pool = app_module.get_pool()
+        db = pool.acquire()
+        try:
+            while app_module.run_migration_batch(db):
+                pass
+            fields = db.execute('SELECT fields_definition FROM settings WHERE id = 1').fetchone()[0]
+            app_module.create_field_indexes(db, json.loads(fields))
+        finally:
+            pool.release(db)
+
+
+def listing_data(listing_id):
+    return json.loads(query('SELECT data FROM listings WHERE id = ?', (listing_id,))[0][0])
+
+
+def test_edit_before_the_runner_keeps_renamed_file_field(app, admin, fields, paused_runner):
+    first, second, third = fields
+    photo = {'name': 'photo', 'label': '图片', 'type': 'file', 'required': False}
+    post_fields(admin, [(field, field['name']) for field in fields] + [(photo, '')], wait=False)
+    run_migrations(app)
+    admin.post('/post_demand', data={'field_name_1': 'hello', 'field_name_2': '', 'field_name_3': ''})
+    listing_id = query('SELECT max(id) FROM listings')[0][0]
+    db = sqlite3.connect(DATABASE)
+    db.execute("UPDATE listings SET data = json_set(data, '$.photo', 'abc.png') WHERE id = ?", (listing_id,))
+    db.commit()
+    db.close()
+
+    post_fields(admin, [(first, 'field_name_1'), (second, 'field_name_2'), (third, 'field_name_3'),
+                        (dict(photo, name='image'), 'photo')], wait=False)
+    assert 'photo' in listing_data(listing_id)
+    assert admin.get(f'/api/listings/{listing_id}').get_json()['data']['image'] == 'abc.png'
+    assert 'abc.png' in admin.get(f'/view_details/{listing_id}').get_data(as_text=True)
+    assert 'abc.png' in admin.get(f'/edit_demand/{listing_id}').get_data(as_text=True)
+
+    admin.post(f'/edit_demand/{listing_id}', data={'field_name_1': 'hello2', 'field_name_2': '', 'field_name_3': ''})
+    expected = {'field_name_1': 'hello2', 'field_name_2': None, 'field_name_3': '', 'image': 'abc.png'}
+    assert listing_data(listing_id) == expected
+    run_migrations(app)
+    assert listing_data(listing_id) == expected
+
+
+def test_runner_skips_listings_edited_during_a_swap(app, admin, fields, paused_runner):
+    for value in ('edited', 'untouched'):
+        admin.post('/post_demand', data={'field_name_1': value, 'field_name_2': '', 'field_name_3': 'other'})
+    edited_id, untouched_id = [row[0] for row in query('SELECT id FROM listings ORDER BY id DESC LIMIT 2')][::-1]
+    first, second, third = fields
+
+    post_fields(admin, [(dict(first, name='field_name_3'), 'field_name_1'), (second, 'field_name_2'),
+                        (dict(third, name='field_name_1'), 'field_name_3')], wait=False)
+    listings = {listing['id']: listing['data'] for listing in admin.get('/api/listings').get_json()['listings']}
+    assert listings[untouched_id] == {'field_name_3': 'untouched', 'field_name_2': None, 'field_name_1': 'other'}
+
+    admin.post(f'/edit_demand/{edited_id}', data={'field_name_3': 'edited', 'field_name_2': '',
+                                                  'field_name_1': 'changed'})
+    run_migrations(app)
+    assert listing_data(edited_id) == {'field_name_3': 'edited', 'field_name_2': None, 'field_name_1': 'changed'}
+    assert listing_data(untouched_id) == {'field_name_3': 'untouched', 'field_name_2': None, 'field_name_1': 'other'}
+
+
+def test_field_change_leaves_row_work_to_the_runner(app, admin, fields, paused_runner):
+    admin.post('/post_demand', data={'field_name_1': 'runner value', 'field_name_2': '', 'field_name_3': ''})
+    listing_id = query('SELECT max(id) FROM listings')[0][0]
+    first, second, third = fields
+    price = {'name': 'price', 'label': '价格', 'type': 'number', 'required': False}
+
+    post_fields(admin, [(dict(first, name='title'), 'field_name_1'), (second, 'field_name_2'), (third, 'field_name_3'),
+                        (price, '')], wait=False)
+    assert query("SELECT 1 FROM sqlite_master WHERE name = 'idx_listings_f_price'") == []
+    assert query('SELECT field FROM search_docs WHERE listing_id = ?', (listing_id,)) == [('field_name_1',)]
+    assert 'runner value' in admin.get('/?q=runner').get_data(as_text=True)
+
+    run_migrations(app)
+    assert query("SELECT 1 FROM sqlite_master WHERE name = 'idx_listings_f_price'") == [(1,)]
+    assert query('SELECT field FROM search_docs WHERE listing_id = ?', (listing_id,)) == [('title',)]
+    assert 'runner value' in admin.get('/?title=runner').get_data(as_text=True)
+
+
+@pytest.mark.parametrize('name, message', [
+    ("bad'name", '字段名无效'),
+    ('1st', '字段名无效'),
+    ('a.b', '字段名无效'),
+    ('field_name_1', '字段名重复'),
+])
+def test_invalid_field_names_are_rejected(admin, fields, name, message):
+    before = query('SELECT fields_definition, version FROM settings WHERE id = 1')
+    first, second, third = fields
+    form = {}
+    for i, (field, original) in enumerate([(first, 'field_name_1'), (second, 'field_name_2'),
+                                           (dict(third, name=name), 'field_name_3')], 1):
+        form.update({f'field_name_{i}': field['name'], f'field_label_{i}': field['label'],
+                     f'field_type_{i}': field['type'], f'field_original_{i}': original})
+    response = admin.post('/admin/update_fields', data=form, follow_redirects=True)
+    assert message in response.get_data(as_text=True)
+    assert query('SELECT fields_definition, version FROM settings WHERE id = 1') == before
+    assert admin.get("/?field_name_1=x").status_code == 200
@@ -0,0 +1,73 @@
+import hashlib
+import io
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from app import store_upload
+
+CONTENT = b'0123456789' * 10
+GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,'
+       b'\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
+
+@pytest.fixture
+def upload(app):
+    name = hashlib.sha256(CONTENT).hexdigest() + '.txt'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'wb') as f:
+        f.write(CONTENT)
+    return name
+
+
+def test_content_addressed_upload_is_immutable(app, client, upload):
+    response = client.get(f'/uploads/{upload}')
+    assert response.data == CONTENT
+    assert response.headers['ETag'] == f'"{upload[:64]}"'
+    assert response.cache_control.immutable and response.cache_control.public
+    assert response.cache_control.max_age == app.config['UPLOAD_IMMUTABLE_MAX_AGE']
+
+    response = client.get(f'/uploads/{upload}', headers={'If-None-Match': f'"{upload[:64]}"'})
+    assert response.status_code == 304 and response.data == b''
+
+
+def test_range_requests(client, upload):
+    response = client.get(f'/uploads/{upload}', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206 and response.data == CONTENT[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(CONTENT)}'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    response = client.get(f'/uploads/{upload}', headers={'Range': 'bytes=500-'})
+    assert response.status_code == 416
+
+
+def test_legacy_names_get_a_short_max_age(app, client):
+    name = '20240101120000_legacy.txt'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'wb') as f:
+        f.write(b'legacy')
+    response = client.get(f'/uploads/{name}')
+    assert response.data == b'legacy' and not response.cache_control.immutable
+    assert response.cache_control.max_age == app.config['UPLOAD_MAX_AGE']
+    etag = response.headers['ETag']
+    assert client.get(f'/uploads/{name}', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_offloaded_uploads(app, client, upload, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_OFFLOAD', 'x-accel')
+    response = client.get(f'/uploads/{upload}')
+    assert response.headers['X-Accel-Redirect'] == app.config['UPLOAD_ACCEL_PREFIX'] + upload
+    assert response.headers['ETag'] == f'"{upload[:64]}"' and response.data == b''
+    assert client.get(f'/uploads/{upload}', headers={'If-None-Match': f'"{upload[:64]}"'}).status_code == 304
+
+    monkeypatch.setitem(app.config, 'UPLOAD_OFFLOAD', 'x-sendfile')
+    response = client.get(f'/uploads/{upload}')
+    assert response.headers['X-Sendfile'] == os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], upload))
+    assert client.get('/uploads/missing.txt').status_code == 404
+    assert client.get('/uploads/..%2Fdatabase.db').status_code == 404
+
+
+def test_identical_uploads_are_stored_once(app, ctx):
+    first = store_upload(FileStorage(io.BytesIO(GIF), 'a.GIF'))
+    second = store_upload(FileStorage(io.BytesIO(GIF), 'b.gif'))
+    assert first == second == hashlib.sha256(GIF).hexdigest() + '.gif'
+    assert not [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if name.startswith('.upload-')]